@@ -4,6 +4,11 @@ export SEGMENT_TAG=us-central1-docker.pkg.dev/bsos-geog-harvest1/street2sat-segm
 export SEGMENT_URL="https://street2sat-segment-grxg7bzh2a-uc.a.run.app/predictions/segmentation"
 export SATELLITE_TAG=us-central1-docker.pkg.dev/bsos-geog-harvest1/street2sat-satellite/street2sat-satellite
 export SATELLITE_URL="https://street2sat-satellite-grxg7bzh2a-uc.a.run.app/predictions/satellite"
+export FUSED_TAG=us-central1-docker.pkg.dev/bsos-geog-harvest1/street2sat-fused/street2sat-fused
+export FUSED_URL="https://street2sat-fused-grxg7bzh2a-uc.a.run.app/predictions/fused"
+# split: uploads go to cropnop, which copies crops to trigger segmentation
+# fused: uploads go to a single service running both models
+export PIPELINE=${PIPELINE:-split}
 
 export BUCKET_UPLOADED=street2sat-uploaded
 export BUCKET_CROPS=street2sat-crops
@@ -53,6 +58,25 @@ gcloud run deploy street2sat-segment --image ${SEGMENT_TAG}:latest \
         --allow-unauthenticated
 
 
+if [ "$PIPELINE" = "fused" ]; then
+        if [ -z "$(gcloud artifacts repositories list --format='get(name)' --filter "street2sat-fused")" ]; then
+                gcloud artifacts repositories create "street2sat-fused" \
+                --location "us-central1" \
+                --repository-format docker
+        fi
+        docker build . -f Dockerfile.fused -t $FUSED_TAG
+        docker push $FUSED_TAG
+        gcloud run deploy street2sat-fused --image ${FUSED_TAG}:latest \
+                --memory=16Gi \
+                --concurrency=20 \
+                --platform=managed \
+                --region=us-central1 \
+                --allow-unauthenticated
+        UPLOADED_URL="$FUSED_URL"
+else
+        UPLOADED_URL="$CROPNOP_URL"
+fi
+
 if [ -z "$(gcloud artifacts repositories list --format='get(name)' --filter "street2sat-satellite")" ]; then
         gcloud artifacts repositories create "street2sat-satellite" \
         --location "us-central1" \
@@ -68,13 +92,26 @@ gcloud run deploy street2sat-satellite --image ${SATELLITE_TAG}:latest \
         --region=us-central1 \
         --allow-unauthenticated
 
+# Shared with the inference services, the functions only upload their --source
+cp gcp/instrumentation.py gcp/trigger_inference/instrumentation.py
+cp gcp/instrumentation.py gcp/web_mercator.py gcp/get_satellite_img/
+
+gcloud functions deploy get-satellite-img \
+    --source=gcp/get_satellite_img \
+    --trigger-http \
+    --allow-unauthenticated \
+    --runtime=python39 \
+    --entry-point=hello_world \
+    --timeout=300s
+
 gcloud functions deploy trigger-street2sat-cropnop \
     --source=gcp/trigger_inference \
     --trigger-bucket=$BUCKET_UPLOADED \
     --allow-unauthenticated \
     --runtime=python39 \
     --entry-point=hello_gcs \
-    --set-env-vars INFERENCE_URL="$CROPNOP_URL" \
+    --retry \
+    --set-env-vars INFERENCE_URL="$UPLOADED_URL" \
     --timeout=300s
 
 gcloud functions deploy trigger-street2sat-segment \
@@ -83,6 +120,7 @@ gcloud functions deploy trigger-street2sat-segment \
     --allow-unauthenticated \
     --runtime=python39 \
     --entry-point=hello_gcs \
+    --retry \
     --set-env-vars INFERENCE_URL="$SEGMENT_URL" \
     --timeout=300s
 
@@ -92,6 +130,7 @@ gcloud functions deploy trigger-street2sat-satellite \
     --allow-unauthenticated \
     --runtime=python39 \
     --entry-point=hello_gcs \
+    --retry \
     --set-env-vars INFERENCE_URL="$SATELLITE_URL" \
     --timeout=300s
 
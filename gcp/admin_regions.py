@@ -0,0 +1,337 @@
+"""
+GAUL admin units of points, from a spatial index over the level 2 polygons.
+
+The polygons are not in the repo: export FAO/GAUL/2015/level2 from Earth
+Engine (or download GAUL) as GeoJSON, keeping the ADM0_CODE, ADM1_CODE and
+ADM2_CODE properties, the codes of data/gaul_adm1.csv and gaul_adm2.csv.
+The first load builds the index and caches it as an .npz next to the
+GeoJSON (or in cache_dir); the .npz itself can be loaded, from a local path
+or a gs:// uri, without the GeoJSON.
+
+The world is split into cells of cell_size degrees. Each cell overlapped
+by polygon bounding boxes lists those polygons, and each row of cells the
+polygon edges crossing its latitudes, so a point is tested, by even-odd
+ray casting vectorized over points and edges, only against the few
+polygons around it and their edges near its latitude.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# A GeoJSON or .npz path, or the gs:// uri of an .npz, unset to skip lookups
+ADMIN_BOUNDARIES = os.environ.get("ADMIN_BOUNDARIES")
+ADMIN_INDEX_CACHE = os.environ.get("ADMIN_INDEX_CACHE")
+CODE_PROPERTIES = ("ADM0_CODE", "ADM1_CODE", "ADM2_CODE")
+# Document fields, named as the columns of data/gaul_adm*.csv
+CODE_FIELDS = ("gaul_adm0", "gaul_adm1", "gaul_adm2")
+# Bounds the (points, edges) arrays of a test to about 32 MB
+MAX_TEST_SIZE = 1 << 22
+
+
+def read_polygons(path: Path) -> Tuple[List[List[np.ndarray]], np.ndarray]:
+    """
+    Returns the rings, (N, 2) lon/lat arrays, of every Polygon or
+    MultiPolygon feature of a GeoJSON file, and their (P, 3) codes
+    """
+    with open(path) as f:
+        features = json.load(f)["features"]
+    rings, codes = [], []
+    for feature in features:
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        # Holes are rings too, even-odd counting excludes them
+        rings.append(
+            [np.asarray(ring, dtype=np.float64)[:, :2] for p in polygons for ring in p]
+        )
+        properties = feature.get("properties") or {}
+        codes.append([int(properties.get(key, -1)) for key in CODE_PROPERTIES])
+    return rings, np.asarray(codes, dtype=np.int64).reshape(-1, 3)
+
+
+def _get_rows(lat: np.ndarray, cell_size: float) -> np.ndarray:
+    return np.floor((lat + 90) / cell_size).astype(np.int64)
+
+
+def _get_cols(lon: np.ndarray, cell_size: float) -> np.ndarray:
+    return np.floor((lon + 180) / cell_size).astype(np.int64)
+
+
+class AdminIndex:
+    """
+    Use AdminIndex.build on polygons or load_admin_index on a file
+    """
+
+    def __init__(
+        self,
+        cell_size: float,
+        codes: np.ndarray,
+        cell_keys: np.ndarray,
+        cell_offsets: np.ndarray,
+        cell_polygons: np.ndarray,
+        row_offsets: np.ndarray,
+        edges: np.ndarray,
+        edge_polygons: np.ndarray,
+    ):
+        self.cell_size = cell_size
+        self.rows = int(round(180 / cell_size))
+        self.cols = int(round(360 / cell_size))
+        self.codes = codes
+        self.cell_keys = cell_keys
+        self.cell_offsets = cell_offsets
+        self.cell_polygons = cell_polygons
+        self.row_offsets = row_offsets
+        self.edges = edges
+        self.edge_polygons = edge_polygons
+
+    @classmethod
+    def build(
+        cls, rings: List[List[np.ndarray]], codes: np.ndarray, cell_size: float = 0.1
+    ) -> "AdminIndex":
+        rows, cols = int(round(180 / cell_size)), int(round(360 / cell_size))
+
+        # Cells overlapped by the bounding box of every polygon
+        cell_ids, cell_polygons = [], []
+        for i, polygon in enumerate(rings):
+            points = np.concatenate(polygon)
+            row_range = np.clip(_get_rows(points[:, 1], cell_size), 0, rows - 1)
+            col_range = np.clip(_get_cols(points[:, 0], cell_size), 0, cols - 1)
+            polygon_rows, polygon_cols = np.meshgrid(
+                np.arange(row_range.min(), row_range.max() + 1),
+                np.arange(col_range.min(), col_range.max() + 1),
+                indexing="ij",
+            )
+            ids = (polygon_rows * cols + polygon_cols).ravel()
+            cell_ids.append(ids)
+            cell_polygons.append(np.full(len(ids), i, dtype=np.int32))
+        cell_ids_array = np.concatenate(cell_ids) if cell_ids else np.zeros(0, int)
+        cell_polygons_array = (
+            np.concatenate(cell_polygons) if cell_polygons else np.zeros(0, np.int32)
+        )
+        order = np.argsort(cell_ids_array, kind="stable")
+        # Only the cells overlapped by a polygon are kept, the rest is sea
+        cell_keys, cell_counts = np.unique(cell_ids_array, return_counts=True)
+        cell_offsets = np.zeros(len(cell_keys) + 1, dtype=np.int64)
+        np.cumsum(cell_counts, out=cell_offsets[1:])
+
+        # Every non horizontal edge, in each row of cells its latitudes cross
+        edges, edge_polygons = [], []
+        for i, polygon in enumerate(rings):
+            for ring in polygon:
+                if not np.array_equal(ring[0], ring[-1]):
+                    ring = np.vstack([ring, ring[:1]])
+                ring_edges = np.hstack([ring[:-1], ring[1:]])
+                ring_edges = ring_edges[ring_edges[:, 1] != ring_edges[:, 3]]
+                edges.append(ring_edges)
+                edge_polygons.append(np.full(len(ring_edges), i, dtype=np.int32))
+        edges_array = np.concatenate(edges) if edges else np.zeros((0, 4))
+        edge_polygons_array = (
+            np.concatenate(edge_polygons) if edge_polygons else np.zeros(0, np.int32)
+        )
+        low = np.clip(
+            _get_rows(np.minimum(edges_array[:, 1], edges_array[:, 3]), cell_size),
+            0,
+            rows - 1,
+        )
+        high = np.clip(
+            _get_rows(np.maximum(edges_array[:, 1], edges_array[:, 3]), cell_size),
+            0,
+            rows - 1,
+        )
+        spans = high - low + 1
+        repeated = np.repeat(np.arange(len(edges_array)), spans)
+        starts = np.repeat(np.cumsum(spans) - spans, spans)
+        edge_rows = low[repeated] + np.arange(len(repeated)) - starts
+        # By row, then polygon, so a polygon's edges in a row are contiguous
+        order_edges = np.lexsort((edge_polygons_array[repeated], edge_rows))
+        row_offsets = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_rows, minlength=rows), out=row_offsets[1:])
+
+        return cls(
+            cell_size,
+            codes,
+            cell_keys,
+            cell_offsets,
+            cell_polygons_array[order],
+            row_offsets,
+            edges_array[repeated[order_edges]],
+            edge_polygons_array[repeated[order_edges]],
+        )
+
+    def save(self, path: Path):
+        # Written whole then renamed, several processes may build the cache
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.npz")
+        np.savez(
+            tmp_path,
+            cell_size=np.float64(self.cell_size),
+            codes=self.codes,
+            cell_keys=self.cell_keys,
+            cell_offsets=self.cell_offsets,
+            cell_polygons=self.cell_polygons,
+            row_offsets=self.row_offsets,
+            edges=self.edges,
+            edge_polygons=self.edge_polygons,
+        )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "AdminIndex":
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        return cls(float(arrays.pop("cell_size")), **arrays)
+
+    def lookup(self, lat: Sequence[float], lon: Sequence[float]) -> np.ndarray:
+        """
+        Returns the (N, 3) GAUL ADM0, ADM1 and ADM2 codes of the points,
+        -1 for points outside every polygon or without coordinates
+        """
+        lats = np.asarray(lat, dtype=np.float64)
+        lons = np.asarray(lon, dtype=np.float64)
+        result = np.full((len(lats), 3), -1, dtype=np.int64)
+        valid = np.isfinite(lats) & np.isfinite(lons)
+        rows = np.where(valid, _get_rows(np.nan_to_num(lats), self.cell_size), -1)
+        cols = np.where(valid, _get_cols(np.nan_to_num(lons), self.cell_size), -1)
+        valid &= (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        cells = rows * self.cols + cols
+
+        points = np.flatnonzero(valid)
+        order = points[np.argsort(cells[points], kind="stable")]
+        unique_cells, starts = np.unique(cells[order], return_index=True)
+        for cell, in_cell in zip(unique_cells, np.split(order, starts[1:])):
+            polygon = self._find(cell // self.cols, cell, lons[in_cell], lats[in_cell])
+            found = polygon >= 0
+            result[in_cell[found]] = self.codes[polygon[found]]
+        return result
+
+    def _find(self, row: int, cell: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the first polygon of the cell containing each
+        point, -1 if none does
+        """
+        found = np.full(len(x), -1, dtype=np.int64)
+        key = np.searchsorted(self.cell_keys, cell)
+        if key == len(self.cell_keys) or self.cell_keys[key] != cell:
+            return found
+        candidates = np.unique(
+            self.cell_polygons[
+                slice(self.cell_offsets[key], self.cell_offsets[key + 1])
+            ]
+        )
+        row_slice = slice(self.row_offsets[row], self.row_offsets[row + 1])
+        row_polygons = self.edge_polygons[row_slice]
+        low = np.searchsorted(row_polygons, candidates, side="left")
+        high = np.searchsorted(row_polygons, candidates, side="right")
+        has_edges = high > low
+        candidates, low, high = candidates[has_edges], low[has_edges], high[has_edges]
+        if len(candidates) == 0:
+            return found
+        edges = self.edges[row_slice][
+            np.concatenate([np.arange(a, b) for a, b in zip(low, high)])
+        ]
+        # Start of the edges of each candidate among those gathered
+        segments = np.cumsum(high - low) - (high - low)
+        x1, y1, x2, y2 = (edges[:, i] for i in range(4))
+
+        chunk = max(1, MAX_TEST_SIZE // len(edges))
+        for start in range(0, len(x), chunk):
+            points = slice(start, start + chunk)
+            px, py = x[points, None], y[points, None]
+            straddles = (y1 > py) != (y2 > py)
+            # Horizontal edges were dropped, so y1 != y2
+            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            crossings = np.add.reduceat(straddles & (px < x_cross), segments, axis=1)
+            inside = crossings % 2 == 1
+            found[points] = np.where(
+                inside.any(axis=1), candidates[inside.argmax(axis=1)], -1
+            )
+        return found
+
+    def get_codes(
+        self, coords: Sequence[Optional[Sequence[float]]]
+    ) -> List[Optional[dict]]:
+        """
+        Returns the {gaul_adm0, gaul_adm1, gaul_adm2} of every (lat, lon),
+        None for missing coordinates or points outside every polygon
+        """
+        lat = [np.nan if c is None else c[0] for c in coords]
+        lon = [np.nan if c is None else c[1] for c in coords]
+        return [
+            None if codes[2] < 0 else dict(zip(CODE_FIELDS, map(int, codes)))
+            for codes in self.lookup(lat, lon)
+        ]
+
+
+def get_cache_path(
+    path: Path, cell_size: float, cache_dir: Optional[Path] = None
+) -> Path:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    name = f"{path.stem}.{digest.hexdigest()[:16]}.{cell_size:g}.npz"
+    return (cache_dir or path.parent) / name
+
+
+def load_admin_index(
+    path: Path, cell_size: float = 0.1, cache_dir: Optional[Path] = None
+) -> AdminIndex:
+    """
+    Loads the index of a GeoJSON of GAUL polygons, building and caching it
+    on first use, or of an .npz cache
+    """
+    if path.suffix == ".npz":
+        return AdminIndex.load(path)
+    cache_path = get_cache_path(path, cell_size, cache_dir)
+    if cache_path.exists():
+        return AdminIndex.load(cache_path)
+    index = AdminIndex.build(*read_polygons(path), cell_size=cell_size)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    index.save(cache_path)
+    return index
+
+
+_admin_index: Optional[AdminIndex] = None
+
+
+def get_admin_index() -> Optional[AdminIndex]:
+    """
+    Returns the index of ADMIN_BOUNDARIES, loaded on first use, None if it
+    is not set. gs:// uris are downloaded to ADMIN_INDEX_CACHE (default the
+    temporary directory) once.
+    """
+    global _admin_index
+    if _admin_index is None and ADMIN_BOUNDARIES:
+        cache_dir = Path(ADMIN_INDEX_CACHE or tempfile.gettempdir())
+        path = Path(ADMIN_BOUNDARIES)
+        if ADMIN_BOUNDARIES.startswith("gs://"):
+            from inference_backends import get_blob_store
+
+            path = cache_dir / Path(ADMIN_BOUNDARIES).name
+            if not path.exists():
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+                tmp_path.write_bytes(get_blob_store().read(ADMIN_BOUNDARIES))
+                tmp_path.replace(path)
+        _admin_index = load_admin_index(path, cache_dir=cache_dir)
+    return _admin_index
+
+
+def get_admin_codes(coords: Sequence[Optional[Sequence[float]]]) -> List[dict]:
+    """
+    Returns the GAUL code fields of every (lat, lon) to store with it, no
+    fields without ADMIN_BOUNDARIES or outside every polygon
+    """
+    index = get_admin_index()
+    if index is None:
+        return [{} for _ in coords]
+    return [codes or {} for codes in index.get_codes(coords)]
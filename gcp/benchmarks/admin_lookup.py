@@ -0,0 +1,173 @@
+"""
+Checks the admin index against a per-point scan of every polygon, on a
+synthetic tiling shaped like GAUL level 2 (shared jagged borders, holes
+and islands), and times building, loading and looking up points with it.
+
+    python gcp/benchmarks/admin_lookup.py --polygons 38000 --points 1000000
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from admin_regions import load_admin_index, read_polygons  # noqa: E402
+
+# Kenya
+BOUNDS = (33.9, -4.7, 41.9, 5.0)
+
+
+def make_tiling(side: int, vertices_per_border: int, seed: int) -> dict:
+    """
+    Returns a GeoJSON FeatureCollection of side x side polygons tiling
+    BOUNDS, their borders shared with their neighbours and jagged with
+    vertices_per_border points. Every 25th polygon has a hole filled by an
+    island polygon.
+    """
+    rng = np.random.default_rng(seed)
+    west, south, east, north = BOUNDS
+    step_x, step_y = (east - west) / side, (north - south) / side
+    corners = np.stack(
+        np.meshgrid(
+            west + step_x * np.arange(side + 1),
+            south + step_y * np.arange(side + 1),
+            indexing="ij",
+        ),
+        axis=-1,
+    )
+    corners[1:-1, 1:-1] += rng.uniform(-0.3, 0.3, (side - 1, side - 1, 2)) * (
+        step_x,
+        step_y,
+    )
+
+    def border(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        t = np.linspace(0, 1, vertices_per_border + 2)[1:-1, None]
+        normal = np.array([a[1] - b[1], b[0] - a[0]])
+        jitter = rng.uniform(-0.05, 0.05, (vertices_per_border, 1))
+        return a + t * (b - a) + jitter * normal
+
+    # Each border is drawn once and reversed for the neighbour
+    horizontal = {
+        (i, j): border(corners[i, j], corners[i + 1, j])
+        for i in range(side)
+        for j in range(side + 1)
+    }
+    vertical = {
+        (i, j): border(corners[i, j], corners[i, j + 1])
+        for i in range(side + 1)
+        for j in range(side)
+    }
+
+    features = []
+    code = 0
+    for i in range(side):
+        for j in range(side):
+            ring = np.concatenate(
+                [
+                    corners[i, j][None],
+                    horizontal[i, j],
+                    corners[i + 1, j][None],
+                    vertical[i + 1, j],
+                    corners[i + 1, j + 1][None],
+                    horizontal[i, j + 1][::-1],
+                    corners[i, j + 1][None],
+                    vertical[i, j][::-1],
+                    corners[i, j][None],
+                ]
+            )
+            rings = [ring.tolist()]
+            if code % 25 == 0:
+                center = ring[:-1].mean(axis=0)
+                angles = np.linspace(0, 2 * np.pi, 9)
+                hole = center + 0.15 * np.stack(
+                    [step_x * np.cos(angles), step_y * np.sin(angles)], axis=1
+                )
+                rings.append(hole[::-1].tolist())
+                features.append(feature([hole.tolist()], code + 1_000_000))
+            features.append(feature(rings, code))
+            code += 1
+    return {"type": "FeatureCollection", "features": features}
+
+
+def feature(rings: List[list], code: int) -> dict:
+    return {
+        "type": "Feature",
+        "properties": {"ADM0_CODE": 133, "ADM1_CODE": code // 100, "ADM2_CODE": code},
+        "geometry": {"type": "Polygon", "coordinates": rings},
+    }
+
+
+def scan(rings: List[List[np.ndarray]], codes: np.ndarray, x: float, y: float):
+    """
+    The ADM2 code of the first polygon containing the point, testing every
+    polygon in turn, -1 if none does
+    """
+    for polygon, polygon_codes in zip(rings, codes):
+        crossings = 0
+        for ring in polygon:
+            x1, y1 = ring[:-1, 0], ring[:-1, 1]
+            x2, y2 = ring[1:, 0], ring[1:, 1]
+            straddles = (y1 > y) != (y2 > y)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            crossings += int(np.sum(straddles & (x < x_cross)))
+        if crossings % 2:
+            return polygon_codes[2]
+    return -1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--polygons", type=int, default=38000)
+    parser.add_argument("--vertices-per-border", type=int, default=20)
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--scanned-points", type=int, default=50)
+    parser.add_argument("--cell-size", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    side = int(np.sqrt(args.polygons))
+    rng = np.random.default_rng(args.seed)
+    west, south, east, north = BOUNDS
+    # Some points fall outside every polygon, or have no coordinates
+    lat = rng.uniform(south - 0.5, north + 0.5, args.points)
+    lon = rng.uniform(west - 0.5, east + 0.5, args.points)
+    lat[slice(0, None, 1000)] = np.nan
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "gaul_level2.geojson"
+        path.write_text(json.dumps(make_tiling(side, args.vertices_per_border, 0)))
+        rings, codes = read_polygons(path)
+        print(
+            f"{len(rings)} polygons, {sum(len(r) for p in rings for r in p)} vertices"
+        )
+
+        start = time.perf_counter()
+        load_admin_index(path, args.cell_size)
+        print(f"Built and cached the index in {time.perf_counter() - start:.2f} s")
+        start = time.perf_counter()
+        index = load_admin_index(path, args.cell_size)
+        print(f"Loaded the cached index in {time.perf_counter() - start:.3f} s")
+
+    start = time.perf_counter()
+    result = index.lookup(lat, lon)
+    seconds = time.perf_counter() - start
+    print(f"Index: {args.points / seconds:,.0f} points/s")
+
+    sample = rng.choice(np.flatnonzero(np.isfinite(lat)), args.scanned_points)
+    start = time.perf_counter()
+    expected = np.array([scan(rings, codes, lon[i], lat[i]) for i in sample])
+    seconds = time.perf_counter() - start
+    print(f"Per-point scan: {args.scanned_points / seconds:,.1f} points/s")
+
+    mismatches = int(np.sum(result[sample, 2] != expected))
+    print(f"Assigned: {np.mean(result[:, 2] >= 0):.1%}, mismatches: {mismatches}")
+    if np.any(result[np.isnan(lat)] != -1) or mismatches:
+        sys.exit("The index disagrees with the per-point scan")
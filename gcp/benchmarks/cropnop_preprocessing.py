@@ -0,0 +1,84 @@
+"""
+Compares the reduced-resolution cropnop preprocessing, and the cropnop view
+downscaled from the segmentation input by the fused handler, with the
+original full-resolution decode + resize, on a synthetic GoPro sized JPEG.
+
+    python gcp/benchmarks/cropnop_preprocessing.py --height 3000 --width 4000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2  # type: ignore
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from inference_preprocessing import (  # noqa: E402
+    read_cropnop_and_segmentation_input,
+    read_cropnop_input,
+)
+
+
+def synthetic_jpeg(height: int, width: int, seed: int = 0) -> bytes:
+    """
+    Smooth fields (sky, soil) with finer texture (leaves) on top,
+    roughly the frequency content of a roadside frame
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((height, width, 3), dtype=np.float32)
+    for cells, weight in [(4, 0.6), (32, 0.25), (256, 0.15)]:
+        noise = rng.random((cells, cells * width // height, 3), dtype=np.float32)
+        img += weight * cv2.resize(
+            noise, (width, height), interpolation=cv2.INTER_CUBIC
+        )
+    img = np.clip(img * 255, 0, 255).astype(np.uint8)
+    _, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buffer.tobytes()
+
+
+def original_cropnop_input(data: bytes) -> np.ndarray:
+    img = cv2.imdecode(
+        np.frombuffer(data, dtype=np.uint8),
+        cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+    )
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img = cv2.resize(img, (300, 300)) / 255
+    return img.transpose(2, 0, 1).astype("float32")
+
+
+def time_it(fn, data: bytes, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(data)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=0.02)
+    args = parser.parse_args()
+
+    data = synthetic_jpeg(args.height, args.width)
+    original = original_cropnop_input(data)
+    reduced, _ = read_cropnop_input(data)
+    diff = np.abs(original - reduced)
+    print(f"Mean absolute difference: {diff.mean():.5f}")
+    print(f"Max absolute difference: {diff.max():.5f}")
+    fused = read_cropnop_and_segmentation_input(data)[0]
+    fused_diff = np.abs(original - fused)
+    print(f"Fused mean absolute difference: {fused_diff.mean():.5f}")
+    print(f"Fused max absolute difference: {fused_diff.max():.5f}")
+
+    original_s = time_it(original_cropnop_input, data, args.repeats)
+    reduced_s = time_it(lambda d: read_cropnop_input(d)[0], data, args.repeats)
+    print(f"Original: {original_s * 1000:.1f} ms/image")
+    print(f"Reduced: {reduced_s * 1000:.1f} ms/image ({original_s / reduced_s:.1f}x)")
+
+    if max(diff.mean(), fused_diff.mean()) > args.tolerance:
+        sys.exit(f"Mean absolute difference above tolerance {args.tolerance}")
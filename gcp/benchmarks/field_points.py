@@ -0,0 +1,94 @@
+"""
+Checks that the array based field point extraction returns the same
+marks as the original per-pixel implementation and times both.
+
+    python gcp/benchmarks/field_points.py --batch-size 8 --seeds 50
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2  # type: ignore
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from inference_postprocessing import THRESHOLD, get_field_points  # noqa: E402
+
+
+def original_get_largest_contour(pred):
+    pred_mask = (pred > 0.5).astype(np.uint8)
+    contours, _ = cv2.findContours(pred_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return pred
+    max_contour = max(contours, key=lambda x: cv2.contourArea(x))
+    new_img = np.zeros(pred.shape)
+    cv2.fillPoly(new_img, pts=[max_contour], color=(1.0, 1.0, 1.0))
+    return new_img * pred
+
+
+def original_get_new_mark_pos(img):
+    x, y = np.where(img > THRESHOLD)
+    if len(x) == 0:
+        return np.unravel_index(np.argmax(img), img.shape)[::-1]
+    x_centr, y_centr = np.mean(x), np.mean(y)
+    med_val = np.median(img[x, y])
+    x_new, y_new = np.where(img >= med_val)
+    z = [i for i in zip(x_new, y_new)]
+    return min(z, key=lambda k: (x_centr - k[0]) ** 2 + (y_centr - k[1]) ** 2)
+
+
+def original_field_points(preds):
+    marks = []
+    for pred in preds:
+        y1, x1 = original_get_new_mark_pos(original_get_largest_contour(pred))
+        marks.append((x1, y1))
+    return np.array(marks)
+
+
+def synthetic_predictions(batch_size, size=512, seed=0):
+    """
+    Blurry field blobs of random size and position, a few of them
+    below the threshold everywhere
+    """
+    rng = np.random.default_rng(seed)
+    preds = np.zeros((batch_size, size, size), dtype=np.float32)
+    for pred in preds:
+        for _ in range(rng.integers(0, 4)):
+            center = tuple(int(c) for c in rng.integers(0, size, 2))
+            axes = tuple(int(a) for a in rng.integers(5, size // 3, 2))
+            cv2.ellipse(pred, center, axes, float(rng.random() * 180), 0, 360, 1.0, -1)
+        pred[:] = cv2.GaussianBlur(pred, (31, 31), 0)
+        pred *= rng.uniform(0.3, 1.0)
+        pred += rng.normal(0, 0.02, pred.shape).astype(np.float32)
+    return np.clip(preds, 0, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seeds", type=int, default=20)
+    args = parser.parse_args()
+
+    original_s, new_s, mismatches = 0.0, 0.0, 0
+    for seed in range(args.seeds):
+        preds = synthetic_predictions(args.batch_size, seed=seed)
+
+        start = time.perf_counter()
+        expected = original_field_points(preds)
+        original_s += time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, marks = get_field_points(preds)
+        new_s += time.perf_counter() - start
+
+        mismatches += int((expected != marks).any(axis=1).sum())
+
+    n = args.seeds * args.batch_size
+    print(f"Mismatched marks: {mismatches}/{n}")
+    print(f"Original: {original_s / n * 1000:.2f} ms/prediction")
+    print(f"New: {new_s / n * 1000:.2f} ms/prediction ({original_s / new_s:.1f}x)")
+    if mismatches:
+        sys.exit("Field points do not match the original implementation")
@@ -0,0 +1,115 @@
+"""
+Compares the shared float32 gamma correction kernel with the original
+float64 segmentation and satellite preprocessing, reporting the largest
+difference, time and peak traced memory per batch.
+
+    python gcp/benchmarks/gamma_correction.py --batch-size 4
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2  # type: ignore
+import numpy as np
+from skimage.transform import resize
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from inference_preprocessing import (  # noqa: E402
+    SEGMENTATION_SIZE,
+    gamma_correction,
+    to_model_input,
+)
+
+
+def original_gamma_correction(img):
+    img = img.astype(float)
+    img = (
+        255 * (img - np.min(img[:])) / (np.max(img[:]) - np.min(img[:]) + 0.1)
+    ).astype(float)
+    img = (img + 0.5) / 256
+    gamma = -1 / np.nanmean(np.log(img))
+    return img ** (gamma)
+
+
+def original_segmentation(imgs):
+    return np.stack(
+        [
+            original_gamma_correction(resize(img, SEGMENTATION_SIZE))
+            .transpose(2, 0, 1)
+            .astype("float32")
+            for img in imgs
+        ]
+    )
+
+
+def new_segmentation(imgs):
+    resized = [
+        cv2.resize(img, SEGMENTATION_SIZE, interpolation=cv2.INTER_AREA) for img in imgs
+    ]
+    return gamma_correction(to_model_input(resized, scale=1 / 255))
+
+
+def original_satellite(imgs):
+    return np.stack(
+        [
+            original_gamma_correction(img).transpose(2, 0, 1).astype("float32")
+            for img in imgs
+        ]
+    )
+
+
+def new_satellite(imgs):
+    return gamma_correction(to_model_input(imgs))
+
+
+def measure(fn, imgs, repeats):
+    tracemalloc.start()
+    fn(imgs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(imgs)
+    return (time.perf_counter() - start) / repeats, peak
+
+
+def compare(label, original_fn, new_fn, imgs, repeats):
+    diff = np.abs(original_fn(imgs) - new_fn(imgs))
+    print(f"{label}: max abs diff {diff.max():.2e}, mean abs diff {diff.mean():.2e}")
+    for name, fn in [("original", original_fn), ("new", new_fn)]:
+        seconds, peak = measure(fn, imgs, repeats)
+        print(f"  {name:<8} {seconds * 1000:8.1f} ms  peak {peak / 2**20:8.1f} MiB")
+    return diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = [
+        cv2.GaussianBlur(
+            rng.integers(0, 256, (1500, 2000, 3), dtype=np.uint8), (5, 5), 0
+        )
+        for _ in range(args.batch_size)
+    ]
+    tiles = [
+        rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)
+        for _ in range(args.batch_size)
+    ]
+
+    satellite_diff = compare(
+        "satellite", original_satellite, new_satellite, tiles, args.repeats
+    )
+    compare(
+        "segmentation", original_segmentation, new_segmentation, frames, args.repeats
+    )
+    # The satellite path only changes the kernel, so it must match closely
+    if satellite_diff.max() > 1e-4:
+        sys.exit("Satellite gamma correction does not match the original")
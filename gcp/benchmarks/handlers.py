@@ -0,0 +1,429 @@
+"""
+Times the preprocess, inference and postprocess stages of the cropnop,
+segmentation, satellite and fused handlers on synthetic images, with small
+stand-in TorchScript models and the in-memory blob and document stores.
+
+    python gcp/benchmarks/handlers.py --batch-sizes 1 4 8 --output results.json
+    python gcp/benchmarks/handlers.py --compare results.json
+
+Reports throughput, p50/p95/p99 latency and peak RSS of every stage per
+handler and batch size, along with the stages timed by the handlers
+themselves (download, decode, forward, db_write...). Results are saved as
+JSON with the commit they were measured on, and --compare prints the
+change against a previous run.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+# Before the handlers create their stores and the instrumentation registers its exit log
+os.environ["STREET2SAT_BACKEND"] = "memory"
+os.environ.setdefault("LOG_METRICS_AT_EXIT", "0")
+# Every iteration re-runs the same images, which the result cache would skip
+os.environ["RESULT_CACHE"] = "0"
+
+import cv2  # type: ignore # noqa: E402
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from cropnop_preprocessing import synthetic_jpeg  # noqa: E402
+from inference_backends import get_blob_store, get_document_store  # noqa: E402
+from inference_cropnop.handler import ModelHandler as CropnopHandler  # noqa: E402
+from inference_fused.handler import ModelHandler as FusedHandler  # noqa: E402
+from inference_postprocessing import CLASSES  # noqa: E402
+from inference_precision import (  # noqa: E402
+    INFERENCE_THREADS,
+    configure_threads,
+    prepare_model,
+)
+from inference_satellite.handler import BUCKET_IMGS_W_ARROW  # noqa: E402
+from inference_satellite.handler import ModelHandler as SatelliteHandler  # noqa: E402
+from inference_segmentation.handler import (  # noqa: E402
+    ModelHandler as SegmentationHandler,
+)
+from inference_utils import BatchErrors, get_name_from_uri  # noqa: E402
+from instrumentation import request_context  # noqa: E402
+
+COLLECTION = "street2sat-v2"
+UPLOAD_BUCKET = "street2sat-uploaded"
+CROPS_BUCKET = "street2sat-crops"
+# Window of get_satellite_img, 256 tile pixels upsampled twice
+SATELLITE_SIZE = 512
+STAGES = ("preprocess", "inference", "postprocess")
+
+
+class CropnopModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.features = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 16, 3, stride=2, padding=1),
+            torch.nn.ReLU(),
+            torch.nn.Conv2d(16, 32, 3, stride=2, padding=1),
+            torch.nn.ReLU(),
+            torch.nn.AdaptiveAvgPool2d(1),
+        )
+        self.classifier = torch.nn.Linear(32, 1)
+
+    def forward(self, x):
+        return self.classifier(self.features(x).flatten(1))
+
+
+class SegmentationModel(torch.nn.Module):
+    """
+    Full resolution per-class probabilities, like the segmentation model
+    """
+
+    def __init__(self, classes: int):
+        super().__init__()
+        self.encoder = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 16, 3, stride=2, padding=1),
+            torch.nn.ReLU(),
+            torch.nn.Conv2d(16, 32, 3, stride=2, padding=1),
+            torch.nn.ReLU(),
+        )
+        self.head = torch.nn.Conv2d(32, classes, 1)
+
+    def forward(self, x):
+        logits = self.head(self.encoder(x))
+        logits = torch.nn.functional.interpolate(
+            logits, size=x.shape[-2:], mode="bilinear", align_corners=False
+        )
+        return logits.softmax(dim=1)
+
+
+class SatelliteModel(SegmentationModel):
+    """
+    A single field probability channel, like the satellite model
+    """
+
+    def __init__(self):
+        super().__init__(classes=1)
+
+
+def to_torchscript(model: torch.nn.Module, size: int) -> torch.jit.ScriptModule:
+    torch.manual_seed(0)
+    model.eval()
+    with torch.no_grad():
+        return torch.jit.trace(model, torch.rand(1, 3, size, size))
+
+
+class Context:
+    """
+    The parts of the TorchServe context used by the handlers
+    """
+
+    def __init__(self):
+        self.statuses: Dict[int, int] = {}
+
+    def set_response_status(self, code=200, phrase="", idx=0):
+        self.statuses[idx] = code
+
+
+class RssSampler:
+    """
+    Samples the resident set size of the process on a background thread,
+    keeping the largest value seen since it was started
+    """
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = get_rss_bytes()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, get_rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss_bytes())
+
+
+def get_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux, only the peak over the whole run is available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def seed_cropnop(height: int, width: int, count: int) -> List[dict]:
+    blob_store = get_blob_store()
+    requests = []
+    for i in range(count):
+        uri = f"gs://{UPLOAD_BUCKET}/benchmark/frame_{i}.jpg"
+        blob_store.write(uri, synthetic_jpeg(height, width, seed=i))
+        requests.append({"uri": uri})
+    return requests
+
+
+def seed_segmentation(height: int, width: int, count: int) -> List[dict]:
+    blob_store, document_store = get_blob_store(), get_document_store()
+    requests = []
+    for i in range(count):
+        uri = f"gs://{CROPS_BUCKET}/benchmark/frame_{i}.jpg"
+        blob_store.write(uri, synthetic_jpeg(height, width, seed=i))
+        document_store.set(COLLECTION, get_name_from_uri(uri), {"input_img": uri})
+        requests.append({"uri": uri})
+    return requests
+
+
+def seed_satellite(count: int) -> List[dict]:
+    blob_store, document_store = get_blob_store(), get_document_store()
+    requests = []
+    for i in range(count):
+        tile_x, tile_y = 155000 + i, 125000
+        uri = f"gs://{BUCKET_IMGS_W_ARROW}/mapbox/{tile_x}/{tile_y}/18/frame_{i}.jpg"
+        tile = cv2.imdecode(
+            np.frombuffer(synthetic_jpeg(256, 256, seed=i), dtype=np.uint8),
+            cv2.IMREAD_COLOR,
+        )
+        img = cv2.resize(tile, (SATELLITE_SIZE, SATELLITE_SIZE))
+        _, buffer = cv2.imencode(".jpg", img)
+        metadata = {
+            "name": f"frame_{i}",
+            "window_x": str(tile_x * 256 - 128),
+            "window_y": str(tile_y * 256 - 128),
+        }
+        blob_store.write(uri, buffer.tobytes(), metadata=metadata)
+        document_store.set(COLLECTION, f"frame_{i}", {})
+        requests.append({"uri": uri})
+    return requests
+
+
+def run_handler(
+    kind: str,
+    handler,
+    requests: List[dict],
+    batch_size: int,
+    iterations: int,
+    warmup: int,
+) -> dict:
+    """
+    Runs the handler's stages on batches of batch_size requests, cycling
+    through requests, and summarizes the timed iterations
+    """
+    seconds: Dict[str, List[float]] = {stage: [] for stage in STAGES + ("batch",)}
+    peak_rss: Dict[str, int] = {stage: 0 for stage in STAGES + ("batch",)}
+    handler_stages: Dict[str, List[float]] = {}
+    # The handlers' logs would drown the results
+    devnull = open(os.devnull, "w")
+    for i in range(warmup + iterations):
+        start = i * batch_size
+        batch = [requests[(start + j) % len(requests)] for j in range(batch_size)]
+        handler.context = Context()
+        handler.errors = BatchErrors(batch, handler.context)
+        timings: Dict[str, float] = {}
+        rss: Dict[str, int] = {}
+        with contextlib.redirect_stdout(devnull), request_context(
+            kind, batch_size=batch_size
+        ) as request:
+            data = batch
+            for stage in STAGES:
+                fn: Callable = getattr(handler, stage)
+                with RssSampler() as sampler:
+                    stage_start = time.perf_counter()
+                    data = fn(data)
+                    timings[stage] = time.perf_counter() - stage_start
+                rss[stage] = sampler.peak
+        if i < warmup:
+            continue
+        for stage in STAGES:
+            seconds[stage].append(timings[stage])
+            peak_rss[stage] = max(peak_rss[stage], rss[stage])
+        seconds["batch"].append(sum(timings.values()))
+        peak_rss["batch"] = max(peak_rss["batch"], *rss.values())
+        for stage, value in request.stages.items():
+            handler_stages.setdefault(stage, []).append(value)
+    devnull.close()
+
+    return {
+        "stages": {
+            stage: summarize(values, batch_size, peak_rss[stage])
+            for stage, values in seconds.items()
+        },
+        "handler_stages": {
+            stage: summarize(values, batch_size)
+            for stage, values in sorted(handler_stages.items())
+        },
+    }
+
+
+def summarize(values: List[float], batch_size: int, peak_rss_bytes=None) -> dict:
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+    summary = {
+        "mean_s": float(np.mean(values)),
+        "p50_s": p50,
+        "p95_s": p95,
+        "p99_s": p99,
+        "images_per_s": batch_size / float(np.mean(values)),
+    }
+    if peak_rss_bytes is not None:
+        summary["peak_rss_bytes"] = peak_rss_bytes
+    return summary
+
+
+def get_environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "precision": os.environ.get("INFERENCE_PRECISION", "float32"),
+    }
+
+
+def compare(results: dict, previous: dict):
+    """
+    Prints the p50 latency and throughput change of every stage measured
+    in both runs
+    """
+    print(f"Compared with {previous['environment'].get('commit')}")
+    for kind, by_batch_size in results["handlers"].items():
+        for batch_size, result in by_batch_size.items():
+            before = previous["handlers"].get(kind, {}).get(batch_size)
+            if before is None:
+                continue
+            for stage, summary in result["stages"].items():
+                if stage not in before["stages"]:
+                    continue
+                p50_change = summary["p50_s"] / before["stages"][stage]["p50_s"] - 1
+                throughput_change = (
+                    summary["images_per_s"] / before["stages"][stage]["images_per_s"]
+                    - 1
+                )
+                print(
+                    f"  {kind} x{batch_size} {stage}: p50 {p50_change:+.1%}, "
+                    f"throughput {throughput_change:+.1%}"
+                )
+
+
+def print_results(results: dict):
+    for kind, by_batch_size in results["handlers"].items():
+        for batch_size, result in by_batch_size.items():
+            print(f"{kind}, batch size {batch_size}")
+            stages = {**result["stages"], **result["handler_stages"]}
+            for stage, summary in stages.items():
+                rss = summary.get("peak_rss_bytes")
+                rss_text = f", peak RSS {rss / 2**20:.0f} MiB" if rss else ""
+                print(
+                    f"  {stage:>12}: p50 {summary['p50_s'] * 1000:8.1f} ms, "
+                    f"p95 {summary['p95_s'] * 1000:8.1f} ms, "
+                    f"p99 {summary['p99_s'] * 1000:8.1f} ms, "
+                    f"{summary['images_per_s']:7.1f} images/s{rss_text}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--handlers",
+        nargs="+",
+        default=["cropnop", "segmentation", "satellite"],
+        choices=["cropnop", "segmentation", "satellite", "fused"],
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    # GoPro HERO frames
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--images", type=int, default=8, help="Distinct images")
+    parser.add_argument(
+        "--threads", default=INFERENCE_THREADS, help="torch intra-op threads"
+    )
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path, help="Results of a previous run")
+    args = parser.parse_args()
+
+    configure_threads(args.threads)
+
+    print("Creating synthetic images")
+    setups: Dict[str, Callable[[], tuple]] = {
+        "cropnop": lambda: (
+            CropnopHandler,
+            to_torchscript(CropnopModel(), 300),
+            seed_cropnop(args.height, args.width, args.images),
+        ),
+        "segmentation": lambda: (
+            SegmentationHandler,
+            to_torchscript(SegmentationModel(len(CLASSES)), 800),
+            seed_segmentation(args.height, args.width, args.images),
+        ),
+        "satellite": lambda: (
+            SatelliteHandler,
+            to_torchscript(SatelliteModel(), SATELLITE_SIZE),
+            seed_satellite(args.images),
+        ),
+        "fused": lambda: (
+            FusedHandler,
+            to_torchscript(CropnopModel(), 300),
+            seed_cropnop(args.height, args.width, args.images),
+        ),
+    }
+
+    results = {
+        "environment": get_environment(),
+        "arguments": {k: str(v) for k, v in vars(args).items()},
+        "handlers": {},
+    }
+    with torch.inference_mode():
+        for kind in args.handlers:
+            handler_class, model, requests = setups[kind]()
+            handler = handler_class()
+            # As in initialize, with INFERENCE_PRECISION
+            handler.model = prepare_model(model)
+            if kind == "fused":
+                handler.segmentation_model = prepare_model(
+                    to_torchscript(SegmentationModel(len(CLASSES)), 800)
+                )
+            results["handlers"][kind] = {}
+            for batch_size in args.batch_sizes:
+                print(f"Running {kind} with batch size {batch_size}")
+                results["handlers"][kind][str(batch_size)] = run_handler(
+                    kind, handler, requests, batch_size, args.iterations, args.warmup
+                )
+
+    print_results(results)
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+        print(f"Saved to {args.output}")
@@ -0,0 +1,99 @@
+"""
+Checks that the array based Web Mercator conversions return the same
+pixels, tiles, quadkeys and field coordinates as pygeotile and times both.
+
+    python gcp/benchmarks/mercator_conversions.py --points 100000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from pygeotile.tile import Point, Tile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import web_mercator  # noqa: E402
+from inference_postprocessing import get_field_coords  # noqa: E402
+
+ZOOM = 18
+
+
+def original_field_coord(path, pred_x, pred_y):
+    tms, *tile_xyz = path.split("/")
+    tile_x, tile_y, tile_z = (int(n) for n in tile_xyz[:3])
+    left_bottom_point, right_top_point = Tile.from_google(tile_x, tile_y, tile_z).bounds
+    x1, _ = left_bottom_point.pixels(zoom=tile_z)
+    _, y1 = right_top_point.pixels(zoom=tile_z)
+    point = Point.from_pixel(x1 + pred_x // 2, y1 + pred_y // 2, zoom=tile_z)
+    return point.latitude_longitude
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    # Street2sat photos are in Africa, a few points anywhere to cover the edges
+    lats = np.concatenate(
+        [rng.uniform(-35, 37, args.points - 100), rng.uniform(-85, 85, 100)]
+    )
+    lons = np.concatenate(
+        [rng.uniform(-18, 52, args.points - 100), rng.uniform(-180, 180, 100)]
+    )
+    marks = rng.integers(0, 512, (args.points, 2))
+
+    expected, original_s = timed(
+        lambda: [
+            (Point(lat, lon).pixels(ZOOM), Tile.for_latitude_longitude(lat, lon, ZOOM))
+            for lat, lon in zip(lats.tolist(), lons.tolist())
+        ]
+    )
+    (pixels, tiles), new_s = timed(
+        lambda: (
+            web_mercator.latlon_to_pixels(lats, lons, ZOOM),
+            web_mercator.latlon_to_tile(lats, lons, ZOOM),
+        )
+    )
+    expected_pixels = np.array([p for p, _ in expected])
+    expected_tiles = np.array([t.google for _, t in expected])
+    pixel_mismatches = int((np.stack(pixels, 1) != expected_pixels).any(1).sum())
+    tile_mismatches = int((np.stack(tiles, 1) != expected_tiles).any(1).sum())
+    print(f"lat/lon -> pixels, tile mismatches: {pixel_mismatches}, {tile_mismatches}")
+    print(f"  pygeotile: {original_s:.3f} s, numpy: {new_s:.3f} s")
+
+    expected_quadkeys, original_s = timed(lambda: [t.quad_tree for _, t in expected])
+    tile_x, tile_y = tiles
+    quadkeys, new_s = timed(lambda: web_mercator.tile_to_quadkey(tile_x, tile_y, ZOOM))
+    quadkey_mismatches = int((quadkeys != np.array(expected_quadkeys)).sum())
+    round_trip = web_mercator.quadkey_to_tile(quadkeys)
+    quadkey_mismatches += int(
+        (np.stack(round_trip[:2], 1) != expected_tiles).any(1).sum()
+    )
+    print(f"tile <-> quadkey mismatches: {quadkey_mismatches}")
+    print(f"  pygeotile: {original_s:.3f} s, numpy: {new_s:.3f} s")
+
+    paths = [f"mapbox/{x}/{y}/{ZOOM}/photo.jpg" for x, y in expected_tiles]
+    expected_coords, original_s = timed(
+        lambda: [
+            original_field_coord(path, x, y)
+            for path, (x, y) in zip(paths, marks.tolist())
+        ]
+    )
+    coords, new_s = timed(lambda: get_field_coords(paths, marks))
+    max_error = float(np.abs(coords - np.array(expected_coords)).max())
+    print(f"field coordinates max abs error: {max_error:.2e} degrees")
+    print(f"  pygeotile: {original_s:.3f} s, numpy: {new_s:.3f} s")
+
+    if pixel_mismatches or tile_mismatches or quadkey_mismatches or max_error > 1e-9:
+        sys.exit("Conversions do not match pygeotile")
@@ -0,0 +1,192 @@
+"""
+Checks the bfloat16 and int8 inference modes against float32 on the real
+models and times each of them.
+
+    python gcp/benchmarks/precision_agreement.py --model-dir model_weights \\
+        --images photos/ --satellite-images arrows/ --precisions bfloat16 int8
+
+For cropnop it reports how often is_crop agrees with float32. For
+segmentation it reports the largest change of any class fraction. For the
+satellite model it reports the distance between the field points, in
+upsampled satellite pixels. Without --images or --satellite-images,
+synthetic images are used. These time the models but say little about
+accuracy.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import cv2  # type: ignore
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from cropnop_preprocessing import synthetic_jpeg  # noqa: E402
+from inference_postprocessing import (  # noqa: E402
+    CLASSES,
+    get_field_points,
+    get_is_crop,
+    get_segmentation_results,
+)
+from inference_precision import (  # noqa: E402
+    PRECISIONS,
+    configure_threads,
+    prepare_model,
+    run_model,
+)
+from inference_preprocessing import (  # noqa: E402
+    gamma_correction,
+    read_cropnop_input,
+    read_segmentation_input,
+    to_model_input,
+)
+from inference_utils import decode_image  # noqa: E402
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+def load_buffers(images: Path, count: int) -> List[bytes]:
+    if images is None:
+        return [synthetic_jpeg(3000, 4000, seed=i) for i in range(count)]
+    paths = sorted(p for p in images.rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES)
+    return [p.read_bytes() for p in paths[:count]]
+
+
+def get_inputs(
+    buffers: List[bytes], satellite_buffers: List[bytes]
+) -> Dict[str, np.ndarray]:
+    """
+    The model input of every buffer, preprocessed as in the handlers
+    """
+    satellite_imgs = []
+    for data in satellite_buffers:
+        img = decode_image(data)
+        if img.shape[:2] != (512, 512):
+            img = cv2.resize(img, (512, 512), interpolation=cv2.INTER_AREA)
+        satellite_imgs.append(img)
+    return {
+        "cropnop": np.stack([read_cropnop_input(data)[0] for data in buffers]),
+        "segmentation": gamma_correction(
+            to_model_input(
+                [read_segmentation_input(data) for data in buffers], scale=1 / 255
+            )
+        ),
+        "satellite": gamma_correction(to_model_input(satellite_imgs)),
+    }
+
+
+def compare_cropnop(expected: np.ndarray, actual: np.ndarray) -> dict:
+    expected_is_crop = np.array(get_is_crop(expected))
+    actual_is_crop = np.array(get_is_crop(actual))
+    return {"is_crop_agreement": float((expected_is_crop == actual_is_crop).mean())}
+
+
+def compare_segmentation(expected: np.ndarray, actual: np.ndarray) -> dict:
+    deltas = np.array(
+        [
+            [
+                abs(
+                    get_segmentation_results(e)[crop]
+                    - get_segmentation_results(a)[crop]
+                )
+                for crop in CLASSES
+            ]
+            for e, a in zip(expected, actual)
+        ]
+    )
+    return {
+        "max_class_fraction_delta": float(deltas.max()),
+        "mean_class_fraction_delta": float(deltas.mean()),
+    }
+
+
+def compare_satellite(expected: np.ndarray, actual: np.ndarray) -> dict:
+    _, expected_marks = get_field_points(expected[:, 0])
+    _, actual_marks = get_field_points(actual[:, 0])
+    distances = np.linalg.norm(expected_marks - actual_marks, axis=1)
+    return {
+        "max_field_point_distance_px": float(distances.max()),
+        "mean_field_point_distance_px": float(distances.mean()),
+    }
+
+
+COMPARISONS: Dict[str, Callable[[np.ndarray, np.ndarray], dict]] = {
+    "cropnop": compare_cropnop,
+    "segmentation": compare_segmentation,
+    "satellite": compare_satellite,
+}
+
+
+def run(model, batch: np.ndarray, precision: str, batch_size: int):
+    """
+    Returns the outputs of every image and the seconds per batch
+    """
+    outputs, seconds = [], []
+    for start in range(0, len(batch), batch_size):
+        tensor = torch.from_numpy(batch[slice(start, start + batch_size)])
+        batch_start = time.perf_counter()
+        outputs.append(run_model(model, tensor, precision).numpy())
+        seconds.append(time.perf_counter() - batch_start)
+    return np.concatenate(outputs), float(np.median(seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", type=Path, default=Path("model_weights"))
+    parser.add_argument("--images", type=Path, help="Directory of sample photos")
+    parser.add_argument(
+        "--satellite-images", type=Path, help="Directory of satellite images"
+    )
+    parser.add_argument("--count", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument(
+        "--models", nargs="+", default=list(COMPARISONS), choices=list(COMPARISONS)
+    )
+    parser.add_argument(
+        "--precisions", nargs="+", default=["bfloat16", "int8"], choices=PRECISIONS
+    )
+    parser.add_argument("--threads")
+    parser.add_argument("--min-agreement", type=float, default=0.98)
+    parser.add_argument("--max-fraction-delta", type=float, default=0.01)
+    args = parser.parse_args()
+
+    configure_threads(args.threads)
+    inputs = get_inputs(
+        load_buffers(args.images, args.count),
+        load_buffers(args.satellite_images, args.count),
+    )
+    failures = []
+    for model_name in args.models:
+        path = args.model_dir / model_name / "best_model.torchscript.pt"
+        batch = inputs[model_name]
+        # Warm up, the first TorchScript calls profile and optimize the graph
+        reference = prepare_model(torch.jit.load(str(path), map_location="cpu"))
+        run(reference, batch[slice(0, args.batch_size)], "float32", args.batch_size)
+        expected, float32_s = run(reference, batch, "float32", args.batch_size)
+        print(f"{model_name} float32: {float32_s * 1000:.1f} ms/batch")
+
+        for precision in args.precisions:
+            model = prepare_model(
+                torch.jit.load(str(path), map_location="cpu"), precision
+            )
+            run(model, batch[slice(0, args.batch_size)], precision, args.batch_size)
+            actual, seconds = run(model, batch, precision, args.batch_size)
+            comparison = COMPARISONS[model_name](expected, actual)
+            print(
+                f"{model_name} {precision}: {seconds * 1000:.1f} ms/batch "
+                f"({float32_s / seconds:.2f}x), {comparison}"
+            )
+            if comparison.get("is_crop_agreement", 1.0) < args.min_agreement:
+                failures.append(f"{model_name} {precision}")
+            if (
+                comparison.get("max_class_fraction_delta", 0.0)
+                > args.max_fraction_delta
+            ):
+                failures.append(f"{model_name} {precision}")
+
+    if failures:
+        sys.exit(f"Outside tolerance: {', '.join(failures)}")
@@ -0,0 +1,252 @@
+"""
+Times the cold start of the handlers: each run is a new process which
+imports a handler, initializes it as TorchServe would and serves two
+single image requests.
+
+    python gcp/benchmarks/startup.py --handlers cropnop segmentation --runs 5
+    python gcp/benchmarks/startup.py --model-dir model_weights
+
+Every handler is started with its models as exported (INFERENCE_FREEZE=0,
+INFERENCE_WARM_UP=0), frozen, and frozen and warmed up (the default).
+Reports the median seconds spent importing, in each phase of initialize
+(load_model, quantize, freeze, warm_up), on the first and second request,
+and until the first response. Without --model-dir the small stand-in
+models of benchmarks/handlers.py are used, which say little about how
+long freezing and warming up the real models take.
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+# Read by the handlers when they are imported
+os.environ["STREET2SAT_BACKEND"] = "memory"
+os.environ.setdefault("LOG_METRICS_AT_EXIT", "0")
+os.environ["RESULT_CACHE"] = "0"
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+HANDLER_MODULES = {
+    "cropnop": "inference_cropnop.handler",
+    "segmentation": "inference_segmentation.handler",
+    "satellite": "inference_satellite.handler",
+    "fused": "inference_fused.handler",
+}
+# The serialized file of every handler, and the extra files packaged with it
+MODEL_FILES = {
+    "cropnop": {"model.pt": "cropnop"},
+    "segmentation": {"model.pt": "segmentation"},
+    "satellite": {"model.pt": "satellite"},
+    "fused": {"model.pt": "cropnop", "segmentation.torchscript.pt": "segmentation"},
+}
+MODES = {
+    "as exported": {"INFERENCE_FREEZE": "0", "INFERENCE_WARM_UP": "0"},
+    "frozen": {"INFERENCE_FREEZE": "1", "INFERENCE_WARM_UP": "0"},
+    "frozen, warmed up": {},
+}
+RESULTS = ("import", "initialize", "first_request", "second_request", "first_response")
+
+
+class ServingContext:
+    """
+    The parts of the TorchServe context read by BaseHandler.initialize
+    """
+
+    def __init__(self, model_dir: str):
+        self.system_properties = {"model_dir": model_dir, "gpu_id": None}
+        self.manifest = {"model": {"serializedFile": "model.pt"}}
+        self.model_yaml_config: dict = {}
+
+
+def measure(kind: str, model_dir: str, height: int, width: int) -> Dict[str, float]:
+    """
+    Starts the handler in this process, returning the seconds of every phase
+    """
+    start = time.perf_counter()
+    handler_class = importlib.import_module(HANDLER_MODULES[kind]).ModelHandler
+    import_s = time.perf_counter() - start
+
+    # Imports every handler, so only once the one measured is
+    from handlers import run_handler, seed_cropnop, seed_satellite, seed_segmentation
+    from instrumentation import metrics
+
+    seeds = {
+        "cropnop": lambda: seed_cropnop(height, width, 2),
+        "segmentation": lambda: seed_segmentation(height, width, 2),
+        "satellite": lambda: seed_satellite(2),
+        "fused": lambda: seed_cropnop(height, width, 2),
+    }
+    requests = seeds[kind]()
+
+    handler = handler_class()
+    start = time.perf_counter()
+    handler.initialize(ServingContext(model_dir))
+    seconds = {"import": import_s, "initialize": time.perf_counter() - start}
+    for histogram in metrics.to_json()["histograms"]:
+        if histogram["labels"].get("kind") == "startup":
+            seconds[histogram["labels"]["stage"]] = histogram["sum"]
+
+    for name, request in zip(("first_request", "second_request"), requests):
+        result = run_handler(kind, handler, [request], 1, 1, 0)
+        seconds[name] = result["stages"]["batch"]["p50_s"]
+    seconds["first_response"] = (
+        seconds["import"] + seconds["initialize"] + seconds["first_request"]
+    )
+    return seconds
+
+
+def write_models(model_dir: Path):
+    """
+    Saves the stand-in models of benchmarks/handlers.py as model_dir/<name>.pt
+    """
+    from handlers import (
+        SATELLITE_SIZE,
+        CropnopModel,
+        SatelliteModel,
+        SegmentationModel,
+        to_torchscript,
+    )
+    from inference_postprocessing import CLASSES
+
+    models = {
+        "cropnop": to_torchscript(CropnopModel(), 300),
+        "segmentation": to_torchscript(SegmentationModel(len(CLASSES)), 800),
+        "satellite": to_torchscript(SatelliteModel(), SATELLITE_SIZE),
+    }
+    for name, model in models.items():
+        model.save(str(model_dir / f"{name}.pt"))
+
+
+def get_model_dir(kind: str, models: Dict[str, Path], root: Path) -> Path:
+    """
+    Links the models of kind into root/kind under the names TorchServe gives them
+    """
+    model_dir = root / kind
+    model_dir.mkdir(exist_ok=True)
+    for file_name, name in MODEL_FILES[kind].items():
+        link = model_dir / file_name
+        if not link.exists():
+            link.symlink_to(models[name].resolve())
+    return model_dir
+
+
+def run_process(kind: str, model_dir: Path, mode: str, args) -> Dict[str, float]:
+    command = [
+        sys.executable,
+        __file__,
+        "--measure",
+        kind,
+        "--measure-model-dir",
+        str(model_dir),
+        "--height",
+        str(args.height),
+        "--width",
+        str(args.width),
+    ]
+    env = {**os.environ, **MODES[mode]}
+    start = time.perf_counter()
+    output = subprocess.run(
+        command, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    seconds = json.loads(output.strip().splitlines()[-1])
+    seconds["process"] = time.perf_counter() - start
+    return seconds
+
+
+def median(values: List[float]) -> float:
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--handlers",
+        nargs="+",
+        default=["cropnop", "segmentation", "satellite"],
+        choices=list(HANDLER_MODULES),
+    )
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--model-dir",
+        type=Path,
+        help="Directory of <model>/best_model.torchscript.pt, as model_weights",
+    )
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--output", type=Path)
+    # Used by the processes this starts
+    parser.add_argument(
+        "--measure", choices=list(HANDLER_MODULES), help=argparse.SUPPRESS
+    )
+    parser.add_argument("--measure-model-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # The handlers' logs would be mixed with the result
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            seconds = measure(
+                args.measure, args.measure_model_dir, args.height, args.width
+            )
+        print(json.dumps(seconds))
+        sys.exit()
+
+    from handlers import get_environment
+
+    results: dict = {
+        "environment": get_environment(),
+        "arguments": {k: str(v) for k, v in vars(args).items()},
+        "handlers": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        if args.model_dir is None:
+            print("Saving stand-in models")
+            write_models(root)
+            models = {
+                name: root / f"{name}.pt"
+                for name in ("cropnop", "segmentation", "satellite")
+            }
+        else:
+            models = {
+                name: args.model_dir / name / "best_model.torchscript.pt"
+                for name in ("cropnop", "segmentation", "satellite")
+            }
+
+        for kind in args.handlers:
+            model_dir = get_model_dir(kind, models, root)
+            results["handlers"][kind] = {}
+            for mode in args.modes:
+                runs = [
+                    run_process(kind, model_dir, mode, args) for _ in range(args.runs)
+                ]
+                summary = {
+                    name: median([run[name] for run in runs])
+                    for name in sorted(set().union(*runs))
+                }
+                results["handlers"][kind][mode] = summary
+                phases = ", ".join(
+                    f"{name} {summary[name]:.2f}"
+                    for name in ("load_model", "quantize", "freeze", "warm_up")
+                    if name in summary
+                )
+                print(
+                    f"{kind}, {mode}: "
+                    + ", ".join(f"{name} {summary[name]:.2f} s" for name in RESULTS)
+                    + f" ({phases}), process {summary['process']:.2f} s"
+                )
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
@@ -0,0 +1,143 @@
+"""
+Runs the trigger dispatcher against a local HTTP stand-in for an inference
+service which is slow, rejects requests over its capacity with 503,
+randomly throttles with 429 and answers some uris with an error the first
+time, and checks that every uri is processed, each once.
+
+    python gcp/benchmarks/trigger_dispatcher.py --uris 500 --capacity 2
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+os.environ.setdefault("LOG_METRICS_AT_EXIT", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "trigger_inference"))
+
+from dispatcher import Dispatcher, RetryQueue, wait_for  # noqa: E402
+
+
+class StandIn(ThreadingHTTPServer):
+    def __init__(
+        self, capacity: int, throttle: float, seconds_per_uri: float, failing: set
+    ):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.slots = threading.BoundedSemaphore(capacity)
+        self.throttle = throttle
+        self.seconds_per_uri = seconds_per_uri
+        # Answered with an error the first time, as an unreadable upload
+        self.failing = failing
+        self.failed: set = set()
+        self.processed: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/predictions/cropnop"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandIn
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if random.random() < self.server.throttle:
+            return self.reply(429, {"message": "throttled"}, retry_after="0.05")
+        if not self.server.slots.acquire(blocking=False):
+            return self.reply(503, {"message": "no capacity"})
+        try:
+            time.sleep(self.server.seconds_per_uri * len(body["uris"]))
+            resps = []
+            with self.server.lock:
+                for uri in body["uris"]:
+                    if uri in self.server.failing and uri not in self.server.failed:
+                        self.server.failed.add(uri)
+                        resps.append({"input_img": uri, "error": "not decodable"})
+                    else:
+                        self.server.processed[uri] += 1
+                        resps.append({"input_img": uri})
+            self.reply(200, resps)
+        finally:
+            self.server.slots.release()
+
+    def reply(self, status: int, body, retry_after=None):
+        with self.server.lock:
+            self.server.statuses[status] += 1
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if retry_after is not None:
+            self.send_header("Retry-After", retry_after)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uris", type=int, default=500)
+    parser.add_argument("--capacity", type=int, default=2)
+    parser.add_argument("--throttle", type=float, default=0.1)
+    parser.add_argument("--seconds-per-uri", type=float, default=0.002)
+    parser.add_argument("--failing", type=float, default=0.02)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    uris = [
+        f"gs://street2sat-uploaded/benchmark/frame_{i}.jpg" for i in range(args.uris)
+    ]
+    failing = set(random.sample(uris, int(args.failing * len(uris))))
+    server = StandIn(args.capacity, args.throttle, args.seconds_per_uri, failing)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        retry_queue = RetryQueue(str(Path(tmp) / "retries.sqlite"))
+        dispatcher = Dispatcher(
+            server.url,
+            retry_queue,
+            batch_size=args.batch_size,
+            max_in_flight=args.max_in_flight,
+            max_attempts=args.max_attempts,
+            backoff_base=0.05,
+            backoff_cap=0.5,
+            retry_queue_delay=0.1,
+        )
+        start = time.perf_counter()
+        counts = wait_for([dispatcher.submit(uri) for uri in uris])
+        print(f"First pass: {counts}, {len(retry_queue)} uris in the retry queue")
+        # As later invocations or the dispatcher CLI would
+        while len(retry_queue):
+            time.sleep(0.1)
+            dispatcher.retry_due()
+            dispatcher.flush()
+        dispatcher.close()
+        seconds = time.perf_counter() - start
+        retry_queue.close()
+    server.shutdown()
+
+    missing = set(uris) - set(server.processed)
+    repeated = sum(n > 1 for n in server.processed.values())
+    print(f"Responses: {dict(server.statuses)}")
+    print(f"{len(server.processed)}/{len(uris)} uris processed in {seconds:.2f} s")
+    print(f"Failed once: {len(server.failed)}, processed more than once: {repeated}")
+    if missing:
+        sys.exit(f"{len(missing)} uris were never processed")
+    if repeated:
+        sys.exit("Uris batched with a failed uri were sent again")
@@ -0,0 +1,284 @@
+"""
+Streams every image under an upload prefix through cropnop -> segmentation
+-> satellite in-process, instead of re-triggering each object through the
+Cloud Run services. Used to reprocess a season after a model update.
+
+    python gcp/bulk_inference.py gs://street2sat-uploaded/KENYA_v2 \\
+        --model-dir model_weights --output kenya_v2.jsonl --workers 4
+
+With --local-root, gs://<bucket>/<blob> is read from <local-root>/<bucket>/<blob>
+so the same run works offline against a copy of the buckets.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import threading
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import numpy as np
+import torch
+from inference_backends import (
+    BlobStore,
+    FirestoreDocumentStore,
+    GCSBlobStore,
+    LocalBlobStore,
+)
+from inference_postprocessing import (
+    get_field_coords,
+    get_field_points,
+    get_is_crop,
+    get_segmentation_results,
+    get_window_origin,
+)
+from inference_precision import (
+    INFERENCE_PRECISION,
+    PRECISIONS,
+    prepare_model,
+    run_model,
+)
+from inference_preprocessing import (
+    gamma_correction,
+    read_cropnop_input,
+    read_segmentation_input,
+    to_model_input,
+)
+from inference_utils import (
+    decode_image,
+    download_bytes,
+    get_name_from_uri,
+    run_concurrently,
+)
+from instrumentation import request_context
+from web_mercator import latlon_to_tile
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+MODELS = ["cropnop", "segmentation", "satellite"]
+BUCKET_IMGS_W_ARROW = "street2sat-satellite-imgs-with-arrow"
+ZOOM = 18
+
+
+def get_blob_store(local_root: Optional[str]) -> BlobStore:
+    return GCSBlobStore() if local_root is None else LocalBlobStore(local_root)
+
+
+def list_images(blob_store: BlobStore, source: str) -> Iterator[str]:
+    """
+    Yields the gs:// uri of every image under source, a gs://<bucket>/<prefix>
+    """
+    for uri in blob_store.list(source):
+        if Path(uri).suffix.lower() in IMAGE_SUFFIXES:
+            yield uri
+
+
+class Pipeline:
+    """
+    The three models loaded once per worker process, applied to a batch of uris
+    """
+
+    def __init__(self, model_dir: str, args):
+        self.args = args
+        self.blob_store = get_blob_store(args.local_root)
+        self.models = {
+            model: prepare_model(
+                torch.jit.load(
+                    str(Path(model_dir, model, "best_model.torchscript.pt")),
+                    map_location="cpu",
+                ),
+                args.precision,
+            )
+            for model in MODELS
+        }
+
+    def run(self, model: str, batch: np.ndarray) -> np.ndarray:
+        return run_model(
+            self.models[model], torch.from_numpy(batch), self.args.precision
+        ).numpy()
+
+    def read(self, uri: str, retries: int = 3) -> bytes:
+        return download_bytes(self.blob_store, uri, retries=retries)
+
+    def read_cropnop(self, uri: str):
+        data = self.read(uri)
+        return data, read_cropnop_input(data)
+
+    def __call__(self, uris: List[str]) -> List[dict]:
+        """
+        Returns one record per uri. A uri which cannot be read only fails
+        its own record, {"input_img": ..., "error": ...}
+        """
+        fetched = run_concurrently(self.read_cropnop, uris, return_exceptions=True)
+        records: List[dict] = [
+            (
+                {"input_img": uri, "error": str(item)}
+                if isinstance(item, Exception)
+                else {"input_img": uri, "name": get_name_from_uri(uri)}
+            )
+            for uri, item in zip(uris, fetched)
+        ]
+        read = [i for i, record in enumerate(records) if "error" not in record]
+        if not read:
+            return records
+        batch = np.stack([fetched[i][1][0] for i in read])
+        is_crops = get_is_crop(self.run("cropnop", batch))
+        for i, is_crop in zip(read, is_crops):
+            img_tags = fetched[i][1][1]
+            records[i].update({"is_crop": is_crop, **img_tags, "results": None})
+
+        crops = [i for i, is_crop in zip(read, is_crops) if is_crop]
+        imgs = run_concurrently(
+            read_segmentation_input,
+            [fetched[i][0] for i in crops],
+            return_exceptions=True,
+        )
+        for i, img in zip(crops, imgs):
+            if isinstance(img, Exception):
+                records[i] = {"input_img": uris[i], "error": str(img)}
+        crops = [i for i, img in zip(crops, imgs) if not isinstance(img, Exception)]
+        imgs = [img for img in imgs if not isinstance(img, Exception)]
+        if crops:
+            batch = gamma_correction(to_model_input(imgs, scale=1 / 255))
+            outputs = self.run("segmentation", batch)
+            for i, output in zip(crops, outputs):
+                records[i]["results"] = get_segmentation_results(output)
+
+        self.add_field_coords([records[i] for i in crops])
+        return records
+
+    def add_field_coords(self, records: List[dict]):
+        """
+        Runs the satellite model on the arrow images which already exist
+        for the records, <tms>/<x>/<y>/<z>/<name>.jpg
+        """
+        records = [record for record in records if "coord" in record]
+        if not records:
+            return
+        lats, lons = np.array([record["coord"] for record in records]).T
+        tiles_x, tiles_y = latlon_to_tile(lats, lons, ZOOM)
+
+        paths, imgs, owners, origins = [], [], [], []
+        for record, tile_x, tile_y in zip(records, tiles_x, tiles_y):
+            for tms in self.args.tms:
+                path = f"{tms}/{tile_x}/{tile_y}/{ZOOM}/{record['name']}.jpg"
+                uri = f"gs://{BUCKET_IMGS_W_ARROW}/{path}"
+                try:
+                    data = self.read(uri, retries=0)
+                    origin = get_window_origin(self.blob_store.metadata(uri))
+                except (FileNotFoundError, ValueError):
+                    continue
+                paths.append(path)
+                origins.append(origin)
+                imgs.append(decode_image(data)[0:512, 0:512])
+                owners.append(record)
+        if not paths:
+            return
+        batch = gamma_correction(to_model_input(imgs))
+        preds = self.run("satellite", batch)[:, 0]
+        _, marks = get_field_points(preds)
+        coords = get_field_coords(paths, marks, origins).tolist()
+        for path, (lat, lon), record in zip(paths, coords, owners):
+            tms = path.split("/")[0]
+            record[f"{tms}_img_source"] = f"gs://{BUCKET_IMGS_W_ARROW}/{path}"
+            record[f"{tms}_field_coord"] = (lat, lon)
+            record[f"{tms}_field_coord_lat"] = lat
+            record[f"{tms}_field_coord_lon"] = lon
+
+
+def worker(args, tasks: mp.Queue, results: mp.Queue):
+    torch.set_num_threads(args.threads_per_worker)
+    pipeline = Pipeline(args.model_dir, args)
+    while True:
+        uris = tasks.get()
+        if uris is None:
+            results.put(None)
+            return
+        try:
+            with request_context("bulk", batch_size=len(uris)):
+                records = pipeline(uris)
+            results.put(records)
+        except Exception as e:
+            # Unreadable images are already isolated in their records, this
+            # is a failure of the whole batch such as the model itself
+            print(f"BULK ERROR: batch starting {uris[0]} failed: {e}")
+            results.put([{"input_img": uri, "error": str(e)} for uri in uris])
+
+
+def produce(args, tasks: mp.Queue):
+    batch: List[str] = []
+    for uri in list_images(get_blob_store(args.local_root), args.source):
+        batch.append(uri)
+        if len(batch) == args.batch_size:
+            tasks.put(batch)
+            batch = []
+    if batch:
+        tasks.put(batch)
+    for _ in range(args.workers):
+        tasks.put(None)
+
+
+def main(args):
+    ctx = mp.get_context("spawn")
+    # Bounded so listing a huge prefix never runs far ahead of the workers
+    tasks = ctx.Queue(maxsize=args.queue_size)
+    results = ctx.Queue(maxsize=args.queue_size)
+    workers = [
+        ctx.Process(target=worker, args=(args, tasks, results))
+        for _ in range(args.workers)
+    ]
+    for p in workers:
+        p.start()
+    producer = threading.Thread(target=produce, args=(args, tasks), daemon=True)
+    producer.start()
+
+    sink = None
+    if args.firestore:
+        from inference_sink import WriteBehindSink
+
+        sink = WriteBehindSink(
+            FirestoreDocumentStore(), get_blob_store(args.local_root)
+        )
+
+    done, processed = 0, 0
+    with open(args.output, "w") as f:
+        while done < len(workers):
+            records = results.get()
+            if records is None:
+                done += 1
+                continue
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+                # Merged, so fields the pipeline does not produce, such as
+                # segmentation_labels and the admin codes, are kept
+                if sink is not None and "error" not in record:
+                    sink.merge("street2sat-v2", record["name"], record)
+            processed += len(records)
+            print(f"BULK: {processed} images processed")
+
+    if sink is not None:
+        sink.close()
+    for p in workers:
+        p.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="gs://<bucket>/<prefix> of uploaded images")
+    parser.add_argument("--local-root", help="Directory standing in for GCS")
+    parser.add_argument("--model-dir", default="model_weights")
+    parser.add_argument("--output", default="bulk_inference.jsonl")
+    parser.add_argument(
+        "--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2)
+    )
+    parser.add_argument("--threads-per-worker", type=int, default=2)
+    parser.add_argument("--precision", choices=PRECISIONS, default=INFERENCE_PRECISION)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--tms", nargs="*", default=["mapbox", "bing"])
+    parser.add_argument(
+        "--firestore",
+        action="store_true",
+        help="Also write each record to the street2sat-v2 collection",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,408 @@
+"""
+Exports the street2sat-v2 collection as typed columns, for analysis and
+map products.
+
+    python gcp/export_predictions.py --output-dir exports --format parquet
+    python gcp/export_predictions.py --output-dir exports --incremental
+
+The collection is split into --partitions name ranges read concurrently,
+--page-size documents per request. Every document becomes one row: results
+is flattened to a column per class, coord to lat and lon, and the
+{tms}_field_coord of every --tms to {tms}_field_coord_lat and _lon.
+Fields outside get_schema() are left out. With --admin-boundaries (default
+ADMIN_BOUNDARIES), the GAUL codes of documents written before the handlers
+assigned them are looked up from lat and lon. Rows are written --chunk-size at
+a time, as Parquet row groups, Arrow record batches or GeoJSON features,
+so memory does not grow with the collection.
+
+Each export writes <output-dir>/<collection>-<start time>.<format> and,
+once complete, records its start time in <collection>.checkpoint.json.
+--incremental then only exports the documents updated since, which
+inference_backends stamps on every write. Deleted documents are not
+reported.
+"""
+
+import argparse
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from admin_regions import ADMIN_BOUNDARIES, CODE_FIELDS, AdminIndex, load_admin_index
+from inference_backends import UPDATED_FIELD, DocumentStore, get_document_store
+from inference_postprocessing import CLASSES
+
+COLLECTION = "street2sat-v2"
+TMS = ("mapbox", "bing")
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "geojson": ".geojson"}
+
+
+def get_schema(tms: Tuple[str, ...] = TMS) -> List[Tuple[str, str]]:
+    """
+    Returns the (column, type) of every exported column, type one of
+    string, bool, int64, float64 or timestamp (UTC)
+    """
+    columns = [
+        ("name", "string"),
+        ("input_img", "string"),
+        ("is_crop", "bool"),
+        ("time", "timestamp"),
+        ("lat", "float64"),
+        ("lon", "float64"),
+        ("focal_length", "float64"),
+        ("pixel_height", "int64"),
+        ("segmentation_labels", "string"),
+    ]
+    columns += [(field, "int64") for field in CODE_FIELDS]
+    columns += [(crop, "float64") for crop in CLASSES]
+    for server in tms:
+        columns += [
+            (f"{server}_img_source", "string"),
+            (f"{server}_img_segmentation", "string"),
+            (f"{server}_field_coord_lat", "float64"),
+            (f"{server}_field_coord_lon", "float64"),
+        ]
+    columns.append((UPDATED_FIELD, "timestamp"))
+    return columns
+
+
+def _to_timestamp(value) -> Optional[datetime]:
+    """
+    Datetimes are UTC, naive ones (EXIF times) included
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):  # The local backend's ISO 8601 strings
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _to_lat_lon(value) -> Tuple[Optional[float], Optional[float]]:
+    if value is None:
+        return None, None
+    if hasattr(value, "latitude"):  # A Firestore GeoPoint
+        return value.latitude, value.longitude
+    return value[0], value[1]
+
+
+CONVERTERS = {
+    "string": lambda value: None if value is None else str(value),
+    "bool": lambda value: None if value is None else bool(value),
+    "int64": lambda value: None if value is None else int(value),
+    "float64": lambda value: None if value is None else float(value),
+    "timestamp": _to_timestamp,
+}
+
+
+def flatten(
+    name: str, doc: dict, schema: List[Tuple[str, str]], tms: Tuple[str, ...] = TMS
+) -> dict:
+    """
+    Returns the row of the document, with a value for every column of schema
+    """
+    row = {**doc, "name": name}
+    row["lat"], row["lon"] = _to_lat_lon(doc.get("coord"))
+    row.update(doc.get("results") or {})
+    for server in tms:
+        lat, lon = _to_lat_lon(doc.get(f"{server}_field_coord"))
+        row.setdefault(f"{server}_field_coord_lat", lat)
+        row.setdefault(f"{server}_field_coord_lon", lon)
+    return {column: CONVERTERS[kind](row.get(column)) for column, kind in schema}
+
+
+class ArrowWriter:
+    """
+    Writes chunks of rows as the row groups of a Parquet file or the record
+    batches of an Arrow IPC file
+    """
+
+    def __init__(self, path: Path, schema: List[Tuple[str, str]], fmt: str):
+        import pyarrow as pa  # type: ignore
+
+        types = {
+            "string": pa.string(),
+            "bool": pa.bool_(),
+            "int64": pa.int64(),
+            "float64": pa.float64(),
+            "timestamp": pa.timestamp("us", tz="UTC"),
+        }
+        self.schema = pa.schema([(column, types[kind]) for column, kind in schema])
+        if fmt == "parquet":
+            import pyarrow.parquet as pq  # type: ignore
+
+            self.writer = pq.ParquetWriter(str(path), self.schema)
+        else:
+            self.writer = pa.ipc.new_file(str(path), self.schema)
+
+    def write(self, rows: List[dict]):
+        import pyarrow as pa  # type: ignore
+
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class GeoJSONWriter:
+    """
+    Writes rows as the Point features of a FeatureCollection, located at
+    geometry (lat and lon, or a {tms}_field_coord), one per line
+    """
+
+    def __init__(self, path: Path, geometry: str = "coord"):
+        self.file = open(path, "w")
+        self.lat, self.lon = (
+            ("lat", "lon")
+            if geometry == "coord"
+            else (f"{geometry}_lat", f"{geometry}_lon")
+        )
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.first = True
+
+    def write(self, rows: List[dict]):
+        for row in rows:
+            point = None
+            if row[self.lat] is not None and row[self.lon] is not None:
+                point = {"type": "Point", "coordinates": [row[self.lon], row[self.lat]]}
+            properties = {
+                column: value.isoformat() if isinstance(value, datetime) else value
+                for column, value in row.items()
+                if value is not None
+            }
+            feature = {"type": "Feature", "properties": properties, "geometry": point}
+            self.file.write(("" if self.first else ",\n") + json.dumps(feature))
+            self.first = False
+
+    def close(self):
+        self.file.write("\n]}\n")
+        self.file.close()
+
+
+def fill_admin_codes(rows: List[dict], admin_index: AdminIndex):
+    """
+    Looks up the GAUL codes of the rows without them, in place
+    """
+    missing = [row for row in rows if row[CODE_FIELDS[2]] is None]
+    if not missing:
+        return
+    lat = [np.nan if row["lat"] is None else row["lat"] for row in missing]
+    lon = [np.nan if row["lon"] is None else row["lon"] for row in missing]
+    for row, codes in zip(missing, admin_index.lookup(lat, lon)):
+        if codes[2] >= 0:
+            row.update(zip(CODE_FIELDS, map(int, codes)))
+
+
+def get_ranges(
+    store: DocumentStore, collection: str, partitions: int
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Returns the [start, end) name ranges partitioning the collection, None
+    meaning unbounded
+    """
+    points: List[Optional[str]] = list(store.get_split_points(collection, partitions))
+    return list(zip([None] + points, points + [None]))
+
+
+def read_chunks(
+    store: DocumentStore,
+    collection: str,
+    chunk_size: int,
+    page_size: int,
+    schema: List[Tuple[str, str]],
+    tms: Tuple[str, ...],
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    updated_after: Optional[datetime] = None,
+    admin_index: Optional[AdminIndex] = None,
+) -> Iterator[List[dict]]:
+    """
+    Yields the rows of the documents streamed, chunk_size at a time
+    """
+    rows = []
+    docs = store.stream(collection, start, end, updated_after, page_size)
+    for name, doc in docs:
+        rows.append(flatten(name, doc, schema, tms))
+        if len(rows) == chunk_size:
+            if admin_index is not None:
+                fill_admin_codes(rows, admin_index)
+            yield rows
+            rows = []
+    if rows:
+        if admin_index is not None:
+            fill_admin_codes(rows, admin_index)
+        yield rows
+
+
+def export(
+    store: DocumentStore,
+    collection: str,
+    path: Path,
+    fmt: str = "parquet",
+    partitions: int = 8,
+    page_size: int = 500,
+    chunk_size: int = 5000,
+    updated_after: Optional[datetime] = None,
+    tms: Tuple[str, ...] = TMS,
+    geometry: str = "coord",
+    admin_index: Optional[AdminIndex] = None,
+) -> int:
+    """
+    Writes the documents of collection (all of them, or those updated after
+    updated_after) to path and returns how many. Partitions are read on
+    threads, their chunks handed to the writer through a queue holding at
+    most two per partition.
+    """
+    schema = get_schema(tms)
+    if updated_after is None:
+        ranges = get_ranges(store, collection, partitions)
+    else:
+        # Updates since a checkpoint are few, and ordered by time not name
+        ranges = [(None, None)]
+    writer = (
+        GeoJSONWriter(path, geometry)
+        if fmt == "geojson"
+        else ArrowWriter(path, schema, fmt)
+    )
+
+    chunks: "queue.Queue[Optional[List[dict]]]" = queue.Queue(2 * len(ranges))
+    failed = threading.Event()
+
+    def read(start: Optional[str], end: Optional[str]):
+        try:
+            for chunk in read_chunks(
+                store,
+                collection,
+                chunk_size,
+                page_size,
+                schema,
+                tms,
+                start,
+                end,
+                updated_after,
+                admin_index,
+            ):
+                while not failed.is_set():
+                    try:
+                        chunks.put(chunk, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+        finally:
+            chunks.put(None)
+
+    exported = 0
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(read, start, end) for start, end in ranges]
+        try:
+            done = 0
+            while done < len(ranges):
+                chunk = chunks.get()
+                if chunk is None:
+                    done += 1
+                    continue
+                writer.write(chunk)
+                exported += len(chunk)
+                print(f"EXPORT: {exported} documents")
+        except BaseException:
+            # Unblocks the readers waiting on a full queue
+            failed.set()
+            while any(not future.done() for future in futures):
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        finally:
+            writer.close()
+        for future in futures:
+            future.result()
+    return exported
+
+
+def read_checkpoint(path: Path) -> Optional[datetime]:
+    if not path.exists():
+        return None
+    return datetime.fromisoformat(json.loads(path.read_text())["updated_after"])
+
+
+def write_checkpoint(path: Path, started: datetime, output: Path):
+    checkpoint = json.loads(path.read_text()) if path.exists() else {"exports": []}
+    checkpoint["updated_after"] = started.isoformat()
+    checkpoint["exports"].append(output.name)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(checkpoint, indent=2))
+    tmp_path.replace(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--collection", default=COLLECTION)
+    parser.add_argument("--output-dir", type=Path, default=Path("exports"))
+    parser.add_argument("--format", choices=list(FORMATS), default="parquet")
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only export the documents updated since the last checkpoint",
+    )
+    parser.add_argument(
+        "--since", type=datetime.fromisoformat, help="Export documents updated after"
+    )
+    parser.add_argument("--tms", nargs="+", default=list(TMS))
+    parser.add_argument(
+        "--geometry",
+        default="coord",
+        help="Location of GeoJSON features, coord or <tms>_field_coord",
+    )
+    parser.add_argument(
+        "--admin-boundaries",
+        type=Path,
+        default=ADMIN_BOUNDARIES,
+        help="GeoJSON or .npz of GAUL polygons, to fill the codes of older documents",
+    )
+    args = parser.parse_args()
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = args.output_dir / f"{args.collection}.checkpoint.json"
+    updated_after = args.since
+    if updated_after is None and args.incremental:
+        updated_after = read_checkpoint(checkpoint_path)
+    if updated_after is not None:
+        updated_after = updated_after.replace(
+            tzinfo=updated_after.tzinfo or timezone.utc
+        )
+        print(f"EXPORT: Documents updated after {updated_after.isoformat()}")
+
+    admin_index = None
+    if args.admin_boundaries is not None:
+        admin_index = load_admin_index(args.admin_boundaries)
+
+    # Writes committed before this are seen by every read of the export
+    started = datetime.now(timezone.utc)
+    name = f"{args.collection}-{started.strftime('%Y%m%dT%H%M%SZ')}"
+    output = args.output_dir / (name + FORMATS[args.format])
+    tmp_output = output.with_name(f".{output.name}")
+    count = export(
+        get_document_store(),
+        args.collection,
+        tmp_output,
+        args.format,
+        args.partitions,
+        args.page_size,
+        args.chunk_size,
+        updated_after,
+        tuple(args.tms),
+        args.geometry,
+        admin_index,
+    )
+    tmp_output.replace(output)
+    write_checkpoint(checkpoint_path, started, output)
+    print(f"EXPORT: {count} documents written to {output}")
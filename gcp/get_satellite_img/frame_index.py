@@ -0,0 +1,261 @@
+"""
+In-memory index of street2sat-v2 frames for direction and neighbor lookups
+without querying Firestore per frame.
+
+Frames are kept sorted by time per tile, so the nearest prior/next frame on
+a tile is a bisect, and radius queries only look at the tiles covering the
+circle. Exports are JSONL with one {"name", "time", "coord"} per line:
+
+    python frame_index.py --output frames.jsonl
+"""
+
+import argparse
+import json
+import math
+import sys
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from web_mercator import latlon_to_tile  # noqa: E402
+
+EARTH_RADIUS_M = 6378137.0
+# Sorts after every name, so (time, LAST_NAME) is after every frame at time
+LAST_NAME = "\U0010ffff"
+
+
+class Frame(NamedTuple):
+    time: float  # seconds since epoch
+    lat: float
+    lon: float
+    tile: Tuple[int, int]
+    name: str
+
+
+def to_timestamp(time) -> float:
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+def get_tile(lat: float, lon: float, zoom: int) -> Tuple[int, int]:
+    tile_x, tile_y = latlon_to_tile(lat, lon, zoom)
+    return int(tile_x), int(tile_y)
+
+
+def haversine(lat1, lon1, lat2, lon2) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class FrameIndex:
+    """
+    Frames by tile, each tile a time sorted list of (time, name) with the
+    frames themselves in a dict by name. Adding or replacing a frame is a
+    bisect and a list insert, lookups are O(log n) in the frames of a tile.
+
+    The time ranges loaded in full from the collection are recorded with
+    mark_loaded, oldest first, so a frame which only arrived as the neighbor
+    of another is not taken to have its own neighbors in the index. evict
+    drops the frames of the oldest ranges to bound the index.
+    """
+
+    def __init__(self, zoom: int = 18):
+        self.zoom = zoom
+        self.frames: Dict[str, Frame] = {}
+        self._tiles: Dict[Tuple[int, int], List[Tuple[float, str]]] = {}
+        self._times: List[Tuple[float, str]] = []
+        self._loaded: List[Tuple[float, float]] = []
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, name: str):
+        return name in self.frames
+
+    def add(self, name: str, time, coord) -> Frame:
+        """
+        Adds or replaces a frame, time is a datetime or ISO 8601 string
+        """
+        lat, lon = coord
+        return self._insert(
+            Frame(to_timestamp(time), lat, lon, get_tile(lat, lon, self.zoom), name)
+        )
+
+    def add_docs(self, docs: Iterable[dict]):
+        """
+        Adds every doc with a time and coord, with the tiles of all of them
+        computed at once
+        """
+        docs = [doc for doc in docs if "coord" in doc and "time" in doc]
+        if not docs:
+            return
+        lats, lons = np.array([doc["coord"] for doc in docs], dtype=np.float64).T
+        tiles_x, tiles_y = latlon_to_tile(lats, lons, self.zoom)
+        for doc, lat, lon, tile_x, tile_y in zip(
+            docs, lats.tolist(), lons.tolist(), tiles_x.tolist(), tiles_y.tolist()
+        ):
+            time = to_timestamp(doc["time"])
+            self._insert(Frame(time, lat, lon, (tile_x, tile_y), doc["name"]))
+
+    def _insert(self, frame: Frame) -> Frame:
+        if frame.name in self.frames:
+            self.remove(frame.name)
+        self.frames[frame.name] = frame
+        insort(self._tiles.setdefault(frame.tile, []), (frame.time, frame.name))
+        insort(self._times, (frame.time, frame.name))
+        return frame
+
+    def remove(self, name: str):
+        frame = self.frames.pop(name)
+        entries = self._tiles[frame.tile]
+        del entries[bisect_left(entries, (frame.time, name))]
+        del self._times[bisect_left(self._times, (frame.time, name))]
+
+    def mark_loaded(self, start_time, end_time):
+        """
+        Records that every frame with start_time <= time <= end_time
+        (datetimes or ISO 8601 strings) has been added
+        """
+        self._loaded.append((to_timestamp(start_time), to_timestamp(end_time)))
+
+    def is_loaded(self, start_time, end_time) -> bool:
+        """
+        Whether every frame with start_time <= time <= end_time is in the index
+        """
+        start, end = to_timestamp(start_time), to_timestamp(end_time)
+        return any(lo <= start and end <= hi for lo, hi in self._loaded)
+
+    def evict(self, max_frames: int):
+        """
+        Forgets the oldest loaded time ranges, and their frames not in a
+        later range, until at most max_frames remain. The latest range is
+        always kept, so are frames added outside of any range.
+        """
+        while len(self.frames) > max_frames and len(self._loaded) > 1:
+            start, end = self._loaded.pop(0)
+            i, j = bisect_left(self._times, (start, "")), bisect_right(
+                self._times, (end, LAST_NAME)
+            )
+            for time, name in self._times[i:j]:
+                if not any(lo <= time <= hi for lo, hi in self._loaded):
+                    self.remove(name)
+
+    def previous(
+        self, name: str, max_seconds: Optional[float] = None
+    ) -> Optional[Frame]:
+        """
+        Returns the latest frame on the same tile strictly before frame name
+        """
+        frame = self.frames[name]
+        entries = self._tiles[frame.tile]
+        i = bisect_left(entries, (frame.time, ""))
+        if i == 0:
+            return None
+        prev = self.frames[entries[i - 1][1]]
+        if max_seconds is not None and frame.time - prev.time > max_seconds:
+            return None
+        return prev
+
+    def next(self, name: str, max_seconds: Optional[float] = None) -> Optional[Frame]:
+        """
+        Returns the earliest frame on the same tile strictly after frame name
+        """
+        frame = self.frames[name]
+        entries = self._tiles[frame.tile]
+        i = bisect_right(entries, (frame.time, LAST_NAME))
+        if i == len(entries):
+            return None
+        following = self.frames[entries[i][1]]
+        if max_seconds is not None and following.time - frame.time > max_seconds:
+            return None
+        return following
+
+    def within(
+        self,
+        lat: float,
+        lon: float,
+        radius_m: float,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+    ) -> List[Frame]:
+        """
+        Returns the frames within radius_m meters of (lat, lon), optionally
+        with start_time <= time < end_time, sorted by distance
+        """
+        d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+        d_lon = d_lat / max(math.cos(math.radians(lat)), 1e-12)
+        min_x, min_y = get_tile(min(lat + d_lat, 85.0511), lon - d_lon, self.zoom)
+        max_x, max_y = get_tile(max(lat - d_lat, -85.0511), lon + d_lon, self.zoom)
+        lo = (-math.inf if start_time is None else start_time, "")
+        hi = (math.inf if end_time is None else end_time, "")
+
+        found = []
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                entries = self._tiles.get((x, y), [])
+                start, end = bisect_left(entries, lo), bisect_left(entries, hi)
+                for _, name in entries[start:end]:
+                    frame = self.frames[name]
+                    distance = haversine(lat, lon, frame.lat, frame.lon)
+                    if distance <= radius_m:
+                        found.append((distance, frame))
+        return [frame for _, frame in sorted(found)]
+
+    def to_records(self) -> Iterable[dict]:
+        for frame in sorted(self.frames.values()):
+            yield {
+                "name": frame.name,
+                "time": datetime.fromtimestamp(frame.time, timezone.utc).isoformat(),
+                "coord": [frame.lat, frame.lon],
+            }
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict], zoom: int = 18) -> "FrameIndex":
+        index = cls(zoom)
+        index.add_docs(records)
+        return index
+
+    @classmethod
+    def load(cls, lines: Iterable[str], zoom: int = 18) -> "FrameIndex":
+        """
+        Builds an index from the lines of a JSONL export
+        """
+        return cls.from_records(
+            (json.loads(line) for line in lines if line.strip()), zoom
+        )
+
+
+def export_collection(collection: str, output: str):
+    from google.cloud import firestore  # type: ignore
+
+    coll = firestore.Client().collection(collection)
+    index = FrameIndex.from_records(
+        {**snapshot.to_dict(), "name": snapshot.id}
+        for snapshot in coll.select(["time", "coord"]).stream()
+    )
+    with open(output, "w") as f:
+        for record in index.to_records():
+            f.write(json.dumps(record) + "\n")
+    print(f"Exported {len(index)} frames to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--collection", default="street2sat-v2")
+    parser.add_argument("--output", default="frames.jsonl")
+    args = parser.parse_args()
+    export_collection(args.collection, args.output)
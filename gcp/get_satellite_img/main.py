@@ -1,18 +1,49 @@
+import math
 import os
-import tempfile
-from datetime import timedelta
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import cv2
-import wget
+import numpy as np
 from google.cloud import firestore, storage
 from google.cloud.firestore_v1.base_query import FieldFilter
-from pygeotile.tile import Point, Tile
+
+# web_mercator.py and instrumentation.py are shared with the inference
+# services, found next to this file when deployed and in gcp/ when run from
+# the repository
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from frame_index import FrameIndex  # noqa: E402
+from instrumentation import (  # noqa: E402
+    count,
+    in_context,
+    request_context,
+    set_field,
+    timer,
+)
+from mosaic import DecodedTiles, build_window, get_window_origin  # noqa: E402
+from tile_cache import TileCache  # noqa: E402
+from tile_fetcher import TileFetcher  # noqa: E402
+from web_mercator import (  # noqa: E402
+    latlon_to_pixels,
+    latlon_to_tile,
+    pixels_to_tile,
+    tile_to_quadkey,
+)
 
 # Google Cloud Storage
 storage_client = storage.Client()
-bucket_imgs = storage_client.get_bucket("street2sat-satellite-imgs")
-bucket_imgs_w_arrow = storage_client.get_bucket("street2sat-satellite-imgs-with-arrow")
+bucket_imgs = storage_client.bucket("street2sat-satellite-imgs")
+bucket_imgs_w_arrow = storage_client.bucket("street2sat-satellite-imgs-with-arrow")
+# Consecutive frames almost always fall on the same tile, so tiles are cached
+# in memory and on local disk in front of the street2sat-satellite-imgs bucket
+tile_cache = TileCache(bucket_imgs)
+decoded_tiles = DecodedTiles()
+tile_fetcher = TileFetcher()
+executor = ThreadPoolExecutor(max_workers=8)
 
 # Tile servers
 ZOOM = 18
@@ -34,8 +65,28 @@ else:
 db = firestore.Client()
 coll = db.collection("street2sat-v2")
 
+# Frames seen so far, seeded from a frame_index.py export if FRAME_INDEX_URI
+# (gs://<bucket>/<blob> or a local path) is set. Photos uploaded after the
+# export are not in it, so a frame's own window is still queried once
+frame_index = FrameIndex(ZOOM)
+# Past this many frames the oldest queried windows are forgotten
+FRAME_INDEX_MAX_FRAMES = int(os.environ.get("FRAME_INDEX_MAX_FRAMES", 100000))
+FRAME_INDEX_URI = os.environ.get("FRAME_INDEX_URI")
+if FRAME_INDEX_URI and FRAME_INDEX_URI.startswith("gs://"):
+    bucket_name, blob_name = FRAME_INDEX_URI.replace("gs://", "", 1).split("/", 1)
+    export = storage_client.bucket(bucket_name).blob(blob_name).download_as_text()
+    frame_index = FrameIndex.load(export.splitlines(), ZOOM)
+elif FRAME_INDEX_URI:
+    with open(FRAME_INDEX_URI) as f:
+        frame_index = FrameIndex.load(f, ZOOM)
+
 # Processing settings
 AMP = 2
+# Side in tile pixels of the window centered on each photo, upsampled by AMP
+WINDOW_SIZE = 256
+# The direction is taken from the nearest previous (or else next) photo on the
+# same tile within DIRECTION_WINDOW_SECONDS
+DIRECTION_WINDOW_SECONDS = 10
 LEFT_DRIVE_COUNTRIES = [
     "Botswana",
     "Kenya",
@@ -54,8 +105,6 @@ LEFT_DRIVE_COUNTRIES = [
     "Zimbabwe",
 ]
 
-temp_dir = tempfile.gettempdir()
-
 
 def get_orthogonal(prev_pos, curr_pos, amp=3, flip=False):
     """
@@ -75,15 +124,16 @@ def get_orthogonal(prev_pos, curr_pos, amp=3, flip=False):
     return (x_new, y_new)
 
 
-def get_xy(lat, lon):
-    pixel_x, pixel_y = Point(lat, lon).pixels(ZOOM)
-    tile_xy = pixel_x // 256, pixel_y // 256
-    within_tile_xy = (pixel_x % 256) * AMP, (pixel_y % 256) * AMP
-    return tile_xy, within_tile_xy
+def get_pixel_xy(lat, lon, zoom=ZOOM):
+    """
+    Returns the global pixel position of (lat, lon) at zoom
+    """
+    pixel_x, pixel_y = latlon_to_pixels(lat, lon, zoom)
+    return int(pixel_x), int(pixel_y)
 
 
 def draw_arrow(img, prev_pixel_xy, pixel_xy, flip=False):
-    img = cv2.resize(img, (256 * AMP, 256 * AMP))
+    img = cv2.resize(img, (WINDOW_SIZE * AMP, WINDOW_SIZE * AMP))
     img = cv2.circle(img, prev_pixel_xy, 1, (0, 0, 255), -1)
     img = cv2.circle(img, pixel_xy, 1, (255, 0, 0), -1)
     img = cv2.arrowedLine(img, prev_pixel_xy, pixel_xy, (0, 255, 0), 1)
@@ -92,83 +142,128 @@ def draw_arrow(img, prev_pixel_xy, pixel_xy, flip=False):
     return img
 
 
-def compute_and_draw_arrow(img_path, doc, img_w_arrow_path):
-    img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-
+def get_direction(doc, zoom=ZOOM):
+    """
+    Returns the global (previous, current) pixel positions of the arrow for
+    doc from the nearest previous frame in frame_index inside its window, or
+    mirrored from the nearest next frame when there is none
+    """
     lat, lon = doc["coord"]
-    origin_time = doc["time"]
-    start_time = origin_time - timedelta(seconds=10)
-    tile_xy, pixel_xy = get_xy(lat, lon)
-
-    photo_references = (
-        coll.where(filter=FieldFilter("time", ">", start_time))
-        .where(filter=FieldFilter("time", "<", origin_time))
-        .order_by("time", direction="DESCENDING")
-        .limit(5)
-        .get()
+    pixel_xy = get_pixel_xy(lat, lon, zoom)
+    time = frame_index.frames[doc["name"]].time
+    # Radius of the circle inscribed in the window
+    meters_per_pixel = 156543.03392 * math.cos(math.radians(lat)) / 2**zoom
+    nearby = frame_index.within(
+        lat,
+        lon,
+        WINDOW_SIZE / 2 * meters_per_pixel,
+        time - DIRECTION_WINDOW_SECONDS,
+        time + DIRECTION_WINDOW_SECONDS + 1e-6,
+    )
+    previous = [frame for frame in nearby if frame.time < time]
+    following = [frame for frame in nearby if frame.time > time]
+    if previous:
+        prev = max(previous, key=lambda frame: frame.time)
+        return get_pixel_xy(prev.lat, prev.lon, zoom), pixel_xy
+    if following:
+        nxt = min(following, key=lambda frame: frame.time)
+        next_pixel_xy = get_pixel_xy(nxt.lat, nxt.lon, zoom)
+        return tuple(2 * p - n for p, n in zip(pixel_xy, next_pixel_xy)), pixel_xy
+
+    raise ValueError(f"No photo found to establish direction for {doc['name']}")
+
+
+def load_neighbors(start_time, end_time):
+    """
+    Adds every document within DIRECTION_WINDOW_SECONDS of [start_time, end_time]
+    to frame_index in one query, returns them sorted by time
+    """
+    window = timedelta(seconds=DIRECTION_WINDOW_SECONDS)
+    with timer("db_read"):
+        snapshots = (
+            coll.where(filter=FieldFilter("time", ">=", start_time - window))
+            .where(filter=FieldFilter("time", "<=", end_time + window))
+            .order_by("time")
+            .get()
+        )
+    docs = [{**s.to_dict(), "name": s.id} for s in snapshots]
+    frame_index.add_docs(docs)
+    frame_index.mark_loaded(start_time - window, end_time + window)
+    frame_index.evict(FRAME_INDEX_MAX_FRAMES)
+    return docs
+
+
+def get_direction_or_error(doc, zoom=ZOOM):
+    try:
+        return get_direction(doc, zoom)
+    except (KeyError, ValueError) as e:
+        return e
+
+
+def compute_and_draw_arrow(img, doc, direction, origin):
+    """
+    Draws the arrow of direction on the window img with its top left corner
+    at the global pixel origin, upsampled by AMP
+    """
+    if isinstance(direction, Exception):
+        raise direction
+    prev_pixel_xy, pixel_xy = (
+        tuple(int((v - o) * AMP) for v, o in zip(xy, origin)) for xy in direction
     )
 
     is_left_hand_country = any(
         c.lower() in doc["name"].lower() for c in LEFT_DRIVE_COUNTRIES
     )
+    return draw_arrow(img, prev_pixel_xy, pixel_xy, is_left_hand_country)
 
-    for photo_ref in photo_references:
-        if photo_ref.id == doc["name"]:
-            continue
-        prev_lat, prev_lon = photo_ref.to_dict()["coord"]
-        prev_tile_xy, prev_pixel_xy = get_xy(prev_lat, prev_lon)
-        if tile_xy == prev_tile_xy:
-            img_w_arrow = draw_arrow(img, prev_pixel_xy, pixel_xy, is_left_hand_country)
-            cv2.imwrite(img_w_arrow_path, img_w_arrow)
-            return img_w_arrow
 
-    # TODO if not found use photo_references after
-    raise ValueError(f"No photo found before to establish direction for {doc['name']}")
+def get_endpoints(tile_x, tile_y, zoom):
+    quadkey = str(tile_to_quadkey(tile_x, tile_y, zoom))
+    return {
+        "mapbox": f"{MAPBOX_URL}/{zoom}/{tile_x}/{tile_y}?access_token={MAPBOX_TOKEN}",
+        "bing": f"{BING_URL}/a{quadkey}.jpeg?g=14009",
+    }
 
 
-def hello_world(request):
-    request_json = request.get_json(silent=True)
-    for key in ["name"]:
-        if key not in request_json:
-            raise ValueError(f"{key} not found in request_json")
+def get_windows_with_arrows(map_tile_server, zoom, frames):
+    """
+    Uploads a window centered on each (doc, direction, metadata) frame with
+    its arrow, mosaicked from the decoded tiles, returns the response of
+    each frame
+    """
+    responses = {}
+    for doc, direction, metadata in frames:
+        response = responses[doc["name"]] = {}
+        pixel_xy = get_pixel_xy(*doc["coord"], zoom)
+        tile_x, tile_y = (int(v) for v in pixels_to_tile(*pixel_xy))
+        origin = get_window_origin(pixel_xy, WINDOW_SIZE)
+        sources = []
 
-    name = request_json["name"]
-    zoom = request_json.get("zoom", ZOOM)
+        def get_tile(x, y):
+            key = (map_tile_server, zoom, x, y)
 
-    # Get database entry
-    docref = db.document(f"street2sat-v2/{name}")
-    doc = docref.get().to_dict()
-    lat, lon = doc["coord"]
+            def load():
+                url = get_endpoints(x, y, zoom)[map_tile_server]
 
-    t = Tile.for_latitude_longitude(lat, lon, zoom)
+                def fetch():
+                    with timer("tile_fetch"):
+                        return tile_fetcher.fetch(map_tile_server, url)
 
-    endpoints = {
-        "mapbox": f"{MAPBOX_URL}/{zoom}/{t.google[0]}/{t.google[1]}?access_token={MAPBOX_TOKEN}",
-        "bing": f"{BING_URL}/a{t.quad_tree}.jpeg?g=14009",
-    }
+                data, source = tile_cache.get(key, fetch, metadata=metadata)
+                sources.append(source)
+                count("tiles", server=map_tile_server, source=source)
+                return data
 
-    response = {}
+            return decoded_tiles.get(key, load)
 
-    for map_tile_server in MAP_TILE_SERVERS.split(" "):
         try:
-            blob = bucket_imgs.blob(
-                f"{map_tile_server}/{t.google[0]}/{t.google[1]}/{zoom}.jpg"
+            # Download satellite images
+            with timer("window"):
+                img = build_window(origin, WINDOW_SIZE, get_tile)
+            response[f"{map_tile_server}_fetched_img"] = "fetched" in sources
+            response[f"{map_tile_server}_img"] = TileCache.blob_name(
+                (map_tile_server, zoom, tile_x, tile_y)
             )
-            img_path = f"{temp_dir}/{map_tile_server}_{name}.jpg"
-
-            # Download satellite image
-            if not blob.exists():
-                print(f"Fetching from: {endpoints[map_tile_server]}")
-                wget.download(endpoints[map_tile_server], img_path)
-                # Upload satellite image
-                blob.upload_from_filename(img_path)
-                blob.metadata = request_json
-                blob.patch()
-                response[f"{map_tile_server}_fetched_img"] = True
-            else:
-                blob.download_to_filename(img_path)
-                response[f"{map_tile_server}_fetched_img"] = False
-            response[f"{map_tile_server}_img"] = blob.name
         except Exception as e:
             print(e)
             response[f"{map_tile_server}_fetched_img"] = False
@@ -176,24 +271,148 @@ def hello_world(request):
 
         try:
             blob_w_arrow = bucket_imgs_w_arrow.blob(
-                f"{map_tile_server}/{t.google[0]}/{t.google[1]}/{zoom}/{name}.jpg"
+                f"{map_tile_server}/{tile_x}/{tile_y}/{zoom}/{doc['name']}.jpg"
             )
 
             # Add arrow
-            img_w_arrow_path = f"{temp_dir}/{map_tile_server}_arrow_{name}.jpg"
-            compute_and_draw_arrow(img_path, doc, img_w_arrow_path)
-            blob_w_arrow.upload_from_filename(img_w_arrow_path)
-            blob_w_arrow.metadata = request_json
-            blob_w_arrow.patch()
+            with timer("arrow"):
+                img_w_arrow = compute_and_draw_arrow(img, doc, direction, origin)
+                _, buffer = cv2.imencode(".jpg", img_w_arrow)
+            blob_w_arrow.metadata = {
+                **metadata,
+                "window_x": str(origin[0]),
+                "window_y": str(origin[1]),
+            }
+            with timer("upload"):
+                blob_w_arrow.upload_from_string(
+                    buffer.tobytes(), content_type="image/jpeg"
+                )
             response[f"{map_tile_server}_added_arrow"] = True
 
         except Exception as e:
             print(e)
             response[f"{map_tile_server}_added_arrow"] = False
 
-        Path(img_path).unlink(missing_ok=True)
-        Path(img_w_arrow_path).unlink(missing_ok=True)
+    return responses
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def parse_time(value):
+    """
+    Parses an ISO 8601 time, UTC unless it has an offset. Raises BadRequest
+    if it is not one
+    """
+    try:
+        # fromisoformat only accepts a trailing Z from Python 3.11
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        time = datetime.fromisoformat(value)
+    except (AttributeError, TypeError, ValueError):
+        raise BadRequest(f"{value!r} is not an ISO 8601 time")
+    # Firestore times are UTC
+    return time if time.tzinfo else time.replace(tzinfo=timezone.utc)
+
+
+def load_batch_docs(request_json):
+    """
+    Returns the docs named in request_json["names"], or with a time in
+    [request_json["start"], request_json["end"]) (ISO 8601), with their
+    neighbors added to frame_index
+    """
+    if "names" in request_json:
+        with timer("db_read"):
+            refs = [coll.document(name) for name in request_json["names"]]
+            docs = [{**s.to_dict(), "name": s.id} for s in db.get_all(refs) if s.exists]
+        if docs:
+            start_time = min(doc["time"] for doc in docs)
+            end_time = max(doc["time"] for doc in docs)
+            load_neighbors(start_time, end_time)
+        return docs
+
+    start_time = parse_time(request_json["start"])
+    end_time = parse_time(request_json.get("end"))
+    neighbors = load_neighbors(start_time, end_time)
+    return [doc for doc in neighbors if start_time <= doc["time"] < end_time]
+
+
+def process_batch(request_json):
+    """
+    Adds arrows for many documents at once: the documents are read in at
+    most two queries, directions come from frame_index and every tile is
+    fetched once
+    """
+    zoom = request_json.get("zoom", ZOOM)
+    docs = load_batch_docs(request_json)
+
+    # Frames of a tile are processed together so they share its decoded
+    # neighbors while they are in decoded_tiles
+    docs = sorted(docs, key=lambda doc: doc["time"])
+    frames_by_tile = defaultdict(list)
+    if docs:
+        lats, lons = np.array([doc["coord"] for doc in docs], dtype=np.float64).T
+        tiles = zip(*(t.tolist() for t in latlon_to_tile(lats, lons, zoom)))
+        for doc, tile in zip(docs, tiles):
+            frame = (doc, get_direction_or_error(doc, zoom), {"name": doc["name"]})
+            frames_by_tile[tile].append(frame)
+
+    futures = [
+        executor.submit(in_context(get_windows_with_arrows), server, zoom, frames)
+        for frames in frames_by_tile.values()
+        for server in MAP_TILE_SERVERS.split(" ")
+    ]
+
+    response = {doc["name"]: {} for doc in docs}
+    for future in futures:
+        for name, frame_response in future.result().items():
+            response[name].update(frame_response)
+    return response
+
+
+def hello_world(request):
+    request_json = request.get_json(silent=True)
+    if "names" in request_json or "start" in request_json:
+        with request_context("get_satellite_img_batch"):
+            try:
+                response = process_batch(request_json)
+            except BadRequest as e:
+                return {"error": str(e)}, 400
+            set_field("batch_size", len(response))
+            return response
+    with request_context("get_satellite_img", name=request_json.get("name")):
+        return process_one(request_json)
+
+
+def process_one(request_json):
+    for key in ["name"]:
+        if key not in request_json:
+            raise ValueError(f"{key} not found in request_json")
+
+    name = request_json["name"]
+    zoom = request_json.get("zoom", ZOOM)
 
+    # Get database entry
+    docref = db.document(f"street2sat-v2/{name}")
+    with timer("db_read"):
+        doc = docref.get().to_dict()
+    doc["name"] = name
+    # Being in the index is not enough, the frame may only have been loaded
+    # as the neighbor of another one, without its own window
+    window = timedelta(seconds=DIRECTION_WINDOW_SECONDS)
+    if not frame_index.is_loaded(doc["time"] - window, doc["time"] + window):
+        load_neighbors(doc["time"], doc["time"])
+
+    # Providers are fetched concurrently so latency is the slowest, not the sum
+    frames = [(doc, get_direction_or_error(doc, zoom), request_json)]
+    futures = [
+        executor.submit(in_context(get_windows_with_arrows), server, zoom, frames)
+        for server in MAP_TILE_SERVERS.split(" ")
+    ]
+    response = {}
+    for future in futures:
+        response.update(future.result()[doc["name"]])
     return response
 
 
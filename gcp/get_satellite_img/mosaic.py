@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Tuple
+
+import cv2
+import numpy as np
+
+TILE_SIZE = 256
+
+
+class DecodedTiles:
+    """
+    Decoded tiles kept across frames, least recently used evicted past max_tiles
+    """
+
+    def __init__(self, max_tiles: int = 64):
+        self.max_tiles = max_tiles
+        self._tiles: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, load: Callable[[], bytes]) -> np.ndarray:
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        img = cv2.imdecode(np.frombuffer(load(), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Tile {key} could not be decoded")
+        if img.shape[:2] != (TILE_SIZE, TILE_SIZE):
+            img = cv2.resize(img, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA)
+        with self._lock:
+            self._tiles[key] = img
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return img
+
+
+def get_window_origin(pixel_xy: Tuple[float, float], size: int) -> Tuple[int, int]:
+    """
+    Returns the global pixel of the top left corner of the size x size window
+    centered on pixel_xy
+    """
+    return int(pixel_xy[0]) - size // 2, int(pixel_xy[1]) - size // 2
+
+
+def build_window(
+    origin: Tuple[int, int],
+    size: int,
+    get_tile: Callable[[int, int], np.ndarray],
+) -> np.ndarray:
+    """
+    Pastes the parts of every tile overlapping the size x size window with
+    its top left corner at the global pixel origin
+    """
+    x0, y0 = origin
+    window = np.empty((size, size, 3), dtype=np.uint8)
+    for tile_y in range(y0 // TILE_SIZE, (y0 + size - 1) // TILE_SIZE + 1):
+        for tile_x in range(x0 // TILE_SIZE, (x0 + size - 1) // TILE_SIZE + 1):
+            tile = get_tile(tile_x, tile_y)
+            # Overlap of the tile and the window in global pixels
+            left = max(x0, tile_x * TILE_SIZE)
+            right = min(x0 + size, (tile_x + 1) * TILE_SIZE)
+            top = max(y0, tile_y * TILE_SIZE)
+            bottom = min(y0 + size, (tile_y + 1) * TILE_SIZE)
+            tile_x0, tile_y0 = tile_x * TILE_SIZE, tile_y * TILE_SIZE
+            window[slice(top - y0, bottom - y0), slice(left - x0, right - x0)] = tile[
+                slice(top - tile_y0, bottom - tile_y0),
+                slice(left - tile_x0, right - tile_x0),
+            ]
+    return window
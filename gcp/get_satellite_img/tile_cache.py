@@ -0,0 +1,184 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from google.api_core.exceptions import NotFound
+
+TileKey = Tuple[str, int, int, int]  # (server, z, x, y)
+
+TILE_CACHE_MEMORY_BYTES = int(os.environ.get("TILE_CACHE_MEMORY_BYTES", 64 << 20))
+# /tmp is memory backed on Cloud Functions, so the disk tier is kept small
+TILE_CACHE_DISK_BYTES = int(os.environ.get("TILE_CACHE_DISK_BYTES", 256 << 20))
+
+
+def tile_hash(key: TileKey) -> str:
+    server, z, x, y = key
+    return hashlib.sha256(f"{server}/{z}/{x}/{y}".encode()).hexdigest()
+
+
+class MemoryLRU:
+    """
+    Tile bytes kept in process, least recently used evicted past max_bytes
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[TileKey, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key: TileKey, data: bytes):
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskLRU:
+    """
+    Tile bytes stored as <root>/<sha256 of key>, least recently read
+    (by mtime, refreshed on every hit) evicted past max_bytes
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sizes: Dict[Path, int] = {}
+        for path in self.root.iterdir():
+            if path.is_file() and not path.name.startswith("."):
+                self._sizes[path] = path.stat().st_size
+        self.size = sum(self._sizes.values())
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        path = self.root / tile_hash(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: TileKey, data: bytes):
+        path = self.root / tile_hash(key)
+        tmp_path = self.root / f".{path.name}.{threading.get_ident()}"
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        with self._lock:
+            self.size += len(data) - self._sizes.get(path, 0)
+            self._sizes[path] = len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        def last_used(path):
+            try:
+                return path.stat().st_mtime
+            except FileNotFoundError:
+                return 0.0
+
+        for path in sorted(self._sizes, key=last_used):
+            if self.size <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            self.size -= self._sizes.pop(path)
+
+
+class TileCache:
+    """
+    Satellite tiles keyed by (server, z, x, y), looked up in an in-process
+    LRU, then a size-bounded local disk directory, then the bucket of
+    previously fetched tiles, before fetching from the tile server.
+
+    Concurrent requests for the same tile share a single lookup/fetch.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        disk_dir: Optional[Path] = None,
+        memory_bytes: int = TILE_CACHE_MEMORY_BYTES,
+        disk_bytes: int = TILE_CACHE_DISK_BYTES,
+    ):
+        self.bucket = bucket
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskLRU(
+            disk_dir or Path(tempfile.gettempdir()) / "street2sat-tiles", disk_bytes
+        )
+        self._in_flight: Dict[TileKey, Future] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def blob_name(key: TileKey) -> str:
+        server, z, x, y = key
+        return f"{server}/{x}/{y}/{z}.jpg"
+
+    def get(
+        self,
+        key: TileKey,
+        fetch: Callable[[], bytes],
+        metadata: Optional[dict] = None,
+    ) -> Tuple[bytes, str]:
+        """
+        Returns the tile and where it was found: memory, disk, bucket or fetched.
+        Fetched tiles are uploaded to the bucket with metadata.
+        """
+        data = self.memory.get(key)
+        if data is not None:
+            return data, "memory"
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = self._load(key, fetch, metadata)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return result
+
+    def _load(self, key, fetch, metadata) -> Tuple[bytes, str]:
+        data = self.disk.get(key)
+        source = "disk"
+        if data is None:
+            blob = self.bucket.blob(self.blob_name(key))
+            try:
+                data = blob.download_as_bytes()
+                source = "bucket"
+            except NotFound:
+                print(f"Fetching tile: {key}")
+                data = fetch()
+                blob.metadata = metadata
+                blob.upload_from_string(data, content_type="image/jpeg")
+                source = "fetched"
+            self.disk.put(key, data)
+        self.memory.put(key, data)
+        return data, source
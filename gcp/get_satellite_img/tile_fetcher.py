@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Per provider (connect, read) timeouts in seconds, retries on connection
+# errors and 429/5xx responses, and sustained requests per second
+PROVIDERS = {
+    "mapbox": {"timeout": (3.05, 10), "retries": 3, "rate": 20.0},
+    "bing": {"timeout": (3.05, 10), "retries": 3, "rate": 10.0},
+}
+POOL_SIZE = int(os.environ.get("TILE_FETCH_POOL_SIZE", 8))
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate requests per second with bursts of up to burst
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        # The token is reserved, so waiting outside the lock keeps requests ordered
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TileFetcher:
+    """
+    Downloads tiles into memory over one keep-alive requests.Session per
+    provider, with the provider's timeouts, retry policy and rate limit
+    """
+
+    def __init__(self, providers: Dict[str, dict] = PROVIDERS):
+        self.providers = providers
+        self._sessions: Dict[str, requests.Session] = {}
+        self._limiters: Dict[str, RateLimiter] = {}
+        for server, settings in providers.items():
+            retry = Retry(
+                total=settings["retries"],
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._sessions[server] = session
+            self._limiters[server] = RateLimiter(settings["rate"])
+
+    def fetch(self, server: str, url: str) -> bytes:
+        """
+        Returns the body of url, raises requests.HTTPError on an error response
+        """
+        if server not in self._sessions:
+            raise ValueError(f"Unknown tile server: {server}")
+        self._limiters[server].acquire()
+        response = self._sessions[server].get(
+            url, timeout=self.providers[server]["timeout"]
+        )
+        response.raise_for_status()
+        return response.content
@@ -0,0 +1,91 @@
+import atexit
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+import cv2  # type: ignore
+import numpy as np
+from instrumentation import count, in_context, timer
+
+SEGMENTATION_SAMPLE_RATE = float(os.environ.get("SEGMENTATION_SAMPLE_RATE", 0.01))
+
+
+def is_sampled(name: str, rate: float = SEGMENTATION_SAMPLE_RATE) -> bool:
+    """
+    Deterministically picks a fraction rate of names, so reprocessing an
+    image exports it again only if it was exported before
+    """
+    digest = hashlib.sha256(name.encode()).digest()
+    return int.from_bytes(digest[:8], "big") < rate * 2**64
+
+
+def get_labels_uri(uri: str, bucket: str) -> str:
+    """
+    Returns gs://<bucket>/<parent>/<stem>/labels.png for gs://<source bucket>/<parent>/<stem>.jpg
+    """
+    uri_as_path = Path(uri)
+    cloud_dest_parent = "/".join(uri_as_path.parts[2:-1])
+    return f"gs://{bucket}/{cloud_dest_parent}/{uri_as_path.stem}/labels.png"
+
+
+def encode_label_map(output: np.ndarray) -> bytes:
+    """
+    Encodes a (C, H, W) segmentation output, or its (H, W) argmax, as a
+    single channel PNG whose pixels are the index of the most likely class
+    """
+    labels = output if output.ndim == 2 else output.argmax(axis=0)
+    labels = labels.astype(np.uint8)
+    is_encoded, buffer = cv2.imencode(".png", labels)
+    if not is_encoded:
+        raise ValueError("Label map could not be encoded")
+    return buffer.tobytes()
+
+
+class ArtifactExporter:
+    """
+    Encodes and uploads artifacts on a thread pool, off the request path.
+
+    At most max_pending artifacts are queued or in progress, further ones
+    are dropped rather than holding on to their outputs.
+    """
+
+    def __init__(self, blob_store, max_workers: int = 2, max_pending: int = 32):
+        self.blob_store = blob_store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        atexit.register(self.close)
+
+    def submit(
+        self,
+        uri: str,
+        encode: Callable[[], bytes],
+        content_type: Optional[str] = None,
+    ) -> Optional[Future]:
+        """
+        Uploads encode() to uri in the background, returns None if the
+        artifact was dropped
+        """
+        if not self._slots.acquire(blocking=False):
+            print(f"HANDLER: Export queue full, dropping {uri}")
+            count("artifacts_dropped")
+            return None
+
+        def export():
+            try:
+                with timer("export"):
+                    self.blob_store.write(uri, encode(), content_type=content_type)
+                print(f"HANDLER: Uploaded to {uri}")
+                return uri
+            except Exception as e:
+                print(f"HANDLER ERROR: Exporting {uri} failed: {e}")
+                raise
+            finally:
+                self._slots.release()
+
+        return self._executor.submit(in_context(export))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,525 @@
+"""
+Pluggable blob storage and document store used by the handlers.
+
+Blobs are addressed by gs://<bucket>/<name> uris and documents by
+(collection, name) whichever backend is used:
+- gcp: Cloud Storage and Firestore, clients created on first use
+- local: <root>/<bucket>/<name> files and <root>/firestore/<collection>/<name>.json
+- memory: dictionaries, for benchmarks and load tests
+
+The backend is chosen with STREET2SAT_BACKEND (default gcp) and the local
+root with STREET2SAT_LOCAL_ROOT.
+
+Every document set or updated gets an updated_at field with the time of
+the write (the commit time on Firestore), which incremental exports query.
+"""
+
+import copy
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from inference_utils import split_uri
+
+# (op, collection, name, data) with op one of "set", "update", "merge" or "delete"
+Write = Tuple[str, str, str, Optional[dict]]
+UPDATED_FIELD = "updated_at"
+
+
+class BlobStore:
+    def read(self, uri: str) -> bytes:
+        """
+        Returns the contents of uri, raises FileNotFoundError if it does not exist
+        """
+        raise NotImplementedError
+
+    def write(
+        self,
+        uri: str,
+        data: bytes,
+        metadata: Optional[dict] = None,
+        content_type: Optional[str] = None,
+    ):
+        raise NotImplementedError
+
+    def exists(self, uri: str) -> bool:
+        try:
+            self.metadata(uri)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def metadata(self, uri: str) -> dict:
+        """
+        Returns the custom metadata of uri, raises FileNotFoundError if it does not exist
+        """
+        raise NotImplementedError
+
+    def copy(self, src_uri: str, dest_uri: str):
+        raise NotImplementedError
+
+    def list(self, prefix_uri: str) -> Iterator[str]:
+        """
+        Yields the uri of every blob whose name starts with the prefix
+        """
+        raise NotImplementedError
+
+
+class DocumentStore:
+    def get(self, collection: str, name: str) -> Optional[dict]:
+        """
+        Returns the document, None if it does not exist
+        """
+        raise NotImplementedError
+
+    def set(self, collection: str, name: str, data: dict):
+        self.commit([("set", collection, name, data)])
+
+    def update(self, collection: str, name: str, data: dict):
+        """
+        Updates fields of an existing document, raises KeyError if it does not exist
+        """
+        self.commit([("update", collection, name, data)])
+
+    def merge(self, collection: str, name: str, data: dict):
+        """
+        Updates fields of the document, creating it if it does not exist
+        """
+        self.commit([("merge", collection, name, data)])
+
+    def delete(self, collection: str, name: str):
+        self.commit([("delete", collection, name, None)])
+
+    def commit(self, writes: List[Write]):
+        """
+        Applies every write atomically
+        """
+        raise NotImplementedError
+
+    def list_names(self, collection: str) -> List[str]:
+        raise NotImplementedError
+
+    def get_split_points(self, collection: str, count: int) -> List[str]:
+        """
+        Returns up to count - 1 sorted names splitting the collection into
+        ranges of about the same number of documents
+        """
+        names = sorted(self.list_names(collection))
+        points = {names[len(names) * i // count] for i in range(1, count) if names}
+        return sorted(points)
+
+    def stream(
+        self,
+        collection: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        updated_after: Optional[datetime] = None,
+        page_size: int = 500,
+    ) -> Iterator[Tuple[str, dict]]:
+        """
+        Yields the (name, document) with names in [start, end) in name order
+        or, with updated_after, those updated after it in update order.
+        Documents are read page_size at a time.
+        """
+        if updated_after is not None and (start is not None or end is not None):
+            raise ValueError("Either a name range or updated_after can be streamed")
+        docs = []
+        for name in sorted(self.list_names(collection)):
+            if (start is not None and name < start) or (
+                end is not None and name >= end
+            ):
+                continue
+            doc = self.get(collection, name)
+            if doc is None:
+                continue
+            if updated_after is not None:
+                updated = doc.get(UPDATED_FIELD)
+                if isinstance(updated, str):
+                    updated = datetime.fromisoformat(updated)
+                if updated is None or updated <= updated_after:
+                    continue
+                docs.append((updated, name, doc))
+            else:
+                yield name, doc
+        for _, name, doc in sorted(docs, key=lambda item: item[:2]):
+            yield name, doc
+
+
+class GCSBlobStore(BlobStore):
+    def __init__(self):
+        self._client = None
+        self._buckets: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import storage  # type: ignore
+
+                self._client = storage.Client()
+        return self._client
+
+    def bucket(self, name: str):
+        """
+        Returns a cached bucket handle, without the metadata round-trip of get_bucket
+        """
+        if name not in self._buckets:
+            self._buckets[name] = self.client.bucket(name)
+        return self._buckets[name]
+
+    def blob(self, uri: str):
+        bucket_name, blob_name = split_uri(uri)
+        return self.bucket(bucket_name).blob(blob_name)
+
+    def read(self, uri: str) -> bytes:
+        from google.api_core.exceptions import NotFound  # type: ignore
+
+        try:
+            return self.blob(uri).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(uri)
+
+    def write(self, uri, data, metadata=None, content_type=None):
+        blob = self.blob(uri)
+        blob.metadata = metadata
+        blob.upload_from_string(data, content_type=content_type)
+
+    def metadata(self, uri: str) -> dict:
+        bucket_name, blob_name = split_uri(uri)
+        blob = self.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(uri)
+        return blob.metadata or {}
+
+    def copy(self, src_uri: str, dest_uri: str):
+        src_blob = self.blob(src_uri)
+        dest_bucket_name, dest_blob_name = split_uri(dest_uri)
+        src_blob.bucket.copy_blob(
+            src_blob, self.bucket(dest_bucket_name), dest_blob_name
+        )
+
+    def list(self, prefix_uri: str) -> Iterator[str]:
+        bucket_name, prefix = split_uri(prefix_uri)
+        for blob in self.client.list_blobs(bucket_name, prefix=prefix):
+            yield f"gs://{bucket_name}/{blob.name}"
+
+
+class FirestoreDocumentStore(DocumentStore):
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import firestore  # type: ignore
+
+                self._client = firestore.Client()
+        return self._client
+
+    def get(self, collection, name):
+        snapshot = self.client.collection(collection).document(name).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def commit(self, writes):
+        from google.api_core.exceptions import NotFound  # type: ignore
+        from google.cloud import firestore  # type: ignore
+
+        batch = self.client.batch()
+        for op, collection, name, data in writes:
+            doc_ref = self.client.collection(collection).document(name)
+            if op == "set":
+                batch.set(doc_ref, {**data, UPDATED_FIELD: firestore.SERVER_TIMESTAMP})
+            elif op == "update":
+                batch.update(
+                    doc_ref, {**data, UPDATED_FIELD: firestore.SERVER_TIMESTAMP}
+                )
+            elif op == "merge":
+                batch.set(
+                    doc_ref,
+                    {**data, UPDATED_FIELD: firestore.SERVER_TIMESTAMP},
+                    merge=True,
+                )
+            else:
+                batch.delete(doc_ref)
+        try:
+            batch.commit()
+        except NotFound as e:
+            raise KeyError(str(e))
+
+    def list_names(self, collection):
+        coll = self.client.collection(collection)
+        return [ref.id for ref in coll.list_documents(page_size=1000)]
+
+    def get_split_points(self, collection, count):
+        if count <= 1:
+            return []
+        # Partitions of the collection group, so of every collection with
+        # this id, which are only top level here
+        partitions = self.client.collection_group(collection).get_partitions(count)
+        return [p.end_at.id for p in partitions if p.end_at is not None]
+
+    def stream(
+        self, collection, start=None, end=None, updated_after=None, page_size=500
+    ):
+        from google.cloud.firestore_v1.base_query import FieldFilter  # type: ignore
+
+        if updated_after is not None and (start is not None or end is not None):
+            raise ValueError("Either a name range or updated_after can be streamed")
+        coll = self.client.collection(collection)
+        if updated_after is None:
+            query = coll.order_by("__name__")
+            if start is not None:
+                query = query.start_at([coll.document(start)])
+            if end is not None:
+                query = query.end_before([coll.document(end)])
+        else:
+            query = coll.where(
+                filter=FieldFilter(UPDATED_FIELD, ">", updated_after)
+            ).order_by(UPDATED_FIELD)
+        # Pages rather than one stream, which the server cuts after a while
+        last = None
+        while True:
+            page_query = query if last is None else query.start_after(last)
+            page = list(page_query.limit(page_size).stream())
+            for snapshot in page:
+                yield snapshot.id, snapshot.to_dict()
+            if len(page) < page_size:
+                return
+            last = page[-1]
+
+
+class MemoryBlobStore(BlobStore):
+    def __init__(self):
+        self.blobs: Dict[str, Tuple[bytes, dict]] = {}
+        self._lock = threading.Lock()
+
+    def read(self, uri):
+        if uri not in self.blobs:
+            raise FileNotFoundError(uri)
+        return self.blobs[uri][0]
+
+    def write(self, uri, data, metadata=None, content_type=None):
+        with self._lock:
+            self.blobs[uri] = (bytes(data), dict(metadata or {}))
+
+    def metadata(self, uri):
+        if uri not in self.blobs:
+            raise FileNotFoundError(uri)
+        return dict(self.blobs[uri][1])
+
+    def copy(self, src_uri, dest_uri):
+        data, metadata = self.read(src_uri), self.metadata(src_uri)
+        self.write(dest_uri, data, metadata)
+
+    def list(self, prefix_uri):
+        return iter(
+            sorted(uri for uri in list(self.blobs) if uri.startswith(prefix_uri))
+        )
+
+
+class MemoryDocumentStore(DocumentStore):
+    def __init__(self):
+        self.collections: Dict[str, Dict[str, dict]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, collection, name):
+        doc = self.collections.get(collection, {}).get(name)
+        return copy.deepcopy(doc)
+
+    def commit(self, writes):
+        with self._lock:
+            for op, collection, name, _ in writes:
+                docs = self.collections.get(collection, {})
+                if op == "update" and name not in docs:
+                    raise KeyError(f"{collection}/{name}")
+            updated = {UPDATED_FIELD: datetime.now(timezone.utc)}
+            for op, collection, name, data in writes:
+                docs = self.collections.setdefault(collection, {})
+                if op == "set":
+                    docs[name] = {**copy.deepcopy(data), **updated}
+                elif op == "update":
+                    docs[name].update({**copy.deepcopy(data), **updated})
+                elif op == "merge":
+                    docs.setdefault(name, {}).update({**copy.deepcopy(data), **updated})
+                else:
+                    docs.pop(name, None)
+
+    def list_names(self, collection):
+        with self._lock:
+            return list(self.collections.get(collection, {}))
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Blobs as files under root/<bucket>/<name>, metadata as JSON files
+    under root/.metadata/<bucket>/<name>.json
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, uri: str) -> Path:
+        return self.root.joinpath(*split_uri(uri))
+
+    def metadata_path(self, uri: str) -> Path:
+        bucket_name, blob_name = split_uri(uri)
+        return self.root / ".metadata" / bucket_name / f"{blob_name}.json"
+
+    def read(self, uri):
+        return self.path(uri).read_bytes()
+
+    def write(self, uri, data, metadata=None, content_type=None):
+        path = self.path(uri)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the destination and renamed so readers never see part of it
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        metadata_path = self.metadata_path(uri)
+        if metadata:
+            metadata_path.parent.mkdir(parents=True, exist_ok=True)
+            metadata_path.write_text(json.dumps(metadata))
+        else:
+            metadata_path.unlink(missing_ok=True)
+
+    def metadata(self, uri):
+        if not self.path(uri).exists():
+            raise FileNotFoundError(uri)
+        metadata_path = self.metadata_path(uri)
+        if not metadata_path.exists():
+            return {}
+        return json.loads(metadata_path.read_text())
+
+    def copy(self, src_uri, dest_uri):
+        self.write(dest_uri, self.read(src_uri), self.metadata(src_uri))
+
+    def list(self, prefix_uri):
+        bucket_name, prefix = split_uri(prefix_uri)
+        bucket_dir = self.root / bucket_name
+        for path in sorted(bucket_dir.rglob("*")):
+            blob_name = path.relative_to(bucket_dir).as_posix()
+            if (
+                path.is_file()
+                and not path.name.startswith(".")
+                and blob_name.startswith(prefix)
+            ):
+                yield f"gs://{bucket_name}/{blob_name}"
+
+
+class LocalDocumentStore(DocumentStore):
+    """
+    Documents as JSON files under root/<collection>/<name>.json,
+    datetimes are stored as ISO 8601 strings
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def path(self, collection: str, name: str) -> Path:
+        return self.root / collection / f"{name}.json"
+
+    def get(self, collection, name):
+        path = self.path(collection, name)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text())
+
+    def commit(self, writes):
+        with self._lock:
+            docs = {}
+            updated = {UPDATED_FIELD: datetime.now(timezone.utc)}
+            for op, collection, name, data in writes:
+                key = (collection, name)
+                if key not in docs:
+                    docs[key] = self.get(collection, name)
+                if op == "set":
+                    docs[key] = {**copy.deepcopy(data), **updated}
+                elif op == "update":
+                    if docs[key] is None:
+                        raise KeyError(f"{collection}/{name}")
+                    docs[key].update({**copy.deepcopy(data), **updated})
+                elif op == "merge":
+                    docs[key] = {**(docs[key] or {}), **copy.deepcopy(data), **updated}
+                else:
+                    docs[key] = None
+            for (collection, name), doc in docs.items():
+                path = self.path(collection, name)
+                if doc is None:
+                    path.unlink(missing_ok=True)
+                    continue
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(json.dumps(doc, default=_to_json))
+
+    def list_names(self, collection):
+        return [path.stem for path in (self.root / collection).glob("*.json")]
+
+
+def _to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "tolist"):  # numpy scalars and arrays
+        return value.tolist()
+    return str(value)
+
+
+_blob_store: Optional[BlobStore] = None
+_document_store: Optional[DocumentStore] = None
+
+
+def _local_root() -> Path:
+    default = Path(tempfile.gettempdir()) / "street2sat"
+    return Path(os.environ.get("STREET2SAT_LOCAL_ROOT", default))
+
+
+def get_blob_store() -> BlobStore:
+    """
+    Returns the blob store selected by STREET2SAT_BACKEND, created on first use
+    """
+    global _blob_store
+    if _blob_store is None:
+        backend = os.environ.get("STREET2SAT_BACKEND", "gcp")
+        if backend == "local":
+            _blob_store = LocalBlobStore(_local_root())
+        elif backend == "memory":
+            _blob_store = MemoryBlobStore()
+        else:
+            _blob_store = GCSBlobStore()
+    return _blob_store
+
+
+def get_document_store() -> DocumentStore:
+    """
+    Returns the document store selected by STREET2SAT_BACKEND, created on first use
+    """
+    global _document_store
+    if _document_store is None:
+        backend = os.environ.get("STREET2SAT_BACKEND", "gcp")
+        if backend == "local":
+            _document_store = LocalDocumentStore(_local_root() / "firestore")
+        elif backend == "memory":
+            _document_store = MemoryDocumentStore()
+        else:
+            _document_store = FirestoreDocumentStore()
+    return _document_store
+
+
+def set_backends(
+    blob_store: Optional[BlobStore] = None,
+    document_store: Optional[DocumentStore] = None,
+):
+    """
+    Replaces the stores returned by get_blob_store and get_document_store
+    """
+    global _blob_store, _document_store
+    if blob_store is not None:
+        _blob_store = blob_store
+    if document_store is not None:
+        _document_store = document_store
@@ -0,0 +1,271 @@
+"""
+Predictions cached by the content of the image and the model which made them.
+
+Keys are <model>/<model version>/<MD5 of the image>, hashed from the bytes
+the handler downloaded, so a hit saves the decode and forward pass and an
+upload not visible yet is retried like any download. Values are JSON
+documents (datetimes included) kept in tiers, looked up in order and
+filled on a hit:
+- memory: the RESULT_CACHE_MEMORY_ITEMS most recently used, in process
+- disk: under RESULT_CACHE_DIR, least recently used evicted past
+  RESULT_CACHE_DISK_BYTES
+- blob: under RESULT_CACHE_URI (gs://<bucket>/<prefix>) when set, shared by
+  every instance
+
+RESULT_CACHE=0 disables the cache.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from instrumentation import count
+
+T = TypeVar("T")
+
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "1") == "1"
+RESULT_CACHE_MEMORY_ITEMS = int(os.environ.get("RESULT_CACHE_MEMORY_ITEMS", 10000))
+RESULT_CACHE_DIR = Path(
+    os.environ.get(
+        "RESULT_CACHE_DIR", Path(tempfile.gettempdir()) / "street2sat-results"
+    )
+)
+# /tmp is memory backed on Cloud Run, so the disk tier is kept small
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", 64 << 20))
+RESULT_CACHE_URI = os.environ.get("RESULT_CACHE_URI")
+
+
+def _to_json(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if hasattr(value, "tolist"):  # numpy scalars and arrays
+        return value.tolist()
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def _from_json(value: dict):
+    if "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    return value
+
+
+def encode_result(result: dict) -> bytes:
+    return json.dumps(result, default=_to_json).encode()
+
+
+def decode_result(data: bytes) -> dict:
+    return json.loads(data, object_hook=_from_json)
+
+
+def get_model_version(path: Optional[str], *settings: str) -> str:
+    """
+    Returns a short hash of the serialized model at path and of the settings
+    it runs with (precision, input size...)
+    """
+    digest = hashlib.sha256()
+    if path is not None:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    for setting in settings:
+        digest.update(setting.encode())
+    return digest.hexdigest()[:16]
+
+
+class ResultStore:
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+
+class MemoryResultStore(ResultStore):
+    """
+    The max_items most recently used results, in process
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._items[key] = data
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+class DiskResultStore(ResultStore):
+    """
+    Results stored as <root>/<sha256 of key>.json, least recently read (by
+    mtime, refreshed on every hit) evicted past max_bytes
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sizes: Dict[Path, int] = {}
+        for path in self.root.glob("*.json"):
+            self._sizes[path] = path.stat().st_size
+        self.size = sum(self._sizes.values())
+
+    def path(self, key: str) -> Path:
+        return self.root / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp_path = self.root / f".{path.name}.{threading.get_ident()}"
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        with self._lock:
+            self.size += len(data) - self._sizes.get(path, 0)
+            self._sizes[path] = len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        def last_used(path):
+            try:
+                return path.stat().st_mtime
+            except FileNotFoundError:
+                return 0.0
+
+        for path in sorted(self._sizes, key=last_used):
+            if self.size <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            self.size -= self._sizes.pop(path)
+
+
+class BlobResultStore(ResultStore):
+    """
+    Results stored as <prefix_uri>/<key>.json in a blob store
+    """
+
+    def __init__(self, blob_store, prefix_uri: str):
+        self.blob_store = blob_store
+        self.prefix_uri = prefix_uri.rstrip("/")
+
+    def get(self, key):
+        try:
+            return self.blob_store.read(f"{self.prefix_uri}/{key}.json")
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        self.blob_store.write(
+            f"{self.prefix_uri}/{key}.json", data, content_type="application/json"
+        )
+
+
+class TieredResultStore(ResultStore):
+    """
+    Looks results up in every store in order, copying a hit to the stores
+    before the one it was found in, and writes them to every store
+    """
+
+    def __init__(self, stores: List[ResultStore]):
+        self.stores = stores
+
+    def get(self, key):
+        for i, store in enumerate(self.stores):
+            data = store.get(key)
+            if data is not None:
+                for upper in self.stores[:i]:
+                    upper.put(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        for store in self.stores:
+            store.put(key, data)
+
+
+class ResultCache:
+    """
+    The predictions of one model, by the content hash of their image
+    """
+
+    def __init__(self, model: str, store: Optional[ResultStore]):
+        self.model = model
+        self.store = store
+        self.version = "unversioned"
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None
+
+    def key(self, data: bytes) -> Optional[str]:
+        """
+        Returns the key of an image's contents, None if the cache is disabled
+        """
+        if not self.enabled:
+            return None
+        return f"{self.model}/{self.version}/{hashlib.md5(data).hexdigest()}"
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        data = self.store.get(key)
+        count("result_cache", model=self.model, hit=data is not None)
+        return None if data is None else decode_result(data)
+
+    def read(
+        self, data: bytes, decode: Callable[[bytes], T]
+    ) -> Tuple[Optional[str], Optional[dict], Optional[T]]:
+        """
+        Returns the key of a downloaded image and its cached result, or
+        decode(data) if there is none, for fetch_images to run on its threads
+        """
+        key = self.key(data)
+        result = self.get(key)
+        if result is not None:
+            return key, result, None
+        return key, None, decode(data)
+
+    def put(self, key: Optional[str], result: dict):
+        if key is not None:
+            self.store.put(key, encode_result(result))
+
+
+def get_result_cache(model: str, blob_store) -> ResultCache:
+    """
+    Returns the cache of model configured by the RESULT_CACHE* environment
+    variables, see the module docstring
+    """
+    if not RESULT_CACHE:
+        return ResultCache(model, None)
+    stores: List[ResultStore] = [
+        MemoryResultStore(RESULT_CACHE_MEMORY_ITEMS),
+        DiskResultStore(RESULT_CACHE_DIR, RESULT_CACHE_DISK_BYTES),
+    ]
+    if RESULT_CACHE_URI:
+        stores.append(BlobResultStore(blob_store, RESULT_CACHE_URI))
+    return ResultCache(model, TieredResultStore(stores))
@@ -1,161 +1,196 @@
 import os
 import sys
-from datetime import datetime
-from pathlib import Path
-from typing import Tuple
+from concurrent.futures import Future
+from functools import partial
+from typing import List, Optional, Tuple
 
-import cv2  # type: ignore
-import exifread
-import matplotlib.pyplot as plt
+import numpy as np
 import torch
-from google.cloud import firestore, storage  # type: ignore
 from ts.torch_handler.base_handler import BaseHandler  # type: ignore
 
 sys.path.insert(0, "/home/model-server")
 
-from inference_utils import download_file, get_name_from_uri  # noqa: E402
+from admin_regions import get_admin_codes, get_admin_index  # noqa: E402
+from inference_backends import get_blob_store, get_document_store  # noqa: E402
+from inference_cache import get_model_version, get_result_cache  # noqa: E402
+from inference_postprocessing import get_is_crop  # noqa: E402
+from inference_precision import (  # noqa: E402
+    INFERENCE_PRECISION,
+    configure_threads,
+    prepare_model,
+    run_model,
+    warm_up,
+)
+from inference_preprocessing import CROPNOP_SIZE, read_cropnop_input  # noqa: E402
+from inference_sink import WriteBehindSink  # noqa: E402
+from inference_utils import (  # noqa: E402
+    BatchErrors,
+    fetch_images,
+    get_name_from_uri,
+    get_uris,
+    split_uri,
+)
+from instrumentation import request_context, timer  # noqa: E402
 
 os.environ["LRU_CACHE_CAPACITY"] = "1"
 
-storage_client = storage.Client()
-db = firestore.Client()
 DEST_BUCKET_NAME = os.environ.get("DEST_BUCKET_NAME", "street2sat-crops")
 device = "cuda" if torch.cuda.is_available() else "cpu"
-
-
-def _get_if_exist(data, key):
-    if key in data:
-        return data[key]
-    return None
-
-
-def _convert_to_degress(value):
-    """
-    Helper function to convert the GPS coordinates stored in the EXIF to degress in float format
-    :param value:
-    :type value: exifread.utils.Ratio
-    :rtype: float
-    """
-    d = float(value.values[0].num) / float(value.values[0].den)
-    m = float(value.values[1].num) / float(value.values[1].den)
-    s = float(value.values[2].num) / float(value.values[2].den)
-
-    return d + (m / 60.0) + (s / 3600.0)
-
-
-def get_exif_location(exif_data):
-    """
-    Returns the latitude and longitude, if available, from the provided exif_data (obtained through get_exif_data above)
-    """
-    gps_latitude = exif_data["GPS GPSLatitude"]
-    gps_latitude_ref = exif_data["GPS GPSLatitudeRef"]
-    gps_longitude = exif_data["GPS GPSLongitude"]
-    gps_longitude_ref = exif_data["GPS GPSLongitudeRef"]
-
-    lat = _convert_to_degress(gps_latitude)
-    if gps_latitude_ref.values[0] != "N":
-        lat = 0 - lat
-
-    lon = _convert_to_degress(gps_longitude)
-    if gps_longitude_ref.values[0] != "E":
-        lon = 0 - lon
-
-    return lat, lon
-
-
-def get_exif_datetime(exif_data):
-    date_time = _get_if_exist(exif_data, "Image DateTime")
-    dt = datetime.strptime(str(date_time), "%Y:%m:%d %H:%M:%S")
-    return dt
-
-
-def get_exif_focal_length(exif_data):
-    n = _get_if_exist(exif_data, "EXIF FocalLength")
-    return n.values[0].num
-
-
-def get_exif_image_height_width(exif_data):
-    w = _get_if_exist(exif_data, "EXIF ExifImageWidth")
-    h = _get_if_exist(exif_data, "EXIF ExifImageLength")
-    return h.values[0], w.values[0]
+# Cloud clients are only created by the backends on first use
+sink = WriteBehindSink(get_document_store(), get_blob_store())
+result_cache = get_result_cache("cropnop", get_blob_store())
 
 
 class ModelHandler(BaseHandler):
     """
     A custom model handler implementation.
+
+    Every request in a TorchServe batch is preprocessed, the images are
+    stacked into a single forward pass and one response is returned per
+    request, in request order. The batch's documents are committed
+    together and its crops copied concurrently. An image which could not
+    be read, written or copied fails its request (or its entry of a "uris"
+    request, see BatchErrors) without failing the rest of the batch.
+
+    Images whose content was already classified by the same model are not
+    decoded or run through it, their cached tags and is_crop are written
+    instead.
     """
 
-    def preprocess(self, data) -> Tuple[str, torch.Tensor, dict]:
+    def handle(self, data, context):
+        self.errors = BatchErrors(data, context)
+        with request_context("cropnop", batch_size=len(data)):
+            return super().handle(data, context)
+
+    def initialize(self, context):
+        # Logged as one JSON line with the seconds of every phase
+        with request_context("startup", handler="cropnop"):
+            configure_threads()
+            with timer("load_model"):
+                super().initialize(context)
+            self.model = prepare_model(self.model)
+            warm_up(self.model, (1, 3, *CROPNOP_SIZE), device=device)
+            with timer("load_admin_index"):
+                get_admin_index()
+            result_cache.version = get_model_version(
+                getattr(self, "model_pt_path", None), INFERENCE_PRECISION
+            )
+
+    def preprocess(self, data) -> Tuple[
+        List[int],
+        List[str],
+        Optional[torch.Tensor],
+        List[dict],
+        List[Optional[str]],
+        List[Optional[bool]],
+    ]:
+        """
+        Returns the index in the batch, uri, EXIF tags, cache key and cached
+        is_crop of every image which could be read, and the tensor of those
+        not cached
+        """
         print(data)
         print("HANDLER: Starting preprocessing")
-        try:
-            uri: str = next(q["uri"].decode() for q in data if "uri" in q)
-        except Exception:
-            raise ValueError("'uri' not found.")
-
-        local_path = download_file(storage_client, uri)
-
-        img_bytes = open(local_path, "rb")
-        tags = exifread.process_file(img_bytes)
-        img_bytes.close()
-        img_tags = {}
-        if tags != {}:
-            img_tags = {
-                "time": get_exif_datetime(tags),
-                "focal_length": get_exif_focal_length(tags),
-                "coord": get_exif_location(tags),
-                "pixel_height": get_exif_image_height_width(tags)[0],
-            }
-
-        img = plt.imread(local_path)
-        Path(local_path).unlink()
-        img = cv2.resize(img, (300, 300)) / 255
-        img = img.transpose(2, 0, 1).astype("float32")
-        img_tensor = torch.from_numpy(img).float().to(device)
-        return uri, img_tensor, img_tags
-
-    def inference(self, data, *args, **kwargs) -> Tuple[str, bool, dict]:
+        uris = get_uris(data)
+        fetched = fetch_images(
+            get_blob_store(),
+            uris,
+            decode=partial(result_cache.read, decode=read_cropnop_input),
+            return_exceptions=True,
+        )
+        indices, fetched = self.errors.split(list(range(len(uris))), fetched)
+
+        imgs, imgs_tags, keys = [], [], []
+        cached_is_crop: List[Optional[bool]] = []
+        for key, cached, decoded in fetched:
+            keys.append(key)
+            if cached is None:
+                img, img_tags = decoded
+                imgs.append(img)
+                imgs_tags.append(img_tags)
+                cached_is_crop.append(None)
+            else:
+                imgs_tags.append(cached["tags"])
+                cached_is_crop.append(cached["is_crop"])
+        print(f"HANDLER: Batch size {len(uris)}, {len(indices) - len(imgs)} cached")
+
+        img_tensor = torch.from_numpy(np.stack(imgs)).to(device) if imgs else None
+        uris = [uris[i] for i in indices]
+        return indices, uris, img_tensor, imgs_tags, keys, cached_is_crop
+
+    def inference(
+        self, data, *args, **kwargs
+    ) -> Tuple[List[int], List[str], List[bool], List[dict]]:
         print("HANDLER: Starting inference")
-        uri, img_tensor, img_tags = data
-        output = self.model(img_tensor.unsqueeze(0))
-        is_crop = (output <= 0).item()
+        indices, uris, img_tensor, imgs_tags, keys, is_crop = data
+        if img_tensor is not None:
+            with timer("forward"):
+                output = run_model(self.model, img_tensor)
+            computed = iter(get_is_crop(output))
+            for i, (key, img_tags) in enumerate(zip(keys, imgs_tags)):
+                if is_crop[i] is None:
+                    is_crop[i] = next(computed)
+                    result_cache.put(key, {"is_crop": is_crop[i], "tags": img_tags})
         print(f"HANDLER: is_crop {is_crop}")
-        return uri, is_crop, img_tags
+        return indices, uris, is_crop, imgs_tags
 
     def postprocess(self, data, *args, **kwargs):
         print("HANDLER: Starting postprocessing")
-        uri, is_crop, img_tags = data
-        resp = {"is_crop": is_crop, "uri": uri}
-
-        name = get_name_from_uri(uri)
-        save_to_db = {
-            "input_img": uri,
-            "name": name,
-            "is_crop": is_crop,
-            **img_tags,
-        }
-        save_to_db["results"] = None
+        indices, uris, is_crops, imgs_tags = data
 
         collection = "street2sat-v2"
-        print(f"HANDLER: Adding to collection: {collection}, document: {name}")
-        db.collection(collection).document(name).set(save_to_db)
-
-        resp = {
-            "input_img": uri,
-            "name": name,
-            "is_crop": is_crop,
-        }
-        if not is_crop:
-            return [resp]
-
-        uri_as_path = Path(uri)
-        src_bucket_name = uri_as_path.parts[1]
-        src_bucket = storage_client.get_bucket(src_bucket_name)
-        blob_name = "/".join(uri_as_path.parts[2:])
-        src_blob = src_bucket.blob(blob_name)
-
-        dest_bucket = storage_client.get_bucket(DEST_BUCKET_NAME)
-        src_bucket.copy_blob(src_blob, dest_bucket, blob_name)
-        resp["dest_uri"] = f"gs://{DEST_BUCKET_NAME}/{blob_name}"
-
-        return [resp]
+        with timer("admin_lookup"):
+            admin_codes = get_admin_codes([tags.get("coord") for tags in imgs_tags])
+        resps, writes = [], []
+        for uri, is_crop, img_tags, codes in zip(
+            uris, is_crops, imgs_tags, admin_codes
+        ):
+            name = get_name_from_uri(uri)
+            save_to_db = {
+                "input_img": uri,
+                "name": name,
+                "is_crop": is_crop,
+                **img_tags,
+                **codes,
+            }
+
+            # Merged, so resending an upload keeps the results segmentation
+            # already wrote to its document
+            print(f"HANDLER: Adding to collection: {collection}, document: {name}")
+            writes.append(sink.merge(collection, name, save_to_db))
+            resps.append(
+                {
+                    "input_img": uri,
+                    "name": name,
+                    "is_crop": is_crop,
+                }
+            )
+        with timer("db_write"):
+            sink.flush()
+
+        # Crops are only copied once their document exists, since the copy
+        # triggers segmentation which updates that document
+        copies = {}
+        for i, (uri, is_crop, write) in enumerate(zip(uris, is_crops, writes)):
+            if not self._succeeded(indices[i], write) or not is_crop:
+                continue
+            blob_name = split_uri(uri)[1]
+            dest_uri = f"gs://{DEST_BUCKET_NAME}/{blob_name}"
+            copies[i] = sink.copy(uri, dest_uri)
+            resps[i]["dest_uri"] = dest_uri
+        with timer("copy"):
+            for i, copy in copies.items():
+                self._succeeded(indices[i], copy)
+
+        return self.errors.respond(indices, resps)
+
+    def _succeeded(self, idx: int, future: Future) -> bool:
+        """
+        Waits for a write or copy of image idx of the batch, recording it as
+        failed if it raised
+        """
+        try:
+            return future.result()
+        except Exception as e:
+            self.errors.add(idx, e)
+            return False
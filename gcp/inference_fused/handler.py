@@ -0,0 +1,220 @@
+import os
+import sys
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from ts.torch_handler.base_handler import BaseHandler  # type: ignore
+
+sys.path.insert(0, "/home/model-server")
+
+from admin_regions import get_admin_codes, get_admin_index  # noqa: E402
+from inference_artifacts import (  # noqa: E402
+    ArtifactExporter,
+    encode_label_map,
+    get_labels_uri,
+    is_sampled,
+)
+from inference_backends import get_blob_store, get_document_store  # noqa: E402
+from inference_postprocessing import get_is_crop, get_segmentation_results  # noqa: E402
+from inference_precision import (  # noqa: E402
+    configure_threads,
+    prepare_model,
+    run_model,
+    warm_up,
+)
+from inference_preprocessing import (  # noqa: E402
+    CROPNOP_SIZE,
+    SEGMENTATION_SIZE,
+    gamma_correction,
+    read_cropnop_and_segmentation_input,
+    to_model_input,
+)
+from inference_sink import WriteBehindSink  # noqa: E402
+from inference_utils import (  # noqa: E402
+    BatchErrors,
+    fetch_images,
+    get_name_from_uri,
+    get_uris,
+)
+from instrumentation import request_context, timer  # noqa: E402
+
+os.environ["LRU_CACHE_CAPACITY"] = "1"
+
+SEGMENTATION_BUCKET_NAME = os.environ.get(
+    "SEGMENTATION_BUCKET_NAME", "street2sat-segmentations"
+)
+# Packaged with --extra-files, the cropnop model is the serialized file
+SEGMENTATION_MODEL_FILE = "segmentation.torchscript.pt"
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+sink = WriteBehindSink(get_document_store(), get_blob_store())
+exporter = ArtifactExporter(get_blob_store())
+
+
+class ModelHandler(BaseHandler):
+    """
+    Cropnop and segmentation in one process.
+
+    Every uploaded image is downloaded and decoded once, to the segmentation
+    input size; cropnop runs on a view downscaled from it and the crops
+    among the batch go through segmentation on the same pixels. Each image
+    gets a single document holding the EXIF tags, is_crop and the
+    segmentation results, so crops are not copied to street2sat-crops and
+    the segmentation service is not called. An image which could not be
+    read or written fails its request (or its entry of a "uris" request,
+    see BatchErrors) without failing the rest of the batch.
+    """
+
+    def handle(self, data, context):
+        self.errors = BatchErrors(data, context)
+        with request_context("fused", batch_size=len(data)):
+            return super().handle(data, context)
+
+    def initialize(self, context):
+        # Logged as one JSON line with the seconds of every phase
+        with request_context("startup", handler="fused"):
+            configure_threads()
+            with timer("load_model"):
+                super().initialize(context)
+                model_dir = context.system_properties.get("model_dir")
+                segmentation_model = torch.jit.load(
+                    os.path.join(model_dir, SEGMENTATION_MODEL_FILE),
+                    map_location=device,
+                )
+            self.model = prepare_model(self.model)
+            self.segmentation_model = prepare_model(segmentation_model)
+            warm_up(self.model, (1, 3, *CROPNOP_SIZE), device=device)
+            warm_up(self.segmentation_model, (1, 3, *SEGMENTATION_SIZE), device=device)
+            with timer("load_admin_index"):
+                get_admin_index()
+
+    def preprocess(
+        self, data
+    ) -> Tuple[
+        List[int], List[str], Optional[torch.Tensor], List[np.ndarray], List[dict]
+    ]:
+        """
+        Returns the index in the batch, uri, segmentation input and EXIF
+        tags of every image which could be read, and their cropnop tensor
+        """
+        print(data)
+        print("HANDLER: Starting preprocessing")
+        uris = get_uris(data)
+        print(f"HANDLER: Batch size {len(uris)}")
+
+        indices, cropnop_imgs, segmentation_imgs, imgs_tags = [], [], [], []
+        fetched = fetch_images(
+            get_blob_store(),
+            uris,
+            decode=read_cropnop_and_segmentation_input,
+            return_exceptions=True,
+        )
+        for i, (cropnop_img, segmentation_img, img_tags) in zip(
+            *self.errors.split(list(range(len(uris))), fetched)
+        ):
+            indices.append(i)
+            cropnop_imgs.append(cropnop_img)
+            segmentation_imgs.append(segmentation_img)
+            imgs_tags.append(img_tags)
+
+        img_tensor = None
+        if cropnop_imgs:
+            img_tensor = torch.from_numpy(np.stack(cropnop_imgs)).to(device)
+        uris = [uris[i] for i in indices]
+        return indices, uris, img_tensor, segmentation_imgs, imgs_tags
+
+    def inference(
+        self, data, *args, **kwargs
+    ) -> Tuple[
+        List[int], List[str], List[bool], List[Optional[np.ndarray]], List[dict]
+    ]:
+        print("HANDLER: Starting inference")
+        indices, uris, img_tensor, segmentation_imgs, imgs_tags = data
+        if img_tensor is None:
+            return indices, uris, [], [], imgs_tags
+        with timer("forward"):
+            is_crops = get_is_crop(run_model(self.model, img_tensor))
+        print(f"HANDLER: is_crop {is_crops}")
+
+        outputs: List[Optional[np.ndarray]] = [None] * len(uris)
+        crops = [i for i, is_crop in enumerate(is_crops) if is_crop]
+        if crops:
+            with timer("preprocess"):
+                batch = gamma_correction(
+                    to_model_input([segmentation_imgs[i] for i in crops], scale=1 / 255)
+                )
+            with timer("segmentation_forward"):
+                crop_outputs = (
+                    run_model(
+                        self.segmentation_model, torch.from_numpy(batch).to(device)
+                    )
+                    .cpu()
+                    .numpy()
+                )
+            for i, output in zip(crops, crop_outputs):
+                outputs[i] = output
+        return indices, uris, is_crops, outputs, imgs_tags
+
+    def postprocess(self, data, *args, **kwargs):
+        print("HANDLER: Starting postprocessing")
+        indices, uris, is_crops, outputs, imgs_tags = data
+
+        collection = "street2sat-v2"
+        with timer("admin_lookup"):
+            admin_codes = get_admin_codes([tags.get("coord") for tags in imgs_tags])
+        resps, writes = [], []
+        for uri, is_crop, output, img_tags, codes in zip(
+            uris, is_crops, outputs, imgs_tags, admin_codes
+        ):
+            name = get_name_from_uri(uri)
+            results = None if output is None else get_segmentation_results(output)
+            save_to_db = {
+                "input_img": uri,
+                "name": name,
+                "is_crop": is_crop,
+                **img_tags,
+                **codes,
+                "results": results,
+            }
+            if output is not None and is_sampled(name):
+                # Not referenced if the export queue was full and it was dropped
+                labels_uri = get_labels_uri(uri, SEGMENTATION_BUCKET_NAME)
+                export = exporter.submit(
+                    labels_uri,
+                    lambda output=output: encode_label_map(output),
+                    content_type="image/png",
+                )
+                if export is not None:
+                    save_to_db["segmentation_labels"] = labels_uri
+
+            # Merged, so resending an upload keeps the fields get_satellite_img
+            # and the satellite handler wrote to its document
+            print(f"HANDLER: Adding to collection: {collection}, document: {name}")
+            writes.append(sink.merge(collection, name, save_to_db))
+            resps.append(
+                {
+                    "input_img": uri,
+                    "name": name,
+                    "is_crop": is_crop,
+                    "results": results,
+                }
+            )
+        with timer("db_write"):
+            sink.flush()
+            for idx, write in zip(indices, writes):
+                self._succeeded(idx, write)
+
+        return self.errors.respond(indices, resps)
+
+    def _succeeded(self, idx: int, future: Future) -> bool:
+        """
+        Waits for the write of image idx of the batch, recording it as
+        failed if it raised
+        """
+        try:
+            return future.result()
+        except Exception as e:
+            self.errors.add(idx, e)
+            return False
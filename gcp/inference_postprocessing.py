@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional, Tuple
+
+import cv2  # type: ignore
+import numpy as np
+import web_mercator
+
+THRESHOLD = 0.5
+RADIUS = 5
+CLASSES = [
+    "background",
+    "banana",
+    "maize",
+    "rice",
+    "soybean",
+    "sugarcane",
+    "sunflower",
+    "tobacco",
+    "wheat",
+]
+
+
+def get_is_crop(output) -> List[bool]:
+    """
+    Returns whether every image of a batch of cropnop logits shows crops
+    """
+    return (output <= 0).reshape(len(output), -1)[:, 0].tolist()
+
+
+def get_segmentation_results(output: np.ndarray) -> Dict[str, float]:
+    """
+    Returns the fraction of the image each class covers in a (C, H, W) output
+    """
+    image_size = output.shape[1] * output.shape[2]
+    return {
+        crop: round(output[i].sum() / image_size, 4) for i, crop in enumerate(CLASSES)
+    }
+
+
+def get_segmentation_results_from_fractions(fractions: np.ndarray) -> Dict[str, float]:
+    """
+    Returns the (C,) fractions of the image each class covers by class name
+    """
+    return {crop: round(float(fractions[i]), 4) for i, crop in enumerate(CLASSES)}
+
+
+def get_largest_contour(pred: np.ndarray) -> np.ndarray:
+    """
+    Zeroes every pixel of pred outside the largest contour of pred > 0.5
+    """
+    pred_mask = (pred > 0.5).astype(np.uint8)
+    contours, _ = cv2.findContours(pred_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return pred
+    max_contour = max(contours, key=cv2.contourArea)
+    # Reuses the uint8 threshold mask instead of allocating a float64 one
+    pred_mask.fill(0)
+    cv2.fillPoly(pred_mask, pts=[max_contour], color=1)
+    return pred * pred_mask
+
+
+def get_new_mark_positions(preds: np.ndarray) -> np.ndarray:
+    """
+    Returns the (row, col) of the field point of every (H, W) prediction in
+    a (N, H, W) batch: of the pixels at least as bright as the median pixel
+    above THRESHOLD, the one closest to the centroid of the pixels above
+    THRESHOLD (ties go to the first in row-major order).
+
+    When no pixel is above THRESHOLD the (col, row) of the brightest pixel is
+    returned instead, as the original per-pixel implementation did.
+    """
+    n, h, w = preds.shape
+    rows = np.arange(h)
+    cols = np.arange(w)
+
+    above = preds > THRESHOLD
+    counts = above.sum(axis=(1, 2))
+    empty = counts == 0
+    safe_counts = np.where(empty, 1, counts)
+    row_centr = (above.sum(axis=2) @ rows) / safe_counts
+    col_centr = (above.sum(axis=1) @ cols) / safe_counts
+
+    # Squared distance to the centroid is separable into row and column terms
+    row_dist = (rows[None, :] - row_centr[:, None]) ** 2
+    col_dist = (cols[None, :] - col_centr[:, None]) ** 2
+    dist = row_dist[:, :, None] + col_dist[:, None, :]
+
+    # Medians in float64 so the >= comparison below matches the original exactly
+    med_vals = np.array(
+        [
+            np.median(pred[mask].astype(np.float64)) if count else np.inf
+            for pred, mask, count in zip(preds, above, counts)
+        ]
+    )
+    dist[preds < med_vals[:, None, None]] = np.inf
+    nearest = dist.reshape(n, -1).argmin(axis=1)
+    marks = np.stack(np.unravel_index(nearest, (h, w)), axis=1)
+
+    if empty.any():
+        brightest = preds[empty].reshape(empty.sum(), -1).argmax(axis=1)
+        marks[empty] = np.stack(np.unravel_index(brightest, (h, w)), axis=1)[:, ::-1]
+    return marks
+
+
+def mark_img(img: np.ndarray, mark_pos: Tuple[int, int]) -> np.ndarray:
+    """
+    Draws the brightest pixel (green) and the field point (red) on img
+    """
+    y, x = np.unravel_index(np.argmax(img), img.shape)
+    new_img = np.repeat(img[:, :, None], 3, axis=2)
+    cv2.circle(new_img, (int(x), int(y)), RADIUS, (0.0, 1.0, 0.0), -1)
+    y1, x1 = mark_pos
+    cv2.circle(new_img, (int(x1), int(y1)), RADIUS, (0.0, 0.0, 1.0), -1)
+    return new_img
+
+
+def get_field_points(preds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keeps the largest contour of every prediction in a (N, H, W) batch and
+    returns the masked predictions with the (x, y) field point of each
+    """
+    masked = np.stack([get_largest_contour(pred) for pred in preds])
+    marks = get_new_mark_positions(masked)
+    return masked, marks[:, ::-1]
+
+
+def get_window_origin(metadata: dict) -> Optional[Tuple[int, int]]:
+    """
+    Returns the global pixel of the top left corner of a satellite image
+    mosaicked around the photo, None for images of a single tile
+    """
+    if "window_x" not in metadata:
+        return None
+    return int(metadata["window_x"]), int(metadata["window_y"])
+
+
+def get_field_coords(
+    paths: List[str],
+    marks: np.ndarray,
+    origins: Optional[List[Optional[Tuple[int, int]]]] = None,
+) -> np.ndarray:
+    """
+    Converts the (x, y) field point on every satellite image
+    <tms>/<x>/<y>/<z>/<name>, upsampled 2x from its tile or from the window
+    at its origin, to a (latitude, longitude)
+    """
+    tile_xyz = np.array(
+        [path.split("/")[1:4] for path in paths], dtype=np.int64
+    ).reshape(-1, 3)
+    # CV2 image has origin (x=0, y=0) at top left
+    x1, y1 = web_mercator.tile_to_pixels(tile_xyz[:, 0], tile_xyz[:, 1])
+    for i, origin in enumerate(origins or []):
+        if origin is not None:
+            x1[i], y1[i] = origin
+
+    marks = np.asarray(marks, dtype=np.int64).reshape(-1, 2)
+    lat, lon = web_mercator.pixels_to_latlon(
+        x1 + marks[:, 0] // 2, y1 + marks[:, 1] // 2, tile_xyz[:, 2]
+    )
+    return np.stack([lat, lon], axis=1)
+
+
+def get_field_coord(
+    path: str, pred_x: int, pred_y: int, origin: Optional[Tuple[int, int]] = None
+) -> Tuple[float, float]:
+    """
+    Converts a field point on the satellite image <tms>/<x>/<y>/<z>/<name>,
+    upsampled 2x from its tile or from the window at origin, to a latitude
+    and longitude
+    """
+    lat, lon = get_field_coords([path], np.array([(pred_x, pred_y)]), [origin])[0]
+    return float(lat), float(lon)
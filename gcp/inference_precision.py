@@ -0,0 +1,126 @@
+"""
+Precision, threading and startup of the TorchScript models on CPU.
+
+INFERENCE_PRECISION selects how the models run:
+- float32: as exported (default)
+- bfloat16: under CPU autocast, outputs converted back to float32
+- int8: Linear layers dynamically quantized to int8 with quantize_dynamic_jit.
+  Convolutions stay float32, quantizing them statically needs the eager
+  models and calibration images, which are not deployed.
+
+Every forward pass runs under torch.inference_mode. INFERENCE_THREADS and
+INFERENCE_INTEROP_THREADS set torch's intra-op and inter-op thread counts.
+benchmarks/precision_agreement.py checks the outputs against float32.
+
+Models are frozen at load (INFERENCE_FREEZE=0 to keep them as exported),
+which inlines their weights as constants, and float32 ones also go through
+torch.jit.optimize_for_inference (conv/batchnorm folding, MKLDNN
+convolutions). warm_up then runs INFERENCE_WARM_UP forward passes so the
+first request does not pay for TorchScript profiling and optimizing the
+graph. benchmarks/startup.py times these phases.
+"""
+
+import os
+from typing import Optional, Sequence
+
+import torch
+from instrumentation import timer
+
+PRECISIONS = ("float32", "bfloat16", "int8")
+INFERENCE_PRECISION = os.environ.get("INFERENCE_PRECISION", "float32")
+INFERENCE_THREADS = os.environ.get("INFERENCE_THREADS")
+INFERENCE_INTEROP_THREADS = os.environ.get("INFERENCE_INTEROP_THREADS")
+INFERENCE_FREEZE = os.environ.get("INFERENCE_FREEZE", "1") == "1"
+# The profiling executor optimizes the graph on the second call
+INFERENCE_WARM_UP = int(os.environ.get("INFERENCE_WARM_UP", 2))
+
+if INFERENCE_PRECISION not in PRECISIONS:
+    raise ValueError(
+        f"INFERENCE_PRECISION must be one of {PRECISIONS}, got {INFERENCE_PRECISION}"
+    )
+
+
+def configure_threads(
+    threads: Optional[str] = INFERENCE_THREADS,
+    interop_threads: Optional[str] = INFERENCE_INTEROP_THREADS,
+):
+    if threads:
+        torch.set_num_threads(int(threads))
+    # Only possible before the first parallel work, so once per process
+    if interop_threads and torch.get_num_interop_threads() != int(interop_threads):
+        try:
+            torch.set_num_interop_threads(int(interop_threads))
+        except RuntimeError as e:
+            print(f"HANDLER: Inter-op threads left unchanged: {e}")
+
+
+def prepare_model(
+    model: torch.jit.ScriptModule,
+    precision: str = INFERENCE_PRECISION,
+    freeze: bool = INFERENCE_FREEZE,
+) -> torch.jit.ScriptModule:
+    """
+    Returns the model converted for precision, in eval mode and frozen if
+    freeze
+    """
+    model = model.eval()
+    if precision == "int8":
+        from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic_jit
+
+        with timer("quantize"):
+            model = quantize_dynamic_jit(model, {"": default_dynamic_qconfig})
+    if freeze:
+        with timer("freeze"):
+            model = freeze_model(model, optimize=precision == "float32")
+    return model
+
+
+def freeze_model(
+    model: torch.jit.ScriptModule, optimize: bool
+) -> torch.jit.ScriptModule:
+    """
+    Returns the model frozen and, if optimize, optimized for inference. The
+    optimizations rewrite float32 convolutions, so they are left out under
+    autocast and quantization. Models which cannot be frozen are returned
+    as they are.
+    """
+    try:
+        if optimize:
+            # Freezes the model first
+            return torch.jit.optimize_for_inference(model)
+        return torch.jit.freeze(model)
+    except RuntimeError as e:
+        print(f"HANDLER: Model left unfrozen: {e}")
+        return model
+
+
+def warm_up(
+    model: torch.jit.ScriptModule,
+    shape: Sequence[int],
+    precision: str = INFERENCE_PRECISION,
+    passes: int = INFERENCE_WARM_UP,
+    device: str = "cpu",
+):
+    """
+    Runs passes forward passes on a batch of zeros of shape, the serving
+    input shape
+    """
+    batch = torch.zeros(tuple(shape), device=device)
+    with timer("warm_up"):
+        for _ in range(passes):
+            run_model(model, batch, precision)
+
+
+def run_model(
+    model: torch.jit.ScriptModule,
+    batch: torch.Tensor,
+    precision: str = INFERENCE_PRECISION,
+) -> torch.Tensor:
+    """
+    Runs model on batch without autograd state, returning float32 outputs
+    """
+    with torch.inference_mode():
+        if precision == "bfloat16":
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                return model(batch).float()
+        return model(batch)
@@ -0,0 +1,234 @@
+import io
+import struct
+from datetime import datetime
+from typing import Optional, Sequence, Tuple, Union
+
+import cv2  # type: ignore
+import numpy as np
+
+CROPNOP_SIZE = (300, 300)
+SEGMENTATION_SIZE = (800, 800)
+
+# Start Of Frame markers carry the image height and width (C4, C8 and CC
+# share the range but are Huffman/arithmetic tables, not frames)
+SOF_MARKERS = {0xC0 + i for i in range(16)} - {0xC4, 0xC8, 0xCC}
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def _get_if_exist(data, key):
+    if key in data:
+        return data[key]
+    return None
+
+
+def _convert_to_degress(value):
+    """
+    Helper function to convert the GPS coordinates stored in the EXIF to degress in float format
+    :param value:
+    :type value: exifread.utils.Ratio
+    :rtype: float
+    """
+    d = float(value.values[0].num) / float(value.values[0].den)
+    m = float(value.values[1].num) / float(value.values[1].den)
+    s = float(value.values[2].num) / float(value.values[2].den)
+
+    return d + (m / 60.0) + (s / 3600.0)
+
+
+def get_exif_location(exif_data):
+    """
+    Returns the latitude and longitude, if available, from the provided exif_data (obtained through get_exif_data above)
+    """
+    gps_latitude = exif_data["GPS GPSLatitude"]
+    gps_latitude_ref = exif_data["GPS GPSLatitudeRef"]
+    gps_longitude = exif_data["GPS GPSLongitude"]
+    gps_longitude_ref = exif_data["GPS GPSLongitudeRef"]
+
+    lat = _convert_to_degress(gps_latitude)
+    if gps_latitude_ref.values[0] != "N":
+        lat = 0 - lat
+
+    lon = _convert_to_degress(gps_longitude)
+    if gps_longitude_ref.values[0] != "E":
+        lon = 0 - lon
+
+    return lat, lon
+
+
+def get_exif_datetime(exif_data):
+    date_time = _get_if_exist(exif_data, "Image DateTime")
+    dt = datetime.strptime(str(date_time), "%Y:%m:%d %H:%M:%S")
+    return dt
+
+
+def get_exif_focal_length(exif_data):
+    n = _get_if_exist(exif_data, "EXIF FocalLength")
+    return n.values[0].num
+
+
+def get_exif_image_height_width(exif_data):
+    w = _get_if_exist(exif_data, "EXIF ExifImageWidth")
+    h = _get_if_exist(exif_data, "EXIF ExifImageLength")
+    return h.values[0], w.values[0]
+
+
+def read_img_tags(data: bytes) -> dict:
+    """
+    Reads the EXIF tags stored in the database from an image held in memory
+    """
+    # Imported here, the segmentation and satellite handlers never read EXIF
+    import exifread
+
+    # details=False skips parsing the (large) GoPro MakerNote
+    tags = exifread.process_file(io.BytesIO(data), details=False)
+    if tags == {}:
+        return {}
+    return {
+        "time": get_exif_datetime(tags),
+        "focal_length": get_exif_focal_length(tags),
+        "coord": get_exif_location(tags),
+        "pixel_height": get_exif_image_height_width(tags)[0],
+    }
+
+
+def get_jpeg_height_width(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Returns the height and width from the SOF header of a JPEG without
+    decoding it, None if data is not a JPEG
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # Markers without a length
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            h, w = struct.unpack_from(">HH", data, i + 5)
+            return h, w
+        # Skips the segment, including APP1 which holds the EXIF thumbnail
+        i += 2 + struct.unpack_from(">H", data, i + 2)[0]
+    return None
+
+
+def get_reduction_factor(height: int, width: int, size: Tuple[int, int]) -> int:
+    """
+    Returns the largest JPEG DCT scaling factor which still decodes
+    to at least size (width, height)
+    """
+    for factor in (8, 4, 2):
+        if height // factor >= size[1] and width // factor >= size[0]:
+            return factor
+    return 1
+
+
+def decode_reduced(data: bytes, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Decodes an image held in memory to an RGB uint8 array of size (width, height).
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale in the DCT domain whenever that
+    is still larger than size, so full resolution pixels are never materialized.
+    """
+    height_width = get_jpeg_height_width(data)
+    factor = 1 if height_width is None else get_reduction_factor(*height_width, size)
+    flags = REDUCED_DECODE_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if img is None:
+        raise ValueError("HANDLER ERROR: image could not be decoded.")
+    img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def to_cropnop_input(img: np.ndarray) -> np.ndarray:
+    """
+    Converts a (300, 300, 3) RGB uint8 image to the (3, 300, 300) float32 cropnop input
+    """
+    img = img.astype(np.float32)
+    img *= 1 / 255
+    return np.ascontiguousarray(img.transpose(2, 0, 1))
+
+
+def read_cropnop_input(data: bytes) -> Tuple[np.ndarray, dict]:
+    """
+    Reads the EXIF tags and the (3, 300, 300) float32 cropnop model input
+    from a single in-memory buffer
+    """
+    return to_cropnop_input(decode_reduced(data, CROPNOP_SIZE)), read_img_tags(data)
+
+
+def read_cropnop_and_segmentation_input(
+    data: bytes,
+) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Decodes an image held in memory once to the (800, 800, 3) uint8
+    segmentation input and returns it with the cropnop input, downscaled
+    from it, and the EXIF tags
+    """
+    img = decode_reduced(data, SEGMENTATION_SIZE)
+    cropnop_img = cv2.resize(img, CROPNOP_SIZE, interpolation=cv2.INTER_AREA)
+    return to_cropnop_input(cropnop_img), img, read_img_tags(data)
+
+
+def read_segmentation_input(
+    data: bytes, size: Tuple[int, int] = SEGMENTATION_SIZE
+) -> np.ndarray:
+    """
+    Decodes an image held in memory to the (800, 800, 3) uint8 segmentation
+    input, or to another (width, height) for tiled segmentation
+    """
+    return decode_reduced(data, size)
+
+
+def to_model_input(
+    imgs: Union[np.ndarray, Sequence[np.ndarray]], scale: float = 1.0
+) -> np.ndarray:
+    """
+    Converts N (H, W, C) images into a (N, C, H, W) float32 batch multiplied by
+    scale, writing each image straight into the batch with no temporaries
+    """
+    n = len(imgs)
+    h, w, c = imgs[0].shape
+    batch = np.empty((n, c, h, w), dtype=np.float32)
+    for img, out in zip(imgs, batch):
+        np.multiply(img.transpose(2, 0, 1), np.float32(scale), out=out)
+    return batch
+
+
+def gamma_correction(batch: np.ndarray) -> np.ndarray:
+    """
+    Stretches every image of a float32 (N, ...) batch to (0, 1] and applies
+    the gamma which maps its mean log intensity to -1, in place.
+
+    Equivalent to the original float64 chain
+        img = 255 * (img - min) / (max - min + 0.1)
+        img = (img + 0.5) / 256
+        img = img ** (-1 / nanmean(log(img)))
+    but with a single min/max pass per image, img ** gamma computed as
+    exp(gamma * log(img)) to reuse the log, and no intermediate arrays.
+    """
+    if batch.dtype != np.float32 or not batch.flags.c_contiguous:
+        raise ValueError("Expecting a C contiguous float32 batch")
+    flat = batch.reshape(len(batch), -1)
+    lo_hi = np.array([cv2.minMaxLoc(img.reshape(1, -1))[:2] for img in flat])
+    lo, hi = lo_hi[:, 0], lo_hi[:, 1]
+    flat -= lo[:, None].astype(np.float32)
+    flat *= (255 / (256 * (hi - lo + 0.1)))[:, None].astype(np.float32)
+    flat += np.float32(0.5 / 256)
+    np.log(flat, out=flat)
+    # Every value is >= 0.5 / 256 here, so the log has no NaNs to skip
+    gamma = -1 / flat.mean(axis=1, dtype=np.float64)
+    flat *= gamma[:, None].astype(np.float32)
+    np.exp(flat, out=flat)
+    return batch
@@ -1,131 +1,252 @@
 import os
-import random
 import sys
-import tempfile
-from pathlib import Path
-from typing import Tuple
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-import matplotlib.pyplot as plt
 import numpy as np  # type: ignore
 import torch
-from google.cloud import firestore, storage  # type: ignore
-from skimage.io import imread
-from skimage.transform import resize
 from ts.torch_handler.base_handler import BaseHandler  # type: ignore
 
 sys.path.insert(0, "/home/model-server")
 
-from inference_utils import download_file, get_name_from_uri  # noqa: E402
+from inference_artifacts import (  # noqa: E402
+    ArtifactExporter,
+    encode_label_map,
+    get_labels_uri,
+    is_sampled,
+)
+from inference_backends import get_blob_store, get_document_store  # noqa: E402
+from inference_cache import get_model_version, get_result_cache  # noqa: E402
+from inference_postprocessing import (  # noqa: E402
+    CLASSES,
+    get_segmentation_results,
+    get_segmentation_results_from_fractions,
+)
+from inference_precision import (  # noqa: E402
+    INFERENCE_PRECISION,
+    configure_threads,
+    prepare_model,
+    run_model,
+    warm_up,
+)
+from inference_preprocessing import (  # noqa: E402
+    gamma_correction,
+    read_segmentation_input,
+    to_model_input,
+)
+from inference_tiling import segment_tiled  # noqa: E402
+from inference_utils import (  # noqa: E402
+    BatchErrors,
+    fetch_images,
+    get_name_from_uri,
+    get_uris,
+)
+from instrumentation import request_context, timer  # noqa: E402
 
 os.environ["LRU_CACHE_CAPACITY"] = "1"
-storage_client = storage.Client()
-db = firestore.Client()
 DEST_BUCKET_NAME = os.environ.get("DEST_BUCKET_NAME", "street2sat-segmentations")
-dest_bucket = storage_client.get_bucket(DEST_BUCKET_NAME)
-CLASSES = [
-    "background",
-    "banana",
-    "maize",
-    "rice",
-    "soybean",
-    "sugarcane",
-    "sunflower",
-    "tobacco",
-    "wheat",
-]
+# Side the images are resized to, larger than the tile in tiled mode
+SEGMENTATION_INPUT_SIZE = int(os.environ.get("SEGMENTATION_INPUT_SIZE", 800))
+# 0 runs every image through the model whole
+SEGMENTATION_TILE_SIZE = int(os.environ.get("SEGMENTATION_TILE_SIZE", 0))
+SEGMENTATION_TILE_OVERLAP = int(os.environ.get("SEGMENTATION_TILE_OVERLAP", 64))
+SEGMENTATION_TILE_BATCH = int(os.environ.get("SEGMENTATION_TILE_BATCH", 4))
+if SEGMENTATION_TILE_SIZE > SEGMENTATION_INPUT_SIZE:
+    raise ValueError("SEGMENTATION_TILE_SIZE must not exceed SEGMENTATION_INPUT_SIZE")
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+exporter = ArtifactExporter(get_blob_store())
+result_cache = get_result_cache("segmentation", get_blob_store())
+
 
 class ModelHandler(BaseHandler):
     """
     A custom model handler implementation.
+
+    With SEGMENTATION_TILE_SIZE set, images are segmented one at a time in
+    overlapping tiles of that size, SEGMENTATION_TILE_BATCH tiles per
+    forward pass, so the model's memory does not grow with
+    SEGMENTATION_INPUT_SIZE.
+
+    Images whose content was already segmented by the same model and
+    settings are not decoded or run through it, their cached results are
+    written instead (without a label map). An image which
+    could not be read or written fails its request (or its entry of a "uris" request,
+    see BatchErrors) without failing the rest of the batch.
     """
 
-    def preprocess(self, data) -> Tuple[str, torch.Tensor]:
+    def handle(self, data, context):
+        self.errors = BatchErrors(data, context)
+        with request_context("segmentation", batch_size=len(data)):
+            return super().handle(data, context)
+
+    def initialize(self, context):
+        # Logged as one JSON line with the seconds of every phase
+        with request_context("startup", handler="segmentation"):
+            configure_threads()
+            with timer("load_model"):
+                super().initialize(context)
+            self.model = prepare_model(self.model)
+            if SEGMENTATION_TILE_SIZE:
+                tile = (SEGMENTATION_TILE_SIZE, SEGMENTATION_TILE_SIZE)
+                warm_up(self.model, (SEGMENTATION_TILE_BATCH, 3, *tile), device=device)
+            else:
+                size = (SEGMENTATION_INPUT_SIZE, SEGMENTATION_INPUT_SIZE)
+                warm_up(self.model, (1, 3, *size), device=device)
+            result_cache.version = get_model_version(
+                getattr(self, "model_pt_path", None),
+                INFERENCE_PRECISION,
+                str(SEGMENTATION_INPUT_SIZE),
+                str(SEGMENTATION_TILE_SIZE),
+                str(SEGMENTATION_TILE_OVERLAP),
+            )
+
+    def preprocess(self, data) -> Tuple[
+        List[int],
+        List[str],
+        Union[torch.Tensor, List[np.ndarray], None],
+        List[Optional[str]],
+        List[Optional[dict]],
+    ]:
+        """
+        Returns the index in the batch, uri, cache key and cached result of
+        every image which could be read, and the model input of those not
+        cached
+        """
         print(data)
         print("HANDLER: Starting preprocessing")
-        try:
-            uri: str = next(q["uri"].decode() for q in data if "uri" in q)
-        except Exception:
-            raise ValueError("'uri' not found.")
-
-        local_path = download_file(storage_client, uri)
-
-        img = imread(local_path)
-        Path(local_path).unlink()
-        img = resize(img, (800, 800))
-        img = img.astype(float)
-        img = (
-            255 * (img - np.min(img[:])) / (np.max(img[:]) - np.min(img[:]) + 0.1)
-        ).astype(float)
-        img = (img + 0.5) / 256
-        gamma = -1 / np.nanmean(np.log(img))
-        img = img ** (gamma)
-        img = img.transpose(2, 0, 1).astype("float32")
-        img_tensor = torch.from_numpy(img).unsqueeze(0).to(device)
-
-        return uri, img_tensor
-
-    def inference(self, data, *args, **kwargs) -> Tuple[str, torch.Tensor]:
+        uris = get_uris(data)
+        size = (SEGMENTATION_INPUT_SIZE, SEGMENTATION_INPUT_SIZE)
+        fetched = fetch_images(
+            get_blob_store(),
+            uris,
+            decode=partial(
+                result_cache.read, decode=partial(read_segmentation_input, size=size)
+            ),
+            return_exceptions=True,
+        )
+        indices, fetched = self.errors.split(list(range(len(uris))), fetched)
+        keys = [key for key, _, _ in fetched]
+        cached = [result for _, result, _ in fetched]
+        imgs = [img for _, result, img in fetched if result is None]
+        print(f"HANDLER: Batch size {len(uris)}, {len(indices) - len(imgs)} cached")
+        uris = [uris[i] for i in indices]
+        if SEGMENTATION_TILE_SIZE or not imgs:
+            # Converted one image at a time by inference, if there are any
+            return indices, uris, imgs, keys, cached
+        # Pixels are scaled to [0, 1] first, as skimage's resize used to return
+        with timer("preprocess"):
+            batch = gamma_correction(to_model_input(imgs, scale=1 / 255))
+        img_tensor = torch.from_numpy(batch).to(device)
+
+        return indices, uris, img_tensor, keys, cached
+
+    def inference(
+        self, data, *args, **kwargs
+    ) -> Tuple[List[int], List[str], List[dict], List[Optional[np.ndarray]]]:
         print("HANDLER: Starting inference")
-        uri, img_tensor = data
-        output = self.model(img_tensor)[0].cpu().detach().numpy()
-        return uri, output
+        indices, uris, model_input, keys, cached = data
+        misses = [uri for uri, result in zip(uris, cached) if result is None]
+        computed_results: List[dict] = []
+        computed_outputs: List[Optional[np.ndarray]] = []
+        if misses and SEGMENTATION_TILE_SIZE:
+            computed_results, computed_outputs = self._inference_tiled(
+                misses, model_input
+            )
+        elif misses:
+            with timer("forward"):
+                computed_outputs = list(
+                    run_model(self.model, model_input).cpu().numpy()
+                )
+            computed_results = [
+                get_segmentation_results(output) for output in computed_outputs
+            ]
+
+        # Cached images have no model output, so no label map is exported
+        results: List[dict] = []
+        outputs: List[Optional[np.ndarray]] = []
+        computed = zip(computed_results, computed_outputs)
+        for key, result in zip(keys, cached):
+            if result is not None:
+                results.append(result["results"])
+                outputs.append(None)
+                continue
+            computed_result, output = next(computed)
+            result_cache.put(key, {"results": computed_result})
+            results.append(computed_result)
+            outputs.append(output)
+        return indices, uris, results, outputs
+
+    def _inference_tiled(
+        self, uris: List[str], imgs: List[np.ndarray]
+    ) -> Tuple[List[dict], List[Optional[np.ndarray]]]:
+        """
+        Returns the results of every image and its label map if it is sampled
+        """
+
+        def run(tiles: np.ndarray) -> np.ndarray:
+            tensor = torch.from_numpy(tiles).to(device)
+            return run_model(self.model, tensor).cpu().numpy()
+
+        results, label_maps = [], []
+        for uri, img in zip(uris, imgs):
+            with timer("preprocess"):
+                model_input = gamma_correction(to_model_input([img], scale=1 / 255))[0]
+            with timer("forward"):
+                fractions, labels = segment_tiled(
+                    run,
+                    model_input,
+                    SEGMENTATION_TILE_SIZE,
+                    SEGMENTATION_TILE_OVERLAP,
+                    SEGMENTATION_TILE_BATCH,
+                    with_labels=is_sampled(get_name_from_uri(uri)),
+                )
+            results.append(get_segmentation_results_from_fractions(fractions))
+            label_maps.append(labels)
+        return results, label_maps
 
     def postprocess(self, data, *args, **kwargs):
         print("HANDLER: Starting postprocessing")
-        uri, output = data
-
-        save_segmentation_images = random.random() < 0.01
-
-        results = {}
-        image_size = output.shape[1] * output.shape[2]
-
-        files_to_upload = []
-        for i, crop in enumerate(CLASSES):
-            results[crop] = round(output[i].sum() / image_size, 4)
+        indices, uris, results, outputs = data
+        kept, resps = [], []
+        for idx, uri, result, output in zip(indices, uris, results, outputs):
+            try:
+                resps.append(self._postprocess_one(uri, result, output))
+                kept.append(idx)
+            except Exception as e:
+                self.errors.add(idx, e)
+        return self.errors.respond(kept, resps)
+
+    def _postprocess_one(
+        self, uri: str, results: dict, output: Optional[np.ndarray]
+    ) -> dict:
+        """
+        output is the model output, or in tiled mode the label map, None
+        when the image is not sampled
+        """
+        name = get_name_from_uri(uri)
+        for crop in CLASSES:
             print(f"HANDLER: Segmentation {crop}: {results[crop]}")
-            if save_segmentation_images:
-                file_name = Path(tempfile.gettempdir()) / f"{crop}.png"
-                plt.imsave(file_name, output[i], cmap=plt.cm.gray)
-                files_to_upload.append(file_name)
-
-        uploaded_files_uri = []
-        uri_as_path = Path(uri)
-        if save_segmentation_images:
-            for i, file_name in enumerate(files_to_upload):
-                print(
-                    f"HANDLER: Uploading segmentation image {i+1}/{len(files_to_upload)}"
-                )
-                segment_uri = save_to_bucket(uri_as_path, file_name)
-                uploaded_files_uri.append(segment_uri)
-                file_name.unlink()
 
-        # Save result to firestore db
-        name = get_name_from_uri(uri)
-        save_to_db = {"results": results}
-        if save_segmentation_images:
-            save_to_db["segmentation_images"] = uploaded_files_uri
+        save_to_db: Dict[str, Any] = {"results": results}
+        if output is not None and is_sampled(name):
+            # Encoded and uploaded in the background, pixels index CLASSES.
+            # Not referenced if the export queue was full and it was dropped
+            labels_uri = get_labels_uri(uri, DEST_BUCKET_NAME)
+            export = exporter.submit(
+                labels_uri, lambda: encode_label_map(output), content_type="image/png"
+            )
+            if export is not None:
+                save_to_db["segmentation_labels"] = labels_uri
 
+        # Save result to firestore db
         collection = "street2sat-v2"
         print(f"HANDLER: Updating collection: {collection}, document: {name}")
-        db.collection(collection).document(name).update(save_to_db)
-
-        return [
-            {
-                "input_img": uri,
-                "name": name,
-                "results": results,
-            }
-        ]
-
-
-def save_to_bucket(uri_as_path: Path, local_dest_path: Path):
-    cloud_dest_parent = "/".join(uri_as_path.parts[2:-1])
-    cloud_dest_path_str = (
-        f"{cloud_dest_parent}/{uri_as_path.stem}/{local_dest_path.name}"
-    )
-    dest_blob = dest_bucket.blob(cloud_dest_path_str)
-    dest_blob.upload_from_filename(str(local_dest_path))
-    print(f"HANDLER: Uploaded to gs://{DEST_BUCKET_NAME}/{cloud_dest_path_str}")
-    return f"gs://{DEST_BUCKET_NAME}/{cloud_dest_path_str}"
+        with timer("db_write"):
+            get_document_store().update(collection, name, save_to_db)
+
+        return {
+            "input_img": uri,
+            "name": name,
+            "results": results,
+        }
@@ -0,0 +1,122 @@
+import atexit
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Tuple
+
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH_SIZE = 500
+
+
+class WriteBehindSink:
+    """
+    Groups document store (Firestore) writes into batched commits and copies
+    blobs on a thread pool. Every write and copy returns a Future which resolves to
+    True, or to the exception raised by its commit/copy, so callers can
+    report success per item.
+
+    Pending writes are committed when max_batch_size of them are queued,
+    when the oldest has waited max_delay seconds, on flush() and on close()
+    (registered to run at interpreter exit).
+    """
+
+    def __init__(
+        self,
+        document_store,
+        blob_store,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_delay: float = 1.0,
+        max_workers: int = 8,
+    ):
+        self.document_store = document_store
+        self.blob_store = blob_store
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self.max_delay = max_delay
+
+        self._pending: List[Tuple[str, str, str, dict, Future]] = []
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+        self._copy_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def set(self, collection: str, name: str, data: dict) -> Future:
+        return self._enqueue("set", collection, name, data)
+
+    def update(self, collection: str, name: str, data: dict) -> Future:
+        return self._enqueue("update", collection, name, data)
+
+    def merge(self, collection: str, name: str, data: dict) -> Future:
+        return self._enqueue("merge", collection, name, data)
+
+    def copy(self, src_uri: str, dest_uri: str) -> Future:
+        def copy():
+            self.blob_store.copy(src_uri, dest_uri)
+            return True
+
+        return self._copy_executor.submit(copy)
+
+    def flush(self):
+        """
+        Commits every pending write, in batches of at most max_batch_size
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        n = self.max_batch_size
+        while pending:
+            self._commit(pending[:n])
+            pending = pending[n:]
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self.flush()
+        self._copy_executor.shutdown(wait=True)
+
+    def _enqueue(self, op: str, collection: str, name: str, data: dict) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("WriteBehindSink is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((op, collection, name, data, future))
+            full = len(self._pending) >= self.max_batch_size
+            self._wake.notify()
+        if full:
+            self.flush()
+        return future
+
+    def _commit(self, writes: List[Tuple[str, str, str, dict, Future]]):
+        if not writes:
+            return
+        try:
+            # A commit is atomic, so its writes succeed or fail together
+            self.document_store.commit([write[:4] for write in writes])
+        except Exception as e:
+            print(f"HANDLER ERROR: Committing {len(writes)} writes failed: {e}")
+            for *_, future in writes:
+                future.set_exception(e)
+            return
+        print(f"HANDLER: Committed {len(writes)} writes")
+        for *_, future in writes:
+            future.set_result(True)
+
+    def _flush_periodically(self):
+        while True:
+            with self._lock:
+                while not self._closed:
+                    if not self._pending:
+                        self._wake.wait()
+                        continue
+                    remaining = self._oldest + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wake.wait(timeout=remaining)
+                if self._closed:
+                    return
+            self.flush()
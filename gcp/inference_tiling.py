@@ -0,0 +1,85 @@
+"""
+Segmentation of an image of any size in overlapping, fixed size tiles.
+
+Tiles are batched through the model and their per-class outputs blended
+with weights which fall off linearly across the overlap, so tiles meeting
+leave no seams. Only the class fractions, and a label map when asked for,
+are accumulated: besides the image itself, memory depends on the tile size
+and batch, not on the image size.
+"""
+
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+def get_tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """
+    Returns the start of every tile along an axis of length, the last one
+    flush with its end
+    """
+    if length < tile_size:
+        raise ValueError(f"Image side {length} is smaller than the tile {tile_size}")
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"Overlap {overlap} must be in [0, {tile_size})")
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    starts.append(length - tile_size)
+    return starts
+
+
+def get_blend_weights(tile_size: int, overlap: int) -> np.ndarray:
+    """
+    Returns (tile_size, tile_size) weights rising linearly over the overlap
+    from the edges of a tile, 1 inside
+    """
+    distance = np.minimum(np.arange(tile_size), np.arange(tile_size)[::-1]) + 1
+    ramp = np.minimum(distance / (overlap + 1), 1).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+def segment_tiled(
+    run: Callable[[np.ndarray], np.ndarray],
+    img: np.ndarray,
+    tile_size: int,
+    overlap: int,
+    batch_size: int,
+    with_labels: bool = False,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Runs a (C, H, W) model input through run, which maps (N, C, tile_size,
+    tile_size) inputs to (N, K, tile_size, tile_size) per-class outputs,
+    batch_size tiles at a time.
+
+    Returns the (K,) fraction of the image each class covers and, if
+    with_labels, the (H, W) uint8 index of the most likely class of every
+    pixel, taken from the tile whose center is closest.
+    """
+    _, height, width = img.shape
+    weights = get_blend_weights(tile_size, overlap)
+    corners = [
+        (y, x)
+        for y in get_tile_starts(height, tile_size, overlap)
+        for x in get_tile_starts(width, tile_size, overlap)
+    ]
+    windows = [(slice(y, y + tile_size), slice(x, x + tile_size)) for y, x in corners]
+
+    total_weights = np.zeros((height, width), dtype=np.float32)
+    for window in windows:
+        total_weights[window] += weights
+
+    sums = np.zeros(0, dtype=np.float64)
+    labels = np.zeros((height, width), dtype=np.uint8) if with_labels else None
+    best_weights = np.zeros((height, width), dtype=np.float32) if with_labels else None
+    for start in range(0, len(windows), batch_size):
+        batch_windows = windows[slice(start, start + batch_size)]
+        tiles = np.stack([img[(slice(None),) + window] for window in batch_windows])
+        for window, output in zip(batch_windows, run(tiles)):
+            # Every pixel's weights over the tiles covering it sum to 1
+            share = weights / total_weights[window]
+            tile_sums = (output * share).reshape(len(output), -1).sum(axis=1)
+            sums = tile_sums if len(sums) == 0 else sums + tile_sums
+            if with_labels:
+                closer = weights > best_weights[window]
+                labels[window][closer] = output.argmax(axis=0)[closer]
+                best_weights[window][closer] = weights[closer]
+    return sums / (height * width), labels
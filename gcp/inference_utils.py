@@ -1,8 +1,21 @@
-import tempfile
+import json
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Tuple, TypeVar
 
-temp_dir = tempfile.gettempdir()
+import cv2  # type: ignore
+import numpy as np
+from instrumentation import count, in_context, timer
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Threads shared by every batch so network I/O and decoding of one image
+# overlap with those of the others (cv2 releases the GIL while decoding).
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 8))
+_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
 
 
 def get_name_from_uri(uri: str) -> str:
@@ -10,29 +23,200 @@ def get_name_from_uri(uri: str) -> str:
     return "-".join(uri_as_path.parts[2:-1]) + "-" + uri_as_path.stem
 
 
-def download_file(storage_client, uri: str) -> str:
+def _get_body(request) -> dict:
+    """
+    Returns the fields of a TorchServe request, sent as a form or as JSON
+    """
+    body = request.get("body", request)
+    if isinstance(body, (bytes, bytearray)):
+        body = json.loads(body)
+    return body
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, (bytes, bytearray)) else value
+
+
+def get_request_uris(request, i: int = 0) -> List[str]:
+    """
+    Returns the uris of a request with either a "uri" or a list of "uris"
+    """
+    body = _get_body(request)
+    if "uris" in body:
+        uris = _decode(body["uris"])
+        if isinstance(uris, str):  # A form field holding a JSON list
+            uris = json.loads(uris)
+        return [_decode(uri) for uri in uris]
+    if "uri" not in body:
+        raise ValueError(f"'uri' not found in request {i}.")
+    return [_decode(body["uri"])]
+
+
+def get_uris(data) -> List[str]:
+    """
+    Returns the uris of every request in a TorchServe batch, in request order
+    """
+    return [uri for i, q in enumerate(data) for uri in get_request_uris(q, i)]
+
+
+def get_request_indices(data) -> List[int]:
+    """
+    Returns the index of the request each of get_uris(data) comes from
+    """
+    return [i for i, q in enumerate(data) for _ in get_request_uris(q, i)]
+
+
+def group_responses(data, resps: List[Any]) -> List[Any]:
+    """
+    Returns one response per request from the responses to get_uris(data):
+    a list of responses for requests with "uris", the response otherwise
+    """
+    grouped: List[Any] = []
+    resps_iter = iter(resps)
+    for i, q in enumerate(data):
+        request_resps = [next(resps_iter) for _ in get_request_uris(q, i)]
+        grouped.append(request_resps if "uris" in _get_body(q) else request_resps[0])
+    return grouped
+
+
+class BatchErrors:
+    """
+    The images of a TorchServe batch which failed, by their index in
+    get_uris(data), so the rest of the batch is still served. A request
+    with a "uri" which failed gets a 500 status. A request with "uris" gets
+    its list of responses, {"input_img": uri, "error": ...} for the images
+    which failed, so only those need to be sent again.
+    """
+
+    def __init__(self, data, context):
+        self.data = data
+        self.context = context
+        self.uris = get_uris(data)
+        self.request_indices = get_request_indices(data)
+        self.errors: Dict[int, str] = {}
+
+    def __contains__(self, idx: int) -> bool:
+        return idx in self.errors
+
+    def add(self, idx: int, error: Exception):
+        print(f"HANDLER ERROR: {self.uris[idx]} failed: {error}")
+        count("image_errors")
+        self.errors[idx] = str(error)
+
+    def split(self, indices: List[int], results: List[Any]) -> Tuple[List[int], List]:
+        """
+        Records the exceptions among the results of the images at indices
+        and returns the indices and results of the others
+        """
+        kept, kept_results = [], []
+        for idx, result in zip(indices, results):
+            if isinstance(result, Exception):
+                self.add(idx, result)
+            else:
+                kept.append(idx)
+                kept_results.append(result)
+        return kept, kept_results
+
+    def respond(self, indices: List[int], resps: List[Any]) -> List[Any]:
+        """
+        Returns one response per request from the responses to the images
+        at indices, setting the status of the requests which failed
+        """
+        all_resps: List[Any] = [None] * len(self.uris)
+        for idx, resp in zip(indices, resps):
+            all_resps[idx] = resp
+        for idx, error in self.errors.items():
+            all_resps[idx] = {"input_img": self.uris[idx], "error": error}
+            request_idx = self.request_indices[idx]
+            if "uris" not in _get_body(self.data[request_idx]):
+                self.context.set_response_status(
+                    code=500, phrase=error, idx=request_idx
+                )
+        return group_responses(self.data, all_resps)
+
+
+def split_uri(uri: str) -> Tuple[str, str]:
     """
-    Downloads file from Google Cloud Bucket
+    Splits gs://<bucket>/<blob name> into the bucket and blob name
     """
     uri_as_path = Path(uri)
-    bucket_name = uri_as_path.parts[1]
-    file_name = "/".join(uri_as_path.parts[2:])
-    bucket = storage_client.bucket(bucket_name)
-    retries = 3
-    blob = bucket.blob(file_name)
+    return uri_as_path.parts[1], "/".join(uri_as_path.parts[2:])
+
+
+def download_bytes(
+    blob_store, uri: str, retries: int = 3, backoff: float = 1.0
+) -> bytes:
+    """
+    Downloads file from the blob store (Google Cloud Bucket) straight into memory.
+    The object may not be visible yet right after the upload event fired,
+    so a 404 is retried with exponential backoff (1s, 2s, 4s by default).
+    """
     for i in range(retries + 1):
-        if blob.exists():
-            print(f"HANDLER: Verified {uri} exists.")
-            break
-        if i == retries:
-            raise ValueError(f"HANDLER ERROR: {uri} does not exist.")
-        msg = f"HANDLER: {uri} doesn't exist, sleeping for 5 seconds and retrying."
-        print(msg)
-        time.sleep(5)
-    local_path = f"{temp_dir}/{uri_as_path.name}"
-    blob.download_to_filename(local_path)
-    if not Path(local_path).exists():
-        msg = f"HANDLER: {uri} from storage was not downloaded"
-        raise FileExistsError(msg)
-    print(f"HANDLER: Verified file downloaded to {local_path}")
-    return local_path
+        try:
+            with timer("download"):
+                data = blob_store.read(uri)
+        except FileNotFoundError:
+            if i == retries:
+                raise ValueError(f"HANDLER ERROR: {uri} does not exist.")
+            delay = backoff * 2**i
+            print(f"HANDLER: {uri} doesn't exist, retrying in {delay} seconds.")
+            count("download_retries")
+            time.sleep(delay)
+            continue
+        print(f"HANDLER: Downloaded {uri} ({len(data)} bytes)")
+        return data
+    raise ValueError(f"HANDLER ERROR: {uri} does not exist.")
+
+
+def decode_image(data: bytes, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    """
+    Decodes an encoded image held in memory to an RGB uint8 array.
+    Like the matplotlib/skimage readers it replaces, EXIF orientation is ignored.
+    """
+    flags |= cv2.IMREAD_IGNORE_ORIENTATION
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if img is None:
+        raise ValueError("HANDLER ERROR: image could not be decoded.")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def run_concurrently(
+    fn: Callable[[T], R], items: Iterable[T], return_exceptions: bool = False
+) -> List[Any]:
+    """
+    Applies fn to every item on the shared fetch threads, results in order.
+    With return_exceptions, the exception an item raised is its result
+    instead of failing every other item.
+    """
+    if return_exceptions:
+        fn = _returning_exceptions(fn)
+    return list(_executor.map(in_context(fn), items))
+
+
+def _returning_exceptions(fn: Callable[[T], R]) -> Callable[[T], Any]:
+    def call(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            return e
+
+    return call
+
+
+def fetch_images(
+    blob_store,
+    uris: List[str],
+    decode: Callable[[bytes], R] = decode_image,  # type: ignore
+    return_exceptions: bool = False,
+) -> List[Any]:
+    """
+    Downloads and decodes every uri concurrently, results in uri order, see
+    run_concurrently for return_exceptions
+    """
+
+    def fetch(uri):
+        data = download_bytes(blob_store, uri)
+        with timer("decode"):
+            return decode(data)
+
+    return run_concurrently(fetch, uris, return_exceptions)
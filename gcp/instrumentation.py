@@ -0,0 +1,231 @@
+"""
+Per-stage timings, counters and histograms for the handlers and functions.
+
+    with request_context("cropnop", batch_size=4):
+        with timer("download"):
+            ...
+
+Every request_context logs one JSON line with the total seconds spent in
+each stage by the request, its duration and the peak RSS of the process.
+Stage durations and counters are also kept in process wide histograms,
+exported with to_openmetrics() or to_json() and logged at exit.
+
+Work submitted to other threads is attributed to the current request when
+wrapped with in_context (run_concurrently does this).
+"""
+
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+# Seconds, from a cached tile to a segmentation forward pass on CPU
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_PREFIX = "street2sat"
+LOG_METRICS_AT_EXIT = os.environ.get("LOG_METRICS_AT_EXIT", "1") == "1"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def get_peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Process wide counters and histograms keyed by name and labels
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def to_openmetrics(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+                for (key_name, labels), value in sorted(self.counters.items()):
+                    if key_name == name:
+                        lines.append(
+                            f"{METRICS_PREFIX}_{name}_total{_format(labels)} {value}"
+                        )
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} histogram")
+                for (key_name, labels), hist in sorted(
+                    self.histograms.items(), key=lambda item: item[0]
+                ):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(hist.buckets + ("+Inf",), hist.counts):
+                        cumulative += n
+                        bucket_labels = labels + (("le", str(bound)),)
+                        lines.append(
+                            f"{METRICS_PREFIX}_{name}_bucket{_format(bucket_labels)} {cumulative}"
+                        )
+                    lines.append(
+                        f"{METRICS_PREFIX}_{name}_count{_format(labels)} {hist.count}"
+                    )
+                    lines.append(
+                        f"{METRICS_PREFIX}_{name}_sum{_format(labels)} {hist.sum}"
+                    )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": hist.count,
+                        "sum": hist.sum,
+                        "buckets": dict(
+                            zip(map(str, hist.buckets + ("+Inf",)), hist.counts)
+                        ),
+                    }
+                    for (name, labels), hist in sorted(
+                        self.histograms.items(), key=lambda item: item[0]
+                    )
+                ],
+            }
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class RequestTimings:
+    def __init__(self, kind: str, fields: dict):
+        self.kind = kind
+        self.fields = fields
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+metrics = Metrics()
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request", default=None)
+
+
+@contextmanager
+def request_context(kind: str, **fields) -> Iterator[RequestTimings]:
+    """
+    Attributes the stages timed inside to one request, logged as JSON at exit
+    """
+    timings = RequestTimings(kind, fields)
+    token = _current.set(timings)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        yield timings
+        status = "ok"
+    finally:
+        seconds = time.perf_counter() - start
+        _current.reset(token)
+        metrics.observe("request_seconds", seconds, kind=kind)
+        metrics.count("requests", kind=kind, status=status)
+        record = {
+            "metric": "request",
+            "kind": kind,
+            **timings.fields,
+            "status": status,
+            "seconds": round(seconds, 6),
+            "stages": {k: round(v, 6) for k, v in timings.stages.items()},
+            "peak_rss_bytes": get_peak_rss_bytes(),
+        }
+        print(json.dumps(record, default=str))
+
+
+@contextmanager
+def timer(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        timings = _current.get()
+        kind = timings.kind if timings is not None else "none"
+        metrics.observe("stage_seconds", seconds, kind=kind, stage=stage)
+        if timings is not None:
+            timings.add(stage, seconds)
+
+
+def count(name: str, value: float = 1, **labels):
+    metrics.count(name, value, **labels)
+
+
+def set_field(key: str, value):
+    """
+    Adds a field to the JSON line of the current request
+    """
+    timings = _current.get()
+    if timings is not None:
+        timings.fields[key] = value
+
+
+def in_context(fn: Callable) -> Callable:
+    """
+    Returns fn bound to a copy of the current context, for thread pools
+    """
+    context = copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def _log_metrics():
+    if metrics.counters or metrics.histograms:
+        print(json.dumps({"metric": "summary", **metrics.to_json()}))
+
+
+if LOG_METRICS_AT_EXIT:
+    atexit.register(_log_metrics)
@@ -0,0 +1,15 @@
+import os
+import sys
+from pathlib import Path
+
+# Before the handlers create their stores and the instrumentation registers its exit log
+os.environ.setdefault("STREET2SAT_BACKEND", "memory")
+os.environ.setdefault("LOG_METRICS_AT_EXIT", "0")
+
+# The modules under test and the reference implementations kept in the
+# benchmarks are imported as top level modules, as the handlers and the
+# get_satellite_img function do
+GCP_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(GCP_DIR / "benchmarks"))
+sys.path.insert(0, str(GCP_DIR / "get_satellite_img"))
+sys.path.insert(0, str(GCP_DIR))
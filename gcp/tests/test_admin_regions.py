@@ -0,0 +1,46 @@
+import json
+
+import numpy as np
+import pytest
+from admin_lookup import BOUNDS, make_tiling, scan
+from admin_regions import AdminIndex, load_admin_index, read_polygons
+
+
+@pytest.fixture(scope="module")
+def boundaries(tmp_path_factory):
+    path = tmp_path_factory.mktemp("admin") / "gaul_level2.geojson"
+    path.write_text(json.dumps(make_tiling(20, 10, 0)))
+    return path
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    west, south, east, north = BOUNDS
+    # Some points fall outside every polygon, or have no coordinates
+    lat = rng.uniform(south - 0.5, north + 0.5, 300)
+    lon = rng.uniform(west - 0.5, east + 0.5, 300)
+    lat[::50] = np.nan
+    return lat, lon
+
+
+def test_index_matches_scan(boundaries, points):
+    lat, lon = points
+    rings, codes = read_polygons(boundaries)
+
+    result = load_admin_index(boundaries, 0.1).lookup(lat, lon)
+
+    finite = np.flatnonzero(np.isfinite(lat))
+    expected = [scan(rings, codes, lon[i], lat[i]) for i in finite]
+    np.testing.assert_array_equal(result[finite, 2], expected)
+    assert (result[np.isnan(lat)] == -1).all()
+
+
+def test_cached_index_matches_built_index(boundaries, points, tmp_path):
+    lat, lon = points
+    index = load_admin_index(boundaries, 0.1)
+    index.save(tmp_path / "index.npz")
+
+    cached = AdminIndex.load(tmp_path / "index.npz")
+
+    np.testing.assert_array_equal(cached.lookup(lat, lon), index.lookup(lat, lon))
@@ -0,0 +1,63 @@
+import argparse
+
+import pytest
+
+pytest.importorskip("torch")
+# The stand-in models live in the handlers benchmark, which imports the handlers
+pytest.importorskip("ts")
+
+from bulk_inference import MODELS, Pipeline  # noqa: E402
+from cropnop_preprocessing import synthetic_jpeg  # noqa: E402
+from handlers import (  # noqa: E402
+    SATELLITE_SIZE,
+    CropnopModel,
+    SatelliteModel,
+    SegmentationModel,
+    to_torchscript,
+)
+from inference_postprocessing import CLASSES  # noqa: E402
+
+UPLOADS = "street2sat-uploaded/test"
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    models = {
+        "cropnop": to_torchscript(CropnopModel(), 300),
+        "segmentation": to_torchscript(SegmentationModel(len(CLASSES)), 800),
+        "satellite": to_torchscript(SatelliteModel(), SATELLITE_SIZE),
+    }
+    for model in MODELS:
+        (tmp_path / "models" / model).mkdir(parents=True)
+        models[model].save(
+            str(tmp_path / "models" / model / "best_model.torchscript.pt")
+        )
+
+    (tmp_path / "gcs" / UPLOADS).mkdir(parents=True)
+    for i in range(3):
+        (tmp_path / "gcs" / UPLOADS / f"frame_{i}.jpg").write_bytes(
+            synthetic_jpeg(600, 800, seed=i)
+        )
+    (tmp_path / "gcs" / UPLOADS / "broken.jpg").write_bytes(b"not a jpeg")
+
+    args = argparse.Namespace(
+        local_root=str(tmp_path / "gcs"), precision="float32", tms=["mapbox"]
+    )
+    return Pipeline(str(tmp_path / "models"), args)
+
+
+def test_pipeline_over_local_blob_store(pipeline):
+    uris = [f"gs://{UPLOADS}/{name}.jpg" for name in ["frame_0", "broken", "frame_1"]]
+
+    records = pipeline(uris)
+
+    assert [record["input_img"] for record in records] == uris
+    assert "error" in records[1]
+    for record in [records[0], records[2]]:
+        assert "error" not in record
+        assert record["name"] in ["frame_0", "frame_1"]
+        assert isinstance(record["is_crop"], bool)
+        if record["is_crop"]:
+            assert set(record["results"]) <= set(CLASSES)
+        else:
+            assert record["results"] is None
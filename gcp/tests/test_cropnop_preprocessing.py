@@ -0,0 +1,38 @@
+import io
+
+import cv2  # type: ignore
+import numpy as np
+import pytest
+from cropnop_preprocessing import synthetic_jpeg
+from inference_preprocessing import (
+    CROPNOP_SIZE,
+    decode_reduced,
+    read_cropnop_and_segmentation_input,
+    to_model_input,
+)
+
+plt = pytest.importorskip("matplotlib.pyplot")
+
+
+def original_cropnop_input(data: bytes) -> np.ndarray:
+    """
+    The cropnop handler's preprocessing before the reduced decode
+    """
+    img = plt.imread(io.BytesIO(data), format="jpeg")
+    img = cv2.resize(img, (300, 300)) / 255
+    return img.transpose(2, 0, 1).astype("float32")
+
+
+# Decoded at 1/4 scale, and at full scale
+@pytest.mark.parametrize("height, width", [(1200, 1600), (480, 640)])
+def test_reduced_decode_stays_close_to_original(height, width):
+    data = synthetic_jpeg(height, width)
+    original = original_cropnop_input(data)
+
+    for new in [
+        to_model_input([decode_reduced(data, CROPNOP_SIZE)], scale=1 / 255)[0],
+        read_cropnop_and_segmentation_input(data)[0],
+    ]:
+        diff = np.abs(new - original)
+        assert diff.mean() < 0.01
+        assert diff.max() < 0.08
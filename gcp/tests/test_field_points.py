@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+from inference_postprocessing import get_field_points
+
+from field_points import original_field_points, synthetic_predictions
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_field_points_match_original(seed):
+    preds = synthetic_predictions(8, seed=seed)
+
+    _, marks = get_field_points(preds)
+
+    np.testing.assert_array_equal(marks, original_field_points(preds))
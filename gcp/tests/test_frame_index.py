@@ -0,0 +1,42 @@
+from frame_index import FrameIndex
+
+COORD = (0.5, 36.5)
+
+
+def test_neighbor_window_is_not_loaded():
+    index = FrameIndex()
+    # Loading A's window at t=110 brings in B at t=100
+    index.add_docs(
+        [
+            {"name": "a", "time": "2020-06-24T10:01:50", "coord": COORD},
+            {"name": "b", "time": "2020-06-24T10:01:40", "coord": COORD},
+        ]
+    )
+    index.mark_loaded("2020-06-24T10:01:40", "2020-06-24T10:02:00")
+
+    assert "b" in index
+    assert index.is_loaded("2020-06-24T10:01:40", "2020-06-24T10:02:00")
+    assert not index.is_loaded("2020-06-24T10:01:30", "2020-06-24T10:01:50")
+
+
+def test_evict_forgets_the_oldest_loaded_windows():
+    index = FrameIndex()
+    for hour in range(10, 13):
+        index.add_docs(
+            {
+                "name": f"{hour}-{second}",
+                "time": f"2020-06-24T{hour}:00:{second:02}",
+                "coord": COORD,
+            }
+            for second in range(0, 20, 5)
+        )
+        index.mark_loaded(f"2020-06-24T{hour}:00:00", f"2020-06-24T{hour}:00:20")
+
+    index.evict(max_frames=8)
+
+    assert len(index) == 8
+    assert "10-0" not in index
+    assert "11-0" in index and "12-0" in index
+    assert len(index.within(*COORD, 10)) == 8
+    assert not index.is_loaded("2020-06-24T10:00:00", "2020-06-24T10:00:20")
+    assert index.is_loaded("2020-06-24T12:00:00", "2020-06-24T12:00:20")
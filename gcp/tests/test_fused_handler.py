@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("ts")
+
+from handlers import COLLECTION, UPLOAD_BUCKET, Context  # noqa: E402
+from inference_backends import get_document_store  # noqa: E402
+from inference_fused.handler import ModelHandler  # noqa: E402
+from inference_postprocessing import CLASSES  # noqa: E402
+from inference_utils import BatchErrors  # noqa: E402
+
+
+def test_postprocess_keeps_satellite_fields():
+    uri = f"gs://{UPLOAD_BUCKET}/test/frame.jpg"
+    document_store = get_document_store()
+    document_store.set(
+        COLLECTION,
+        "frame",
+        {"input_img": uri, "mapbox_field_coord": (0.5, 36.5), "mapbox_added_arrow": 1},
+    )
+    data = [{"uri": uri}]
+    handler = ModelHandler()
+    handler.context = Context()
+    handler.errors = BatchErrors(data, handler.context)
+    output = np.full((len(CLASSES), 8, 8), 1 / len(CLASSES), dtype=np.float32)
+
+    resps = handler.postprocess(([0], [uri], [True], [output], [{}]))
+
+    assert "error" not in resps[0]
+    doc = document_store.get(COLLECTION, "frame")
+    assert doc["is_crop"] is True
+    assert doc["results"] is not None
+    assert doc["mapbox_field_coord"] == (0.5, 36.5)
+    assert doc["mapbox_added_arrow"] == 1
@@ -0,0 +1,45 @@
+import cv2  # type: ignore
+import numpy as np
+from gamma_correction import (
+    new_satellite,
+    new_segmentation,
+    original_satellite,
+    original_segmentation,
+)
+
+
+def frames(count, shape=(600, 800, 3)):
+    rng = np.random.default_rng(0)
+    return [
+        cv2.GaussianBlur(rng.integers(0, 256, shape, dtype=np.uint8), (5, 5), 0)
+        for _ in range(count)
+    ]
+
+
+def test_satellite_gamma_correction_matches_original():
+    rng = np.random.default_rng(0)
+    tiles = [rng.integers(0, 256, (512, 512, 3), dtype=np.uint8) for _ in range(4)]
+
+    # The satellite path only changes the kernel, so it must match closely
+    np.testing.assert_allclose(
+        new_satellite(tiles), original_satellite(tiles), rtol=0, atol=1e-4
+    )
+
+
+def test_segmentation_input_stays_close_to_original():
+    imgs = frames(2)
+
+    # skimage's resize and float64 against INTER_AREA and float32
+    diff = np.abs(new_segmentation(imgs) - original_segmentation(imgs))
+
+    assert diff.mean() < 0.01
+    assert diff.max() < 0.06
+
+
+def test_batch_matches_one_image_at_a_time():
+    imgs = frames(3)
+
+    batch = new_segmentation(imgs)
+
+    one_at_a_time = np.concatenate([new_segmentation([img]) for img in imgs])
+    np.testing.assert_allclose(batch, one_at_a_time, rtol=0, atol=1e-6)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import web_mercator
+from inference_postprocessing import get_field_coords
+from mercator_conversions import ZOOM, original_field_coord
+from pygeotile.tile import Point, Tile
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    # Street2sat photos are in Africa, a few points anywhere to cover the edges
+    lats = np.concatenate([rng.uniform(-35, 37, 900), rng.uniform(-85, 85, 100)])
+    lons = np.concatenate([rng.uniform(-18, 52, 900), rng.uniform(-180, 180, 100)])
+    return lats, lons
+
+
+def test_latlon_to_pixels_and_tile_match_pygeotile(points):
+    lats, lons = points
+    pixels = web_mercator.latlon_to_pixels(lats, lons, ZOOM)
+    tiles = web_mercator.latlon_to_tile(lats, lons, ZOOM)
+
+    expected_pixels = [Point(lat, lon).pixels(ZOOM) for lat, lon in zip(lats, lons)]
+    expected_tiles = [
+        Tile.for_latitude_longitude(lat, lon, ZOOM).google
+        for lat, lon in zip(lats, lons)
+    ]
+    np.testing.assert_array_equal(np.stack(pixels, 1), expected_pixels)
+    np.testing.assert_array_equal(np.stack(tiles, 1), expected_tiles)
+
+
+def test_quadkeys_match_pygeotile(points):
+    lats, lons = points
+    tile_x, tile_y = web_mercator.latlon_to_tile(lats, lons, ZOOM)
+    quadkeys = web_mercator.tile_to_quadkey(tile_x, tile_y, ZOOM)
+
+    expected = [
+        Tile.from_google(x, y, ZOOM).quad_tree
+        for x, y in zip(tile_x.tolist(), tile_y.tolist())
+    ]
+    np.testing.assert_array_equal(quadkeys, expected)
+    round_trip_x, round_trip_y, zoom = web_mercator.quadkey_to_tile(quadkeys)
+    np.testing.assert_array_equal(round_trip_x, tile_x)
+    np.testing.assert_array_equal(round_trip_y, tile_y)
+    assert zoom == ZOOM
+
+
+def test_field_coords_match_pygeotile(points):
+    lats, lons = points
+    marks = np.random.default_rng(1).integers(0, 512, (len(lats), 2))
+    tile_x, tile_y = web_mercator.latlon_to_tile(lats, lons, ZOOM)
+    paths = [f"mapbox/{x}/{y}/{ZOOM}/photo.jpg" for x, y in zip(tile_x, tile_y)]
+
+    expected = [
+        original_field_coord(path, x, y) for path, (x, y) in zip(paths, marks.tolist())
+    ]
+    np.testing.assert_allclose(get_field_coords(paths, marks), expected, atol=1e-9)
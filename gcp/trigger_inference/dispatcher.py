@@ -0,0 +1,362 @@
+"""
+Sends storage events to an inference service in micro-batches.
+
+Uris are grouped into {"uris": [...]} requests of up to batch_size, sent
+once the batch is full or its oldest uri has waited max_delay seconds. At
+most max_in_flight requests are outstanding, over one pooled session. On
+429/503 and connection errors a batch is resent after a jittered
+exponential backoff, honouring Retry-After. Batches which still fail, and
+the uris a handler answered with an "error" in an otherwise successful
+batch, are stored in a SQLite retry queue and resent later, so no uri is
+dropped and a uri which keeps failing does not hold back the others.
+
+    gsutil ls gs://street2sat-uploaded/KENYA_v2/** | \\
+        python gcp/trigger_inference/dispatcher.py --url $CROPNOP_URL
+
+also drains the retry queue left by earlier runs.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# instrumentation.py is copied next to this file by deploy.sh
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from instrumentation import count, timer  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 503}
+# (connect, read) timeouts, the read covering a whole batch
+TIMEOUT = (3.05, 300)
+
+
+class DispatchError(Exception):
+    pass
+
+
+class RetryQueue:
+    """
+    Uris whose batch failed, with their attempts and when to try them next,
+    in a SQLite file which outlives the process
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS retries ("
+                "uri TEXT PRIMARY KEY, attempts INTEGER, next_attempt REAL, error TEXT)"
+            )
+
+    def put(self, uris: List[str], attempts: int, next_attempt: float, error: str):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?)",
+                [(uri, attempts, next_attempt, error) for uri in uris],
+            )
+
+    def claim(self, limit: int, lease: float) -> List[Tuple[str, int]]:
+        """
+        Returns up to limit (uri, attempts) whose next attempt is due and
+        postpones them by lease seconds, so they are not resent while in
+        flight but are again if this process dies
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            due = self._conn.execute(
+                "SELECT uri, attempts FROM retries WHERE next_attempt <= ? "
+                "ORDER BY next_attempt LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE retries SET next_attempt = ? WHERE uri = ?",
+                [(now + lease, uri) for uri, _ in due],
+            )
+        return due
+
+    def remove(self, uris: List[str]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM retries WHERE uri = ?", [(uri,) for uri in uris]
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM retries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_backoff(
+    attempt: int, base: float, cap: float, retry_after: Optional[str] = None
+) -> float:
+    """
+    Returns the seconds to wait before attempt, uniformly random up to the
+    exponential backoff (full jitter) and at least Retry-After
+    """
+    delay = random.uniform(0, min(cap, base * 2**attempt))
+    if retry_after is not None:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:  # An HTTP date, not worth parsing
+            pass
+    return delay
+
+
+class Dispatcher:
+    """
+    Batches uris into multi-uri requests to url, see the module docstring.
+
+    submit() returns a Future resolving to the service's response for the
+    uri, or raising DispatchError once the uri is in the retry queue. Without
+    a retry_queue failed uris are only reported, for the caller to retry.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        retry_queue: Optional[RetryQueue],
+        batch_size: int = 16,
+        max_delay: float = 0.5,
+        max_in_flight: int = 4,
+        max_attempts: int = 4,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 30.0,
+        retry_queue_delay: float = 60.0,
+        timeout: Tuple[float, float] = TIMEOUT,
+    ):
+        self.url = url
+        self.retry_queue = retry_queue
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_queue_delay = retry_queue_delay
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        self._pending: List[Tuple[str, Future]] = []
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = threading.Thread(target=self._batch_periodically, daemon=True)
+        self._thread.start()
+
+    def submit(self, uri: str) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Dispatcher is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((uri, future))
+            if len(self._pending) >= self.batch_size:
+                self._wake.notify()
+        return future
+
+    def flush(self):
+        """
+        Sends every pending uri now
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        self._send_batches(pending)
+
+    def retry_due(self, limit: int = 1000) -> int:
+        """
+        Resends the uris of the retry queue which are due, returns how many
+        """
+        if self.retry_queue is None:
+            return 0
+        lease = self.timeout[1] * self.max_attempts + self.backoff_cap
+        due = self.retry_queue.claim(limit, lease)
+        for start in range(0, len(due), self.batch_size):
+            batch = due[slice(start, start + self.batch_size)]
+            self._start(
+                [(uri, Future()) for uri, _ in batch],
+                queued_attempts=max(attempts for _, attempts in batch),
+            )
+        return len(due)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _batch_periodically(self):
+        while True:
+            with self._lock:
+                while not self._closed and (
+                    not self._pending
+                    or len(self._pending) < self.batch_size
+                    and time.monotonic() - self._oldest < self.max_delay
+                ):
+                    timeout = None
+                    if self._pending:
+                        timeout = self.max_delay - (time.monotonic() - self._oldest)
+                    self._wake.wait(timeout)
+                if self._closed:
+                    return
+                pending, self._pending = self._pending, []
+            self._send_batches(pending)
+
+    def _send_batches(self, pending: List[Tuple[str, Future]]):
+        for start in range(0, len(pending), self.batch_size):
+            self._start(pending[slice(start, start + self.batch_size)])
+
+    def _start(self, batch: List[Tuple[str, Future]], queued_attempts: int = 0):
+        # Blocks the batching thread while max_in_flight batches are outstanding
+        self._in_flight.acquire()
+        self._executor.submit(self._send, batch, queued_attempts)
+
+    def _send(self, batch: List[Tuple[str, Future]], queued_attempts: int):
+        uris = [uri for uri, _ in batch]
+        error = ""
+        try:
+            for attempt in range(self.max_attempts):
+                try:
+                    with timer("inference_request"):
+                        response = self.session.post(
+                            self.url, json={"uris": uris}, timeout=self.timeout
+                        )
+                except requests.RequestException as e:
+                    count("inference_responses", status="error")
+                    error, retry_after = str(e), None
+                else:
+                    count("inference_responses", status=response.status_code)
+                    if response.status_code == 200:
+                        failed = self._resolve(batch, response.json())
+                        if queued_attempts and self.retry_queue is not None:
+                            failed_uris = {uri for uri, _, _ in failed}
+                            self.retry_queue.remove(
+                                [uri for uri in uris if uri not in failed_uris]
+                            )
+                        for uri, future, uri_error in failed:
+                            self._queue(
+                                [(uri, future)],
+                                queued_attempts + attempt + 1,
+                                uri_error,
+                            )
+                        return
+                    error = f"{response.status_code} {response.text[:200]}"
+                    if response.status_code not in RETRY_STATUSES:
+                        break
+                    retry_after = response.headers.get("Retry-After")
+                if attempt + 1 < self.max_attempts:
+                    count("inference_retries")
+                    time.sleep(
+                        get_backoff(
+                            attempt, self.backoff_base, self.backoff_cap, retry_after
+                        )
+                    )
+            self._queue(batch, queued_attempts + self.max_attempts, error)
+        except Exception as e:
+            self._queue(batch, queued_attempts + self.max_attempts, str(e))
+        finally:
+            self._in_flight.release()
+
+    def _resolve(
+        self, batch: List[Tuple[str, Future]], resps
+    ) -> List[Tuple[str, Future, str]]:
+        """
+        Resolves the futures of the uris the service processed, returns the
+        uris it answered with an error, their future and the error
+        """
+        if not isinstance(resps, list) or len(resps) != len(batch):
+            raise DispatchError(f"Expecting {len(batch)} responses, got {resps}")
+        failed = []
+        for (uri, future), resp in zip(batch, resps):
+            if isinstance(resp, dict) and "error" in resp:
+                failed.append((uri, future, str(resp["error"])))
+            else:
+                future.set_result(resp)
+        return failed
+
+    def _queue(self, batch: List[Tuple[str, Future]], attempts: int, error: str):
+        uris = [uri for uri, _ in batch]
+        if self.retry_queue is not None:
+            logger.error(
+                f"Queueing {len(uris)} uris for retry after {attempts}: {error}"
+            )
+            count("inference_queued", len(uris))
+            next_attempt = time.time() + get_backoff(
+                attempts, self.retry_queue_delay, 3600.0
+            )
+            self.retry_queue.put(uris, attempts, next_attempt, error)
+        else:
+            logger.error(f"{len(uris)} uris failed after {attempts}: {error}")
+            count("inference_failed", len(uris))
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(DispatchError(error))
+
+
+def wait_for(futures: List[Future]) -> Dict[str, int]:
+    counts = {"ok": 0, "queued": 0}
+    for future in futures:
+        try:
+            future.result()
+            counts["ok"] += 1
+        except DispatchError:
+            counts["queued"] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default=os.environ.get("INFERENCE_URL"))
+    parser.add_argument("--retry-queue", default="dispatch_retries.sqlite")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--max-attempts", type=int, default=4)
+    parser.add_argument(
+        "--no-stdin", action="store_true", help="Only drain the retry queue"
+    )
+    args = parser.parse_args()
+
+    retry_queue = RetryQueue(args.retry_queue)
+    dispatcher = Dispatcher(
+        args.url,
+        retry_queue,
+        batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight,
+        max_attempts=args.max_attempts,
+    )
+    print(f"Retrying {dispatcher.retry_due(limit=sys.maxsize)} queued uris")
+    futures = []
+    if not args.no_stdin:
+        for line in sys.stdin:
+            if line.strip().startswith("gs://"):
+                futures.append(dispatcher.submit(line.strip()))
+    dispatcher.close()
+    print(json.dumps({**wait_for(futures), "retry_queue": len(retry_queue)}))
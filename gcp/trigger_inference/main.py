@@ -1,12 +1,111 @@
 import logging
 import os
+import sys
+import threading
 import time
+from pathlib import Path
+from typing import Optional
 
 import requests
 
+# instrumentation.py is copied next to this file by deploy.sh
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from dispatcher import (  # noqa: E402
+    RETRY_STATUSES,
+    Dispatcher,
+    DispatchError,
+    get_backoff,
+)
+from instrumentation import count, request_context, timer  # noqa: E402
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# "dispatch" batches the events of concurrent invocations into multi-uri
+# requests (see dispatcher.py), "single" posts each event on its own
+TRIGGER_MODE = os.environ.get("TRIGGER_MODE", "single")
+DISPATCH_BATCH_SIZE = int(os.environ.get("DISPATCH_BATCH_SIZE", 16))
+DISPATCH_MAX_DELAY = float(os.environ.get("DISPATCH_MAX_DELAY", 0.5))
+DISPATCH_MAX_IN_FLIGHT = int(os.environ.get("DISPATCH_MAX_IN_FLIGHT", 4))
+# A single uri, with its retries, must fit in the function's 300 s timeout
+TRIGGER_MAX_ATTEMPTS = int(os.environ.get("TRIGGER_MAX_ATTEMPTS", 3))
+TRIGGER_TIMEOUT = (3.05, 60)
+
+_dispatcher: Optional[Dispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> Dispatcher:
+    """
+    Returns the dispatcher of this instance, created on first use. It has no
+    retry queue, an instance's disk does not outlive it: failed events are
+    retried by the platform instead
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(
+                os.environ["INFERENCE_URL"],
+                None,
+                batch_size=DISPATCH_BATCH_SIZE,
+                max_delay=DISPATCH_MAX_DELAY,
+                max_in_flight=DISPATCH_MAX_IN_FLIGHT,
+            )
+    return _dispatcher
+
+
+def dispatch(src_path: str):
+    """
+    Sends src_path in the next batch and waits for its response. A failed
+    uri raises, so the event is not acknowledged and is delivered again
+    when the function is deployed with --retry
+    """
+    with request_context("trigger_dispatch", uri=src_path):
+        try:
+            logger.info(get_dispatcher().submit(src_path).result())
+        except DispatchError as e:
+            logger.error(f"Failed to process {src_path}, raising for a retry: {e}")
+            raise
+
+
+def post(url: str, src_path: str):
+    """
+    Posts src_path to url, resent after a jittered exponential backoff on
+    429/503 and connection errors. Raises once those attempts are used up,
+    so the event is delivered again when the function is deployed with
+    --retry. Any other failed response is only logged, a resend would fail
+    the same way.
+    """
+    error = ""
+    for attempt in range(TRIGGER_MAX_ATTEMPTS):
+        retry_after = None
+        logger.info("Sending request")
+        try:
+            with timer("inference_request"):
+                response = requests.post(
+                    url, data={"uri": src_path}, timeout=TRIGGER_TIMEOUT
+                )
+        except requests.RequestException as e:
+            count("inference_responses", status="error")
+            error = str(e)
+        else:
+            logger.info(response.status_code)
+            count("inference_responses", status=response.status_code)
+            if response.status_code == 200:
+                logger.info(response.json())
+                return
+            error = f"{response.status_code} {response.text[:200]}"
+            if response.status_code not in RETRY_STATUSES:
+                logger.error(f"Failed response: {error}")
+                return
+            retry_after = response.headers.get("Retry-After")
+        if attempt + 1 < TRIGGER_MAX_ATTEMPTS:
+            count("inference_retries")
+            time.sleep(get_backoff(attempt, 1.0, 30.0, retry_after))
+    logger.error(f"Failed to process {src_path}, raising for a retry: {error}")
+    raise DispatchError(error)
+
 
 def hello_gcs(event, context=None):
     """Triggered by a change to a Cloud Storage bucket.
@@ -20,19 +119,14 @@ def hello_gcs(event, context=None):
     src_path = f"gs://{bucket_name}/{blob_name}"
     logger.info(src_path)
 
+    if TRIGGER_MODE == "dispatch":
+        dispatch(src_path)
+        return
+
     url = os.environ.get("INFERENCE_URL")
     logger.info(url)
-    data = {"uri": src_path}
-    for _ in range(3):
-        logger.info("Sending request")
-        response = requests.post(url, data=data)
-        logger.info("Received response")
-        logger.info(response.status_code)
-        if response.status_code == 200:
-            logger.info(response.json())
-            break
-        logger.error(f"Failed response: {response.raw}")
-        time.sleep(5)
+    with request_context("trigger", uri=src_path, url=url):
+        post(url, src_path)
 
 
 if __name__ == "__main__":
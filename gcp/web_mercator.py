@@ -0,0 +1,103 @@
+"""
+Web Mercator (EPSG:3857) conversions between latitude/longitude, global
+pixels, Google XYZ tiles and Bing quadkeys, over whole arrays at once.
+
+Results match pygeotile: pixels are rounded to integers half to even and a
+pixel on the left/top edge of a tile belongs to the tile before it.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+EARTH_RADIUS = 6378137.0
+TILE_SIZE = 256
+ORIGIN_SHIFT = np.pi * EARTH_RADIUS
+INITIAL_RESOLUTION = 2 * np.pi * EARTH_RADIUS / TILE_SIZE
+
+
+def resolution(zoom) -> np.ndarray:
+    """
+    Returns the meters per pixel at the equator at zoom
+    """
+    return INITIAL_RESOLUTION / 2.0 ** np.asarray(zoom)
+
+
+def latlon_to_pixels(lat, lon, zoom) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the global pixels, origin top left, of every (lat, lon) at zoom
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    meter_x = lon * ORIGIN_SHIFT / 180.0
+    meter_y = np.log(np.tan((90.0 + lat) * np.pi / 360.0)) * EARTH_RADIUS
+    res = resolution(zoom)
+    pixel_x = np.abs(np.round((meter_x + ORIGIN_SHIFT) / res))
+    pixel_y = np.abs(np.round((meter_y - ORIGIN_SHIFT) / res))
+    return pixel_x.astype(np.int64), pixel_y.astype(np.int64)
+
+
+def pixels_to_latlon(pixel_x, pixel_y, zoom) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the (lat, lon) of every global pixel at zoom
+    """
+    res = resolution(zoom)
+    meter_x = np.asarray(pixel_x, dtype=np.float64) * res - ORIGIN_SHIFT
+    meter_y = ORIGIN_SHIFT - np.asarray(pixel_y, dtype=np.float64) * res
+    lon = meter_x / ORIGIN_SHIFT * 180.0
+    lat = np.degrees(2 * np.arctan(np.exp(meter_y / EARTH_RADIUS)) - np.pi / 2)
+    return lat, lon
+
+
+def pixels_to_tile(pixel_x, pixel_y) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the Google (x, y) of the tile of every global pixel
+    """
+    tile_x = np.ceil(np.asarray(pixel_x) / TILE_SIZE) - 1
+    tile_y = np.ceil(np.asarray(pixel_y) / TILE_SIZE) - 1
+    return tile_x.astype(np.int64), tile_y.astype(np.int64)
+
+
+def latlon_to_tile(lat, lon, zoom) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the Google (x, y) of the tile of every (lat, lon) at zoom
+    """
+    return pixels_to_tile(*latlon_to_pixels(lat, lon, zoom))
+
+
+def tile_to_pixels(tile_x, tile_y) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the global pixel of the top left corner of every Google tile
+    """
+    return np.asarray(tile_x) * TILE_SIZE, np.asarray(tile_y) * TILE_SIZE
+
+
+def tile_to_quadkey(tile_x, tile_y, zoom: int) -> np.ndarray:
+    """
+    Returns the Bing quadkey of every Google tile at zoom
+    """
+    tile_x = np.asarray(tile_x, dtype=np.int64)
+    tile_y = np.asarray(tile_y, dtype=np.int64)
+    shifts = np.arange(zoom - 1, -1, -1)
+    digits = ((tile_x[..., None] >> shifts) & 1) + 2 * (
+        (tile_y[..., None] >> shifts) & 1
+    )
+    # Digits as ASCII bytes, viewed as one fixed width string per tile
+    ascii_digits = np.ascontiguousarray((digits + ord("0")).astype(np.uint8))
+    return ascii_digits.view(f"S{zoom}")[..., 0].astype(str)
+
+
+def quadkey_to_tile(quadkeys) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Returns the Google (x, y) and zoom of quadkeys, all of the same zoom
+    """
+    quadkeys = np.asarray(quadkeys, dtype=str)
+    zoom = len(quadkeys.flat[0]) if quadkeys.size else 0
+    digits = (
+        quadkeys.astype(f"S{zoom}").view(np.uint8).reshape(*quadkeys.shape, zoom)
+        - ord("0")
+    ).astype(np.int64)
+    weights = 1 << np.arange(zoom - 1, -1, -1)
+    tile_x = ((digits & 1) * weights).sum(axis=-1)
+    tile_y = ((digits >> 1) * weights).sum(axis=-1)
+    return tile_x, tile_y, zoom